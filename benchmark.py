@@ -0,0 +1,393 @@
+"""
+Бенчмарк горячих путей редактора на разных размерах текстуры.
+
+Редактор создаётся без интерфейса (root=None) — дисплей не нужен.
+Результаты пишутся в JSON и сравниваются с сохранённым эталоном:
+
+    python benchmark.py                                  # все размеры, таблица в консоль
+    python benchmark.py --sizes 16 64 --out result.json
+    python benchmark.py --baseline bench_baseline.json   # код выхода 1 при регрессии
+    python benchmark.py --baseline bench_baseline.json --update-baseline
+
+Режим бюджета памяти: сценарии сеансов под tracemalloc, код выхода 1,
+если пик памяти больше бюджета (в МБ):
+
+    python benchmark.py --memory
+    python benchmark.py --memory --budget strokes_256=150 --session journal.oplog=80
+"""
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import PIL
+
+import minecraft_texture_painter as mtp
+
+SIZES = (16, 32, 64, 128, 256)
+
+# Замедление больше THRESHOLD считается регрессией, если оно больше NOISE_FLOOR_S по абсолютной величине
+THRESHOLD = 0.25
+NOISE_FLOOR_S = 50e-6
+
+FORMAT = "mc-texture-bench"
+VERSION = 1
+
+
+def seed_content(app, rng):
+    """Блочный «пиксель-арт» из 8 цветов, на каждой грани свой"""
+    ts = app.texture_size
+    palette = rng.integers(0, 256, (8, 4), dtype=np.uint8)
+    palette[:, 3] = 255
+    for face in app.FACE_NAMES:
+        cells = rng.integers(0, len(palette), (ts // 4 + 1, ts // 4 + 1))
+        index = cells.repeat(4, axis=0).repeat(4, axis=1)[:ts, :ts]
+        app.faces[face] = mtp.TiledFace.from_array(palette[index])
+    app.save_state()
+
+
+def session_strokes(app):
+    """Штрихи кистью по всем граням: история заполняется до max_history, затем откат"""
+    ts = app.texture_size
+    app.current_tool, app.brush_size = "brush", max(3, ts // 16)
+    rng = np.random.default_rng(2)
+    for k in range(app.max_history + 20):
+        app.current_face = app.FACE_NAMES[k % len(app.FACE_NAMES)]
+        points = [tuple(p) for p in rng.integers(0, ts, (6, 2)).tolist()]
+        app.begin_stroke(*points[0])
+        app.stroke_to(points[1:])
+        app.end_stroke()
+    for _ in range(app.max_history // 2):
+        app.undo()
+
+
+def session_filters(app):
+    """Фильтры на всю грань по очереди на всех гранях — каждый шаг истории меняет все тайлы грани"""
+    kinds = list(mtp.CONV_FILTERS)
+    for k in range(app.max_history):
+        app.current_face = app.FACE_NAMES[k % len(app.FACE_NAMES)]
+        app.apply_filter(kinds[k % len(kinds)], 1)
+
+
+def session_layers(app):
+    """По четыре слоя на грани, штрихи в каждом слое, откат и возврат"""
+    ts = app.texture_size
+    app.current_tool = "pencil"
+    for face in app.FACE_NAMES:
+        app.current_face = face
+        for i in range(3):
+            app.add_layer()
+            app.begin_stroke(i, 0)
+            app.stroke_to([(ts - 1, ts - 1 - i), (0, ts - 1)])
+            app.end_stroke()
+    for _ in range(20):
+        app.undo()
+    for _ in range(20):
+        app.redo()
+
+
+def session_workspace(app):
+    """Двенадцать блоков из шаблонов с переключением между ними"""
+    templates = [name for name in dir(app) if name.startswith("tpl_")]
+    for k in range(12):
+        app.new_workspace_block()
+        getattr(app, templates[k % len(templates)])()
+    for name in sorted(app.workspace.blocks):
+        app.switch_block(name)
+
+
+# Имя: (размер текстуры, сценарий, бюджет пика памяти в МБ).
+# Бюджеты — замеренный пик с запасом около полутора раз
+MEMORY_SESSIONS = {
+    "strokes_256": (256, session_strokes, 24),
+    "filters_256": (256, session_filters, 32),
+    "layers_128": (128, session_layers, 6),
+    "workspace_64": (64, session_workspace, 4),
+}
+
+
+def measure_memory(session, size=None):
+    """
+    Выполнить сценарий на новом редакторе под tracemalloc.
+    Пик и остаток — всё, что выделено Python и NumPy за сеанс, включая
+    сам редактор; отчёт memory_report — разбивка по подсистемам в конце.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        t0 = time.perf_counter()
+        app = mtp.MinecraftBlockTexturePainter(None)
+        if size is not None:
+            app.resize_texture(size, "crop")
+            seed_content(app, np.random.default_rng(size))
+        session(app)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        seconds = time.perf_counter() - t0
+        breakdown = app.memory_report()
+    finally:
+        tracemalloc.stop()
+    return {"peak_mb": peak / 2 ** 20, "retained_mb": current / 2 ** 20, "seconds": seconds,
+            "history": len(app.history), "report": breakdown}
+
+
+def run_memory(sessions, log=print):
+    """sessions: {имя: (размер или None, сценарий, бюджет МБ)}; результаты и список превышений"""
+    results, over = {}, []
+    for name, (size, session, budget) in sessions.items():
+        result = measure_memory(session, size)
+        result["budget_mb"] = budget
+        results[name] = result
+        exceeded = result["peak_mb"] > budget
+        if exceeded:
+            over.append((name, result["peak_mb"], budget))
+        parts = ", ".join(f"{key} {mtp.format_bytes(value)}" for key, value in result["report"].items())
+        log(f"{name:<20} пик {result['peak_mb']:7.1f} МБ / бюджет {budget:g} МБ, "
+            f"остаток {result['retained_mb']:.1f} МБ{'  ПРЕВЫШЕН' if exceeded else ''}")
+        log(f"{'':<20} {parts}")
+    return results, over
+
+
+def oplog_session(path):
+    """Сценарий из журнала операций (python minecraft_texture_painter.py --replay)"""
+    ops = mtp.OpLog.read(path)
+
+    def session(app):
+        mtp.replay_op_log(ops, render=False, app=app)
+    return session
+
+
+def make_cases(app, folder):
+    """
+    Список (имя, подготовка, замер). Подготовка не замеряется и
+    выполняется перед серией замеров; замер вызывается много раз подряд.
+    """
+    ts = app.texture_size
+    rng = np.random.default_rng(1)
+    points = [tuple(p) for p in rng.integers(0, ts, (256, 2)).tolist()]
+    path = [(ts // 10, ts // 10), (ts * 9 // 10, ts // 2), (ts // 5, ts * 9 // 10), (ts // 2, 0)]
+    colors = itertools.cycle(["#c04020", "#20c040"])
+    atlas_path = os.path.join(folder, "atlas.png")
+    project_path = os.path.join(folder, "project.json")
+
+    def tool(name, **settings):
+        def setup():
+            app.current_tool = name
+            for key, value in settings.items():
+                setattr(app, key, value)
+        return setup
+
+    def set_pixels():
+        for x, y in points:
+            app.set_pixel(x, y, "#ff0000")
+
+    def stroke():
+        app.begin_stroke(*path[0])
+        app.stroke_to(path[1:])
+        app.end_stroke()
+
+    def clear_front():
+        app.faces["front"].clear()
+
+    def undo_redo():
+        app.undo()
+        app.redo()
+
+    def render_3d():
+        app._snapshot = None
+        app._render_3d(app._preview_snapshot(), 25, 45, 1)
+
+    def save_project():
+        memo = {}
+        layers = {face: app.layers[face].snapshot(memo) for face in app.FACE_NAMES}
+        mtp.write_project(project_path, app.texture_size, layers)
+
+    cases = [
+        ("set_pixel x256", None, set_pixels),
+        ("pencil_stroke", tool("pencil"), stroke),
+        ("brush_stroke", tool("brush", brush_size=max(3, ts // 8), brush_antialias=True, paint_alpha=160),
+         stroke),
+        ("flood_fill", clear_front, lambda: app.flood_fill(0, 0, next(colors))),
+    ]
+    for kind in mtp.CONV_FILTERS:
+        radius = 2 if kind in ("box_blur", "gaussian_blur") else 1
+        cases.append((f"filter_{kind}", tool("pencil", paint_alpha=255),
+                      lambda k=kind, r=radius: app.apply_filter(k, r)))
+    cases += [
+        ("filter_brightness", None, lambda: app.adjust_brightness(20)),
+        ("filter_grayscale", None, app.grayscale_face),
+        ("filter_invert", None, app.invert_face),
+        ("filter_noise", None, app.noise_face),
+        ("rotate_face", None, lambda: app.rotate_face(90)),
+        ("flip_face", None, lambda: app.flip_face("h")),
+        ("shift_face", None, lambda: app.shift_face(1, 0)),
+        ("save_state", None, app.save_state),
+        ("undo_redo", None, undo_redo),
+        ("_face_to_pil", None, lambda: app._face_to_pil("front")),
+        ("update_3d_preview (render)", None, render_3d),
+        ("save_atlas", None, lambda: app.write_atlas(atlas_path)),
+        ("open_atlas", lambda: app.write_atlas(atlas_path), lambda: app.load_atlas(atlas_path)),
+        ("save_project", None, save_project),
+        ("open_project", save_project, lambda: app.load_project(project_path)),
+        ("export_resourcepack", None, lambda: app.write_resourcepack(folder, "pack", "block")),
+    ]
+    return cases
+
+
+def time_case(func, min_time, min_runs=3, max_runs=500):
+    """Повторять func, пока не наберётся min_time секунд (не меньше min_runs раз)"""
+    func()  # прогрев: кэши, ленивые таблицы
+    times = []
+    total = 0.0
+    while len(times) < max_runs and (len(times) < min_runs or total < min_time):
+        t0 = time.perf_counter()
+        func()
+        dt = time.perf_counter() - t0
+        times.append(dt)
+        total += dt
+    return {"median": statistics.median(times), "min": min(times), "runs": len(times)}
+
+
+def run(sizes, min_time, only=None, log=print):
+    results = {}
+    for size in sizes:
+        app = mtp.MinecraftBlockTexturePainter(None)
+        app.resize_texture(size, "crop")
+        seed_content(app, np.random.default_rng(size))
+        folder = tempfile.mkdtemp(prefix="mc_bench_")
+        try:
+            results[str(size)] = cases = {}
+            for name, setup, func in make_cases(app, folder):
+                if only and not any(part in name for part in only):
+                    continue
+                if setup is not None:
+                    setup()
+                cases[name] = time_case(func, min_time)
+                log(f"{size:>4} {name:<28} {1000 * cases[name]['median']:10.3f} мс "
+                    f"({cases[name]['runs']} раз)")
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    return {
+        "format": FORMAT,
+        "version": VERSION,
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, threshold=THRESHOLD):
+    """Строки сравнения с эталоном и список регрессий (размер, имя, во сколько раз медленнее)"""
+    lines, regressions = [], []
+    for size, cases in report["results"].items():
+        base = baseline.get("results", {}).get(size, {})
+        for name, result in cases.items():
+            ref = base.get(name)
+            if ref is None:
+                lines.append(f"{size:>4} {name:<28} {'—':>10}  (нет в эталоне)")
+                continue
+            ratio = result["median"] / ref["median"] if ref["median"] > 0 else float("inf")
+            slower = ratio > 1 + threshold and result["median"] - ref["median"] > NOISE_FLOOR_S
+            mark = "  РЕГРЕССИЯ" if slower else ""
+            lines.append(f"{size:>4} {name:<28} {ratio:9.2f}×{mark}")
+            if slower:
+                regressions.append((size, name, ratio))
+    return lines, regressions
+
+
+def parse_budget(text):
+    """ИМЯ=МБ -> (имя, мегабайты)"""
+    name, sep, mb = text.rpartition("=")
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(f"ожидается ИМЯ=МБ: {text!r}")
+    try:
+        return name, float(mb)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"бюджет не число: {text!r}")
+
+
+def main_memory(args):
+    sessions = dict(MEMORY_SESSIONS)
+    for path, budget in args.session:
+        sessions[os.path.basename(path)] = (None, oplog_session(path), budget)
+    for name, budget in args.budget:
+        if name not in sessions:
+            print(f"Неизвестный сценарий: {name}", file=sys.stderr)
+            return 2
+        size, session, _ = sessions[name]
+        sessions[name] = (size, session, budget)
+    if args.only:
+        sessions = {name: v for name, v in sessions.items() if any(part in name for part in args.only)}
+    results, over = run_memory(sessions)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"format": FORMAT, "version": VERSION, "memory": results}, f, indent=1)
+    if over:
+        print(f"\nБюджет превышен: {', '.join(name for name, _, _ in over)}")
+        return 1
+    print("\nВсе сценарии в бюджете")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк горячих путей редактора текстур")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--only", nargs="+", metavar="ИМЯ", help="только замеры, в имени которых есть подстрока")
+    parser.add_argument("--min-time", type=float, default=0.2, help="секунд на один замер (по умолчанию 0.2)")
+    parser.add_argument("--out", help="записать результаты в JSON")
+    parser.add_argument("--baseline", help="эталон JSON для сравнения")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="допустимое замедление относительно эталона (0.25 = +25%%)")
+    parser.add_argument("--update-baseline", action="store_true", help="записать результаты в файл эталона")
+    parser.add_argument("--memory", action="store_true", help="сценарии под tracemalloc вместо замеров времени")
+    parser.add_argument("--budget", type=parse_budget, action="append", default=[], metavar="ИМЯ=МБ",
+                        help="бюджет пика памяти сценария (можно несколько раз)")
+    parser.add_argument("--session", type=parse_budget, action="append", default=[], metavar="ЖУРНАЛ=МБ",
+                        help="добавить сценарий из журнала операций со своим бюджетом")
+    args = parser.parse_args(argv)
+    if args.memory or args.session:
+        return main_memory(args)
+
+    report = run(args.sizes, args.min_time, args.only)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=1)
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Эталон записан: {args.baseline}")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("format") != FORMAT:
+        print(f"{args.baseline}: не результаты бенчмарка", file=sys.stderr)
+        return 2
+    lines, regressions = compare(report, baseline, args.threshold)
+    print("\nОтносительно эталона (медиана, больше 1 — медленнее):")
+    print("\n".join(lines))
+    if regressions:
+        print(f"\nРегрессий: {len(regressions)}")
+        return 1
+    print("\nРегрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,2453 @@
+import time
+
+START_TIME = time.perf_counter()  # отсчёт замера запуска (StartupTimer) — до импорта tkinter, PIL и NumPy
+
 import tkinter as tk
 from tkinter import ttk, colorchooser, filedialog, messagebox, simpledialog
-from PIL import Image, ImageTk, ImageDraw
+from PIL import Image
 import json
 import os
 import math
 import random
 import copy
+import zlib
+import pickle
+import struct
+import hashlib
+import weakref
+import tempfile
+import functools
+import collections
+import queue
+import itertools
+import threading
+import traceback
+
+import numpy as np
+
+
+# =============================================
+#  ТРАССИРОВКА (ПРОФИЛИРОВАНИЕ)
+# =============================================
+
+class Tracer:
+    """
+    Интервалы (spans) для профилирования: имя, категория, начало и
+    длительность в наносекундах, поток. Включается и выключается на ходу;
+    выключенный трассировщик стоит одну проверку флага на вызов. Хранятся
+    последние MAX_SPANS интервалов. Экспорт — Chrome trace JSON
+    (chrome://tracing, Perfetto) или сводка p50/p95/p99 по именам.
+    """
+
+    MAX_SPANS = 200000
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = collections.deque(maxlen=self.MAX_SPANS)  # (имя, категория, начало, длительность, поток)
+        self._threads = {}
+        self._origin = time.perf_counter_ns()
+
+    def start(self):
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def clear(self):
+        self.spans.clear()
+
+    def add(self, name, cat, start_ns, dur_ns):
+        # deque.append атомарен — потоки превью и журнала пишут без блокировки
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads[tid] = threading.current_thread().name
+        self.spans.append((name, cat, start_ns, dur_ns, tid))
+
+    def span(self, name, cat="misc"):
+        """with TRACER.span("имя"): ... — интервал вокруг произвольного участка кода"""
+        return _Span(self, name, cat) if self.enabled else _NO_SPAN
+
+    def chrome_trace(self):
+        """Интервалы в формате Chrome trace (события "X", время в микросекундах)"""
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                  for tid, name in list(self._threads.items())]
+        for name, cat, start, dur, tid in list(self.spans):
+            events.append({"name": name, "cat": cat, "ph": "X", "pid": pid, "tid": tid,
+                           "ts": (start - self._origin) / 1000, "dur": dur / 1000})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self):
+        """[(имя, категория, вызовов, всего мс, p50, p95, p99, max мс)] — по убыванию общего времени"""
+        groups = {}
+        for name, cat, _, dur, _ in list(self.spans):
+            groups.setdefault((name, cat), []).append(dur)
+        rows = []
+        for (name, cat), durs in groups.items():
+            ms = np.array(durs, dtype=np.float64) / 1e6
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            rows.append((name, cat, len(ms), float(ms.sum()), float(p50), float(p95), float(p99), float(ms.max())))
+        rows.sort(key=lambda r: -r[3])
+        return rows
+
+    def format_summary(self):
+        lines = [f"{'интервал':<28} {'катег.':<8} {'вызовов':>8} {'всего мс':>10} "
+                 f"{'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"]
+        for name, cat, n, total, p50, p95, p99, peak in self.summary():
+            lines.append(f"{name:<28} {cat:<8} {n:>8} {total:>10.1f} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f} {peak:>8.2f}")
+        return "\n".join(lines)
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "cat", "start")
+
+    def __init__(self, tracer, name, cat):
+        self.tracer, self.name, self.cat = tracer, name, cat
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.cat, self.start, time.perf_counter_ns() - self.start)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+# Один трассировщик на процесс: интервалы пишут и главный поток, и фоновые
+TRACER = Tracer()
+
+
+def traced(cat):
+    """Интервал вокруг каждого вызова функции (имя интервала — имя функции) при включённой трассировке"""
+    def decorate(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                TRACER.add(name, cat, start, time.perf_counter_ns() - start)
+
+        return wrapper
+    return decorate
+
+
+# =============================================
+#  ХРАНЕНИЕ ГРАНЕЙ (ТАЙЛЫ)
+# =============================================
+
+TILE_SIZE = 64
+TRANSPARENT = (0, 0, 0, 0)
+MAX_TEXTURE_SIZE = 1024
+
+# Поколение содержимого грани: новое при каждой записи, копии его сохраняют.
+# Равные поколения — гарантированно равное содержимое (ключ для кэшей)
+_generations = itertools.count(1)
+
+
+def hex_to_rgba(c, alpha=255):
+    """'#rrggbb' → (r, g, b, alpha), '#rrggbbaa' — альфа из строки; None — прозрачный"""
+    if not c:
+        return TRANSPARENT
+    if len(c) == 9:
+        alpha = int(c[7:9], 16)
+    if alpha == 0:
+        return TRANSPARENT
+    return int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16), alpha
+
+
+def rgba_to_hex(px, with_alpha=False):
+    """
+    (r, g, b, a) → '#rrggbb'; прозрачный — None. with_alpha — полупрозрачный
+    пиксель записывается как '#rrggbbaa' (без потерь, для файлов проекта).
+    """
+    if px[3] == 0:
+        return None
+    if with_alpha and px[3] < 255:
+        return f"#{int(px[0]):02x}{int(px[1]):02x}{int(px[2]):02x}{int(px[3]):02x}"
+    return f"#{int(px[0]):02x}{int(px[1]):02x}{int(px[2]):02x}"
+
+
+class TiledFace:
+    """
+    Пиксели одной грани — RGBA-тайлы TILE_SIZE×TILE_SIZE (uint8, полная
+    8-битная альфа, неумноженный цвет), которые существуют только там, где
+    есть хоть один не полностью прозрачный пиксель. Копии (история,
+    буфер обмена, снимки превью) разделяют тайлы и копируют тайл при первой
+    записи в него, поэтому память и время операций растут с затронутой
+    площадью, а не с размером текстуры. Прозрачный пиксель — (0, 0, 0, 0).
+    """
+
+    def __init__(self, size, tiles=None, generation=None):
+        self.size = size
+        self.tiles = tiles if tiles is not None else {}
+        self._owned = set()  # тайлы, которые не разделяются ни с одной копией
+        self._tile_gens = {}  # тайл → поколение его последнего изменения
+        self.generation = generation or next(_generations)
+
+    @classmethod
+    def from_array(cls, arr):
+        """Грань из массива (size, size, 4); прозрачные тайлы не выделяются"""
+        face = cls(arr.shape[0])
+        face.write(0, 0, np.ascontiguousarray(arr, dtype=np.uint8))
+        return face
+
+    # ---------- тайлы ----------
+
+    def _tile_shape(self, tx, ty):
+        return (min(TILE_SIZE, self.size - ty * TILE_SIZE),
+                min(TILE_SIZE, self.size - tx * TILE_SIZE), 4)
+
+    def _tiles_in(self, x0, y0, x1, y1):
+        """Ключи тайлов, пересекающих прямоугольник [x0, x1) × [y0, y1)"""
+        for ty in range(y0 // TILE_SIZE, (y1 - 1) // TILE_SIZE + 1):
+            for tx in range(x0 // TILE_SIZE, (x1 - 1) // TILE_SIZE + 1):
+                yield tx, ty
+
+    def _writable(self, key):
+        self.generation = next(_generations)
+        self._tile_gens[key] = self.generation
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = np.zeros(self._tile_shape(*key), dtype=np.uint8)
+        elif key in self._owned:
+            return tile
+        else:
+            tile = tile.copy()
+        self.tiles[key] = tile
+        self._owned.add(key)
+        return tile
+
+    def _drop_if_empty(self, key):
+        if not self.tiles[key][..., 3].any():
+            del self.tiles[key]
+            self._owned.discard(key)
+
+    def snapshot(self):
+        """Копия за O(числа тайлов): тайлы общие до первой записи в любую из копий"""
+        self._owned.clear()
+        copy_ = TiledFace(self.size, dict(self.tiles), self.generation)
+        copy_._tile_gens = dict(self._tile_gens)
+        return copy_
+
+    @property
+    def nbytes(self):
+        return sum(t.nbytes for t in self.tiles.values())
+
+    def changed_since(self, generation):
+        """Ключи тайлов, изменённых после поколения generation (для кэшей по областям)"""
+        return {key for key, gen in self._tile_gens.items() if gen > generation}
+
+    # ---------- чтение ----------
+
+    def get(self, x, y):
+        """RGBA пикселя кортежем"""
+        tile = self.tiles.get((x // TILE_SIZE, y // TILE_SIZE))
+        if tile is None:
+            return TRANSPARENT
+        return tuple(int(v) for v in tile[y % TILE_SIZE, x % TILE_SIZE])
+
+    def get_hex(self, x, y):
+        return rgba_to_hex(self.get(x, y))
+
+    def read(self, x0=0, y0=0, x1=None, y1=None):
+        """Копия области [x0, x1) × [y0, y1) — массив (h, w, 4)"""
+        x1 = self.size if x1 is None else x1
+        y1 = self.size if y1 is None else y1
+        out = np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+        for key in self._tiles_in(x0, y0, x1, y1):
+            tile = self.tiles.get(key)
+            if tile is None:
+                continue
+            bx, by = key[0] * TILE_SIZE, key[1] * TILE_SIZE
+            ix0, iy0 = max(x0, bx), max(y0, by)
+            ix1, iy1 = min(x1, bx + tile.shape[1]), min(y1, by + tile.shape[0])
+            out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = tile[iy0 - by:iy1 - by, ix0 - bx:ix1 - bx]
+        return out
+
+    def to_image(self, box=None):
+        """PIL Image (RGBA) всей грани или области box = (x0, y0, x1, y1)"""
+        return Image.fromarray(self.read(*(box or ())), "RGBA")
+
+    def colors(self):
+        """Непрозрачные цвета грани в виде '#rrggbb'"""
+        found = set()
+        for tile in self.tiles.values():
+            px = tile[tile[..., 3] > 0][:, :3].astype(np.uint32)
+            packed = np.unique((px[:, 0] << 16) | (px[:, 1] << 8) | px[:, 2])
+            found.update(f"#{int(v):06x}" for v in packed)
+        return found
+
+    def opaque_pixels(self):
+        """Итератор (x, y, '#rrggbb' или '#rrggbbaa') по видимым пикселям"""
+        for (tx, ty), tile in sorted(self.tiles.items()):
+            ys, xs = np.nonzero(tile[..., 3])
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                yield tx * TILE_SIZE + x, ty * TILE_SIZE + y, rgba_to_hex(tile[y, x], with_alpha=True)
+
+    def __eq__(self, other):
+        if not isinstance(other, TiledFace):
+            return NotImplemented
+        if self.size != other.size:
+            return False
+        for key in self.tiles.keys() | other.tiles.keys():
+            a, b = self.tiles.get(key), other.tiles.get(key)
+            if a is b:
+                continue
+            # Хранимый тайл никогда не бывает полностью прозрачным
+            if a is None or b is None or not np.array_equal(a, b):
+                return False
+        return True
+
+    __hash__ = None
+
+    # ---------- запись ----------
+
+    def set_pixel(self, x, y, rgba):
+        key = (x // TILE_SIZE, y // TILE_SIZE)
+        if rgba[3] == 0 and key not in self.tiles:
+            return
+        self._writable(key)[y % TILE_SIZE, x % TILE_SIZE] = rgba
+        if rgba[3] == 0:
+            self._drop_if_empty(key)
+
+    def write(self, x0, y0, data, mask=None):
+        """
+        Записать область с левым верхним углом (x0, y0). data — массив
+        (h, w, 4) или один цвет RGBA; mask (h, w) — какие пиксели писать.
+        Всё, что за краем грани, отбрасывается.
+        """
+        if isinstance(data, np.ndarray):
+            h, w = data.shape[:2]
+            color = None
+        else:
+            h, w = mask.shape
+            color = np.array(data, dtype=np.uint8)
+        cx0, cy0 = max(0, x0), max(0, y0)
+        cx1, cy1 = min(self.size, x0 + w), min(self.size, y0 + h)
+        if cx0 >= cx1 or cy0 >= cy1:
+            return
+        for key in self._tiles_in(cx0, cy0, cx1, cy1):
+            bx, by = key[0] * TILE_SIZE, key[1] * TILE_SIZE
+            th, tw = self._tile_shape(*key)[:2]
+            ix0, iy0 = max(cx0, bx), max(cy0, by)
+            ix1, iy1 = min(cx1, bx + tw), min(cy1, by + th)
+            dst = (slice(iy0 - by, iy1 - by), slice(ix0 - bx, ix1 - bx))
+            src = (slice(iy0 - y0, iy1 - y0), slice(ix0 - x0, ix1 - x0))
+            sub_mask = None if mask is None else mask[src]
+            if sub_mask is not None and not sub_mask.any():
+                continue
+            if key not in self.tiles:
+                # Прозрачное в пустой тайл — ничего не меняет
+                if color is not None and color[3] == 0:
+                    continue
+                if color is None:
+                    alpha = data[src][..., 3]
+                    if not (alpha[sub_mask] if sub_mask is not None else alpha).any():
+                        continue
+            tile = self._writable(key)
+            value = color if color is not None else data[src]
+            if sub_mask is None:
+                tile[dst] = value
+            elif color is not None:
+                tile[dst][sub_mask] = color
+            else:
+                tile[dst][sub_mask] = value[sub_mask]
+            self._drop_if_empty(key)
+
+    def fill(self, rgba):
+        """Залить грань одним цветом; тайлы одной формы разделяют один массив"""
+        self.clear()
+        if rgba[3] == 0:
+            return
+        shared = {}
+        n = (self.size + TILE_SIZE - 1) // TILE_SIZE
+        for ty in range(n):
+            for tx in range(n):
+                shape = self._tile_shape(tx, ty)
+                if shape not in shared:
+                    shared[shape] = np.empty(shape, dtype=np.uint8)
+                    shared[shape][:] = rgba
+                self.tiles[(tx, ty)] = shared[shape]
+                self._tile_gens[(tx, ty)] = self.generation
+
+    def clear(self):
+        self.generation = next(_generations)
+        self._tile_gens.update(dict.fromkeys(self.tiles, self.generation))
+        self.tiles = {}
+        self._owned = set()
+
+    def map_tiles(self, func):
+        """
+        Заменить каждый непустой тайл на func(tile). func возвращает новый
+        массив и не меняет входной — тот может быть общим с копиями.
+        """
+        self.generation = next(_generations)
+        self._tile_gens.update(dict.fromkeys(self.tiles, self.generation))
+        for key in list(self.tiles):
+            self.tiles[key] = func(self.tiles[key])
+            self._owned.add(key)
+            self._drop_if_empty(key)
+
+
+def flood_fill_mask(match, x, y):
+    """
+    Маска 4-связной области match (bool, h×w), содержащей (x, y).
+    Заливка отрезками: каждая строка разбивается на серии True один раз,
+    и каждая серия посещается не больше одного раза.
+    """
+    h = match.shape[0]
+    filled = np.zeros(match.shape, dtype=bool)
+    if not match[y, x]:
+        return filled
+    runs = {}
+
+    def row_runs(r):
+        if r not in runs:
+            padded = np.concatenate(([False], match[r], [False]))
+            edges = np.flatnonzero(padded[1:] != padded[:-1])
+            runs[r] = (edges[0::2], edges[1::2])
+        return runs[r]
+
+    starts, ends = row_runs(y)
+    i = int(np.searchsorted(starts, x, "right")) - 1
+    stack = [(y, int(starts[i]), int(ends[i]))]
+    seen = {(y, int(starts[i]))}
+    while stack:
+        r, left, right = stack.pop()
+        filled[r, left:right] = True
+        for nr in (r - 1, r + 1):
+            if not 0 <= nr < h:
+                continue
+            ns, ne = row_runs(nr)
+            # Серии соседней строки, перекрывающие [left, right)
+            for j in range(int(np.searchsorted(ne, left, "right")), int(np.searchsorted(ns, right, "left"))):
+                key = (nr, int(ns[j]))
+                if key not in seen:
+                    seen.add(key)
+                    stack.append((nr, int(ns[j]), int(ne[j])))
+    return filled
+
+
+def line_points(x0, y0, x1, y1):
+    """Тексели отрезка по Брезенхэму, от (x0, y0) до (x1, y1) включительно"""
+    dx, dy = abs(x1 - x0), abs(y1 - y0)
+    sx = 1 if x0 < x1 else -1
+    sy = 1 if y0 < y1 else -1
+    err = dx - dy
+    pts = []
+    while True:
+        pts.append((x0, y0))
+        if x0 == x1 and y0 == y1:
+            break
+        e2 = 2 * err
+        if e2 > -dy:
+            err -= dy; x0 += sx
+        if e2 < dx:
+            err += dx; y0 += sy
+    return pts
+
+
+def ellipse_outline(x0, y0, x1, y1):
+    """
+    Контур эллипса, вписанного в прямоугольник (x0, y0)–(x1, y1), по
+    целочисленному алгоритму средней точки (вариант А. Цингля для
+    произвольной рамки, в т.ч. чётной ширины). O(периметра).
+    Возвращает массивы (xs, ys); точки могут повторяться.
+    """
+    a, b = abs(x1 - x0), abs(y1 - y0)
+    b1 = b & 1
+    dx, dy = 4 * (1 - a) * b * b, 4 * (b1 + 1) * a * a
+    err = dx + dy + b1 * a * a
+    x0, x1 = min(x0, x1), max(x0, x1)
+    y0 = min(y0, y1) + (b + 1) // 2
+    y1 = y0 - b1
+    a, b1 = 8 * a * a, 8 * b * b
+    xs, ys = [], []
+    while True:
+        xs += (x1, x0, x0, x1)
+        ys += (y0, y0, y1, y1)
+        e2 = 2 * err
+        if e2 <= dy:
+            y0 += 1; y1 -= 1; dy += a; err += dy
+        if e2 >= dx or 2 * err > dy:
+            x0 += 1; x1 -= 1; dx += b1; err += dx
+        if x0 > x1:
+            break
+    while y0 - y1 <= b:  # очень плоский эллипс: досыпать концы
+        xs += (x0 - 1, x1 + 1, x0 - 1, x1 + 1)
+        ys += (y0, y0, y1, y1)
+        y0 += 1; y1 -= 1
+    return np.array(xs), np.array(ys)
+
+
+def outline_spans(xs, ys):
+    """Горизонтальные отрезки заливки по контуру: (rows, left, right) — крайние точки каждой строки"""
+    rows, inv = np.unique(ys, return_inverse=True)
+    left = np.full(len(rows), np.iinfo(np.int64).max, dtype=np.int64)
+    right = np.full(len(rows), np.iinfo(np.int64).min, dtype=np.int64)
+    np.minimum.at(left, inv, xs)
+    np.maximum.at(right, inv, xs)
+    return rows, left, right
+
+
+def convex_spans(corners):
+    """
+    Отрезки строк выпуклого многоугольника corners ((x, y), ...) в координатах
+    краёв текселей: в строку попадают тексели, центр которых внутри.
+    """
+    pts = np.asarray(corners, dtype=np.float64)
+    rows = np.arange(int(math.floor(pts[:, 1].min())), int(math.ceil(pts[:, 1].max())))
+    yc = rows + 0.5
+    left = np.full(len(rows), np.inf)
+    right = np.full(len(rows), -np.inf)
+    for (ax, ay), (bx, by) in zip(pts, np.roll(pts, -1, axis=0)):
+        if ay == by:
+            continue
+        inside = (yc >= min(ay, by)) & (yc < max(ay, by))
+        x = ax + (yc - ay) * (bx - ax) / (by - ay)
+        left = np.where(inside, np.minimum(left, x), left)
+        right = np.where(inside, np.maximum(right, x), right)
+    lo = np.ceil(left - 0.5)
+    hi = np.ceil(right - 0.5) - 1
+    keep = np.isfinite(lo) & np.isfinite(hi) & (hi >= lo)
+    return rows[keep], lo[keep].astype(np.int64), hi[keep].astype(np.int64)
+
+
+def thick_line_spans(x0, y0, x1, y1, width):
+    """Отрезок толщины width с квадратными концами — выпуклый четырёхугольник, заливка строками"""
+    dx, dy = x1 - x0, y1 - y0
+    length = math.hypot(dx, dy)
+    ux, uy = (dx / length, dy / length) if length else (1.0, 0.0)
+    h = width / 2
+    nx, ny = -uy * h, ux * h
+    ax, ay = x0 + 0.5 - ux * h, y0 + 0.5 - uy * h
+    bx, by = x1 + 0.5 + ux * h, y1 + 0.5 + uy * h
+    return convex_spans(((ax + nx, ay + ny), (bx + nx, by + ny), (bx - nx, by - ny), (ax - nx, ay - ny)))
+
+
+def span_points(rows, left, right, hole=None):
+    """
+    Тексели отрезков строк. hole = (rows, left, right) — вырезаемые отрезки
+    (внутренний контур кольца); строки без выреза заливаются целиком.
+    """
+    if hole is not None:
+        h_rows, h_left, h_right = hole
+        pos = np.searchsorted(h_rows, rows)
+        safe = np.minimum(pos, len(h_rows) - 1)
+        has = (pos < len(h_rows)) & (h_rows[safe] == rows)
+        hl, hr = np.where(has, h_left[safe], right + 1), np.where(has, h_right[safe], right)
+        # Строка с вырезом даёт два отрезка: до выреза и после
+        first = (rows, left, np.minimum(right, hl - 1))
+        second = (rows[has], np.maximum(left[has], hr[has] + 1), right[has])
+        parts = [span_points(*first), span_points(*second)]
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+    lengths = np.maximum(right - left + 1, 0)
+    total = int(lengths.sum())
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    xs = np.repeat(left, lengths) + np.arange(total) - starts
+    return xs, np.repeat(rows, lengths)
+
+
+def _ellipse_spans(x0, y0, x1, y1):
+    return outline_spans(*ellipse_outline(x0, y0, x1, y1))
+
+
+def _rect_spans(x0, y0, x1, y1):
+    rows = np.arange(y0, y1 + 1)
+    return rows, np.full(len(rows), x0), np.full(len(rows), x1)
+
+
+@functools.lru_cache(maxsize=16)
+def shape_points(tool, start, end, width=1):
+    """
+    Тексели фигуры инструмента tool от start до end: (xs, ys), массивы только
+    для чтения. Контуры — средней точкой / Брезенхэмом за O(периметра),
+    заливки и толстые контуры — отрезками строк. Кэшируется по аргументам:
+    превью во время перетаскивания и итоговая отрисовка используют одни
+    и те же точки. None для инструментов без контура (градиент).
+    """
+    (x0, y0), (x1, y1) = start, end
+    mnx, mxx = min(x0, x1), max(x0, x1)
+    mny, mxy = min(y0, y1), max(y0, y1)
+    if tool in ("circle", "filled_circle") and (mnx == mxx or mny == mxy):
+        tool = "line"
+    if tool == "line":
+        if width <= 1:
+            xs, ys = np.array(line_points(x0, y0, x1, y1)).T
+        else:
+            xs, ys = span_points(*thick_line_spans(x0, y0, x1, y1, width))
+    elif tool == "filled_rect":
+        xs, ys = span_points(*_rect_spans(mnx, mny, mxx, mxy))
+    elif tool == "filled_circle":
+        xs, ys = span_points(*_ellipse_spans(mnx, mny, mxx, mxy))
+    elif tool in ("rectangle", "circle"):
+        spans = _rect_spans if tool == "rectangle" else _ellipse_spans
+        w = max(1, width)
+        if tool == "circle" and w == 1:
+            xs, ys = ellipse_outline(mnx, mny, mxx, mxy)
+        elif mxx - mnx < 2 * w or mxy - mny < 2 * w:
+            xs, ys = span_points(*spans(mnx, mny, mxx, mxy))  # толщина съела всю фигуру
+        else:
+            xs, ys = span_points(*spans(mnx, mny, mxx, mxy), hole=spans(mnx + w, mny + w, mxx - w, mxy - w))
+    else:
+        return None
+    xs.setflags(write=False)
+    ys.setflags(write=False)
+    return xs, ys
+
+
+# =============================================
+#  ШТАМПЫ КИСТЕЙ
+# =============================================
+
+BRUSH_SHAPES = {"square": "Квадрат", "circle": "Круг", "diamond": "Ромб", "custom": "Из буфера"}
+
+
+@functools.lru_cache(maxsize=64)
+def brush_stamp(shape, size):
+    """
+    Штамп кисти size×size: (маска bool, покрытие float32 0..1). Покрытие
+    считается по 4×4 подвыборкам на тексель и даёт сглаженный край;
+    маска — тексели, покрытые хотя бы наполовину. Массивы только для чтения.
+    """
+    sub = (np.arange(size * 4) + 0.5) / 4 - size / 2
+    dx, dy = np.meshgrid(sub, sub)
+    r = size / 2
+    if shape == "circle":
+        inside = dx * dx + dy * dy <= r * r
+    elif shape == "diamond":
+        inside = np.abs(dx) + np.abs(dy) <= r
+    else:
+        inside = np.ones(dx.shape, dtype=bool)
+    alpha = inside.reshape(size, 4, size, 4).mean(axis=(1, 3)).astype(np.float32)
+    mask = alpha >= 0.5
+    mask[size // 2, size // 2] = True  # центр закрашивается всегда
+    alpha[mask] = np.maximum(alpha[mask], 0.5)
+    mask.setflags(write=False)
+    alpha.setflags(write=False)
+    return mask, alpha
+
+
+def stamp_from_array(arr):
+    """Штамп из картинки (h, w, 4): непрозрачная часть, обрезанная по рамке"""
+    alpha = arr[..., 3]
+    ys, xs = np.nonzero(alpha)
+    if not len(xs):
+        return None
+    alpha = alpha[ys.min():ys.max() + 1, xs.min():xs.max() + 1].astype(np.float32) / 255.0
+    return alpha > 0, alpha
+
+
+def stamp_coverage(xs, ys, stamp):
+    """
+    Покрытие следа штампа stamp (h, w), приложенного центром к каждой
+    точке (xs, ys). Возвращает (x0, y0, cov) — левый верхний угол и
+    плотный массив float32. Цикл идёт по тому, чего меньше: точкам или
+    текселям штампа, так что кисть 32px стоит столько же вызовов NumPy, сколько 1px.
+    """
+    h, w = stamp.shape
+    mx, my = int(xs.min()), int(ys.min())
+    cov = np.zeros((int(ys.max()) - my + h, int(xs.max()) - mx + w), dtype=np.float32)
+    px, py = xs - mx, ys - my
+    if len(px) <= np.count_nonzero(stamp):
+        for x, y in zip(px.tolist(), py.tolist()):
+            view = cov[y:y + h, x:x + w]
+            np.maximum(view, stamp, out=view)
+    else:
+        for sy, sx in zip(*np.nonzero(stamp)):
+            idx = (py + sy, px + sx)
+            cov[idx] = np.maximum(cov[idx], stamp[sy, sx])
+    return mx - w // 2, my - h // 2, cov
+
+
+# =============================================
+#  СИММЕТРИЯ (ТАБЛИЦЫ ПЕРЕСТАНОВОК)
+# =============================================
+
+SYMMETRY_MODES = {
+    "none": "Нет",
+    "x": "Зеркало X",
+    "y": "Зеркало Y",
+    "xy": "Зеркало X и Y",
+    "diagonal": "Диагональ",
+    "rot2": "Поворот 2×",
+    "rot4": "Поворот 4×",
+    "rot8": "Поворот 8×",
+    "kaleidoscope": "Калейдоскоп",
+}
+
+# Преобразования координат относительно центра грани: (u, v) -> (u', v')
+_SYM_OPS = {
+    "id": lambda u, v: (u, v),
+    "mx": lambda u, v: (-u, v),
+    "my": lambda u, v: (u, -v),
+    "r90": lambda u, v: (-v, u),
+    "r180": lambda u, v: (-u, -v),
+    "r270": lambda u, v: (v, -u),
+    "diag": lambda u, v: (v, u),
+    "anti": lambda u, v: (-v, -u),
+}
+
+_SYM_GROUPS = {
+    "none": ("id",),
+    "x": ("id", "mx"),
+    "y": ("id", "my"),
+    "xy": ("id", "mx", "my", "r180"),
+    "diagonal": ("id", "diag"),
+    "rot2": ("id", "r180"),
+    "rot4": ("id", "r90", "r180", "r270"),
+    "kaleidoscope": ("id", "r90", "r180", "r270", "mx", "my", "diag", "anti"),
+}
+
+
+@functools.lru_cache(maxsize=32)
+def symmetry_maps(mode, size):
+    """
+    Таблицы образов каждого текселя: (map_x, map_y), массивы int32
+    (K, size, size), K — число копий вместе с исходной. Считаются один раз
+    на режим и размер; тиражирование точек — одна выборка map[:, ys, xs].
+    Образ за краем грани (поворот на 45°) помечен -1.
+    """
+    c = (size - 1) / 2
+    v, u = np.mgrid[0:size, 0:size].astype(np.float64) - c
+    images = []
+    if mode == "rot8":
+        for k in range(8):
+            a = math.radians(45 * k)
+            images.append((u * math.cos(a) - v * math.sin(a), u * math.sin(a) + v * math.cos(a)))
+    else:
+        images = [_SYM_OPS[op](u, v) for op in _SYM_GROUPS[mode]]
+    map_x = np.rint(np.array([img[0] for img in images]) + c).astype(np.int32)
+    map_y = np.rint(np.array([img[1] for img in images]) + c).astype(np.int32)
+    outside = (map_x < 0) | (map_x >= size) | (map_y < 0) | (map_y >= size)
+    map_x[outside] = -1
+    map_y[outside] = -1
+    map_x.setflags(write=False)
+    map_y.setflags(write=False)
+    return map_x, map_y
+
+
+# =============================================
+#  ПРЕОБРАЗОВАНИЯ ГРАНЕЙ (ПЕРЕСТАНОВКИ ИНДЕКСОВ)
+# =============================================
+#
+# Операция — кортеж: ("rotate", 90 | -90 | 180), ("flip", "h" | "v"),
+# ("shift", dx, dy). Каждая — аффинное отображение текселей по модулю
+# размера, поэтому любая цепочка сводится к одной перестановке.
+
+def transform_affine(op, size):
+    """Операция как (M, t): тексель (x, y) переходит в M·(x, y) + t по модулю size"""
+    n = size - 1
+    kind = op[0]
+    if kind == "rotate":
+        angle = op[1] % 360
+        if angle == 90:  # по часовой стрелке
+            return np.array([[0, -1], [1, 0]]), np.array([n, 0])
+        if angle == 180:
+            return np.array([[-1, 0], [0, -1]]), np.array([n, n])
+        if angle == 270:
+            return np.array([[0, 1], [-1, 0]]), np.array([0, n])
+        return np.eye(2, dtype=int), np.zeros(2, dtype=int)
+    if kind == "flip":
+        if op[1] == "h":
+            return np.array([[-1, 0], [0, 1]]), np.array([n, 0])
+        return np.array([[1, 0], [0, -1]]), np.array([0, n])
+    if kind == "shift":
+        return np.eye(2, dtype=int), np.array([op[1], op[2]])
+    raise ValueError(f"Неизвестное преобразование: {op!r}")
+
+
+def compose_transforms(ops, size):
+    """Свести цепочку операций (по порядку применения) к одному (M, t)"""
+    m, t = np.eye(2, dtype=int), np.zeros(2, dtype=int)
+    for op in ops:
+        m2, t2 = transform_affine(op, size)
+        m, t = m2 @ m, (m2 @ t + t2) % size
+    return m, t
+
+
+@functools.lru_cache(maxsize=32)
+def transform_index(ops, size):
+    """
+    Индексы выборки (src_y, src_x) для всей цепочки: out = arr[src_y, src_x].
+    None, если цепочка сводится к тождеству.
+    """
+    m, t = compose_transforms(ops, size)
+    if (m == np.eye(2, dtype=int)).all() and not t.any():
+        return None
+    yy, xx = np.mgrid[0:size, 0:size]
+    dx, dy = xx - t[0], yy - t[1]
+    # M — матрица перестановки со знаками, обратная к ней — транспонированная
+    src_x = (m[0, 0] * dx + m[1, 0] * dy) % size
+    src_y = (m[0, 1] * dx + m[1, 1] * dy) % size
+    return src_y, src_x
+
+
+def apply_transform_sequence(faces, ops, names=None):
+    """
+    Применить цепочку операций к граням словаря faces ({имя: TiledFace})
+    за один проход на грань. names — какие грани (по умолчанию все).
+    Грани с общим буфером преобразуются один раз и остаются общими.
+    Возвращает список изменённых граней. Работает и без интерфейса.
+    """
+    names = list(faces) if names is None else names
+    ops = tuple(tuple(op) for op in ops)
+    changed = []
+    done = {}
+    for name in names:
+        pix = faces[name]
+        if id(pix) not in done:
+            index = transform_index(ops, pix.size)
+            if index is None or not pix.tiles:
+                continue
+            done[id(pix)] = TiledFace.from_array(pix.read()[index])
+        faces[name] = done[id(pix)]
+        changed.append(name)
+    return changed
+
+
+# =============================================
+#  СВЁРТОЧНЫЕ ФИЛЬТРЫ (РАЗДЕЛИМЫЕ ЯДРА)
+# =============================================
+
+CONV_FILTERS = {
+    "box_blur": "Размытие (усреднение)",
+    "gaussian_blur": "Размытие по Гауссу",
+    "sharpen": "Резкость",
+    "emboss": "Тиснение",
+    "edges": "Выделение краёв",
+    "outline": "Обводка",
+}
+
+# Ядра Собеля как произведение сглаживания и производной
+_SMOOTH_3 = np.array([1, 2, 1], dtype=np.float32) / 4
+_DERIV_3 = np.array([-1, 0, 1], dtype=np.float32) / 2
+_BOX_3 = np.ones(3, dtype=np.float32)
+
+
+def blur_kernel(kind, radius):
+    """Одномерное ядро размытия длины 2·radius + 1, сумма весов — 1"""
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    if kind == "gaussian_blur":
+        sigma = max(radius / 2.0, 0.5)
+        k = np.exp(-x * x / (2 * sigma * sigma))
+    else:
+        k = np.ones_like(x)
+    return k / k.sum()
+
+
+def _convolve_axis(data, kernel, axis):
+    """Свёртка вдоль оси с заворачиванием краёв — результат тайлится без швов"""
+    c = len(kernel) // 2
+    out = None
+    for i, w in enumerate(kernel):
+        if w == 0:
+            continue
+        part = np.roll(data, c - i, axis=axis) * w
+        out = part if out is None else out + part
+    return out
+
+
+def _separable(data, kx, ky):
+    """data — стопка (F, H, W, C): строки ядром kx, столбцы ядром ky"""
+    return _convolve_axis(_convolve_axis(data, kx, 2), ky, 1)
+
+
+def filter_stack(stack, kind, radius=1, color=None):
+    """
+    Фильтр для стопки граней (F, H, W, 4) uint8 за один проход по всем.
+    Цвет меняется только у видимых пикселей, альфа сохраняется; размытие
+    берёт соседей с весом их альфы (premultiplied). «Обводка» красит color прозрачные
+    пиксели, касающиеся непрозрачных.
+    """
+    opaque = stack[..., 3:] > 0
+    alpha = stack[..., 3:].astype(np.float32) / 255.0
+    rgb = stack[..., :3].astype(np.float32)
+    out = stack.copy()
+    if kind == "outline":
+        near = _separable(alpha, _BOX_3, _BOX_3) > 0
+        ring = near[..., 0] & ~opaque[..., 0]
+        out[ring] = color
+        return out
+
+    if kind in ("box_blur", "gaussian_blur", "sharpen"):
+        k = blur_kernel("box_blur" if kind == "sharpen" else kind, radius)
+        den = _separable(alpha, k, k)
+        blurred = np.where(den > 0, _separable(rgb * alpha, k, k) / np.maximum(den, 1e-6), rgb)
+        new = blurred if kind != "sharpen" else rgb + (rgb - blurred)
+    else:
+        gx = _separable(rgb, _DERIV_3, _SMOOTH_3)
+        gy = _separable(rgb, _SMOOTH_3, _DERIV_3)
+        if kind == "emboss":
+            new = rgb + gx + gy
+        else:  # edges
+            new = np.sqrt(gx * gx + gy * gy) * 2
+    new = np.clip(new + 0.5, 0, 255).astype(np.uint8)
+    out[..., :3] = np.where(opaque, new, stack[..., :3])
+    return out
+
+
+def distinct_buffers(faces, names):
+    """Грани из names по одной на общий буфер — чтобы запись на месте шла в буфер один раз"""
+    seen = set()
+    out = []
+    for name in names:
+        if id(faces[name]) not in seen:
+            seen.add(id(faces[name]))
+            out.append(name)
+    return out
+
+
+def filter_faces(faces, names, kind, radius=1, mask=None, color=TRANSPARENT):
+    """
+    Применить фильтр к граням names словаря faces ({имя: TiledFace}).
+    mask (size×size bool) ограничивает изменения областью: считается только
+    её рамка с полями на радиус ядра. Возвращает изменённую область или None.
+    """
+    names = distinct_buffers(faces, names)
+    size = faces[names[0]].size
+    if mask is None:
+        x0, y0, x1, y1 = 0, 0, size, size
+    else:
+        ys, xs = np.nonzero(mask)
+        if not len(xs):
+            return None
+        x0, y0, x1, y1 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+    margin = radius + 1
+    if x1 - x0 + 2 * margin >= size or y1 - y0 + 2 * margin >= size:
+        # Рамка почти во всю грань — свёртка всей грани, края заворачиваются точно
+        stack = np.stack([faces[n].read() for n in names])
+        out = filter_stack(stack, kind, radius, color)[:, y0:y1, x0:x1]
+    else:
+        # Поля берутся с другой стороны грани, если рамка у края
+        iy = np.arange(y0 - margin, y1 + margin) % size
+        ix = np.arange(x0 - margin, x1 + margin) % size
+        stack = np.stack([faces[n].read()[np.ix_(iy, ix)] for n in names])
+        out = filter_stack(stack, kind, radius, color)[:, margin:-margin, margin:-margin]
+    sub_mask = None if mask is None else mask[y0:y1, x0:x1]
+    for name, region in zip(names, out):
+        faces[name].write(x0, y0, region, mask=sub_mask)
+    return x0, y0, x1, y1
+
+
+# =============================================
+#  СЛОИ ГРАНИ
+# =============================================
+
+BLEND_MODES = {
+    "normal": "Обычный",
+    "multiply": "Умножение",
+    "screen": "Экран",
+    "overlay": "Перекрытие",
+    "add": "Сложение",
+}
+
+
+def _blend(mode, cb, cs):
+    """Функция смешивания B(фон, слой) для цветов 0..1"""
+    if mode == "multiply":
+        return cb * cs
+    if mode == "screen":
+        return cb + cs - cb * cs
+    if mode == "overlay":
+        return np.where(cb <= 0.5, 2 * cb * cs, 1 - 2 * (1 - cb) * (1 - cs))
+    if mode == "add":
+        return np.minimum(cb + cs, 1.0)
+    return cs
+
+
+def blend_color(dst, rgba, cov):
+    """
+    Наложить цвет rgba на пиксели dst (h, w, 4) uint8 с покрытием cov (h, w)
+    0..1: «source-over» в premultiplied alpha. Прозрачный цвет стирает —
+    альфа пикселя уменьшается пропорционально покрытию.
+    """
+    cov = cov[..., None]
+    a_dst = dst[..., 3:].astype(np.float32) / 255.0
+    out = dst.copy()
+    if rgba[3] == 0:
+        a = a_dst * (1 - cov)
+    else:
+        a_src = cov * (rgba[3] / 255.0)
+        a = a_src + a_dst * (1 - a_src)
+        prem = np.array(rgba[:3], dtype=np.float32) * a_src + dst[..., :3] * (a_dst * (1 - a_src))
+        rgb = np.where(a > 0, prem / np.maximum(a, 1e-6), 0.0)
+        out[..., :3] = np.clip(rgb + 0.5, 0, 255)
+    out[..., 3] = np.clip(a[..., 0] * 255.0 + 0.5, 0, 255)
+    out[out[..., 3] == 0] = 0
+    return out
+
+
+def composite_tiles(parts, shape):
+    """
+    Свести тайлы слоёв снизу вверх: parts — [(tile или None, непрозрачность, режим)].
+    Наложение «source-over» в premultiplied alpha; режим смешивания
+    применяется там, где под слоем уже что-то есть.
+    """
+    acc = np.zeros(shape[:2] + (3,), dtype=np.float32)   # цвет, умноженный на альфу
+    acc_a = np.zeros(shape[:2] + (1,), dtype=np.float32)
+    for tile, opacity, mode in parts:
+        if tile is None:
+            continue
+        cs = tile[..., :3].astype(np.float32) / 255.0
+        a = tile[..., 3:].astype(np.float32) * (opacity / 255.0)
+        if mode != "normal":
+            cb = np.where(acc_a > 0, acc / np.maximum(acc_a, 1e-6), 0.0)
+            cs = (1 - acc_a) * cs + acc_a * _blend(mode, cb, cs)
+        acc = cs * a + acc * (1 - a)
+        acc_a = a + acc_a * (1 - a)
+    out = np.zeros(shape, dtype=np.uint8)
+    rgb = np.where(acc_a > 0, acc / np.maximum(acc_a, 1e-6), 0.0)
+    out[..., :3] = np.clip(rgb * 255.0 + 0.5, 0, 255)
+    out[..., 3] = np.clip(acc_a[..., 0] * 255.0 + 0.5, 0, 255)
+    out[out[..., 3] == 0] = 0
+    return out
+
+
+class Layer:
+    """Слой грани: пиксели и свойства наложения"""
+
+    def __init__(self, pixels, name="Слой 1", opacity=1.0, visible=True, blend="normal"):
+        self.pixels = pixels
+        self.name = name
+        self.opacity = opacity
+        self.visible = visible
+        self.blend = blend
+
+    def copy(self, memo=None):
+        """Копия слоя. memo ({id буфера: копия}) сохраняет общие буферы общими и в копиях"""
+        if memo is None:
+            pixels = self.pixels.snapshot()
+        else:
+            pixels = memo.get(id(self.pixels))
+            if pixels is None:
+                pixels = memo[id(self.pixels)] = self.pixels.snapshot()
+        return Layer(pixels, self.name, self.opacity, self.visible, self.blend)
+
+
+class LayerStack:
+    """
+    Слои одной грани (снизу вверх) и кэш их сведения. Сведённая грань
+    пересчитывается только в тайлах, которые изменились в слоях с прошлого
+    раза; при смене свойств или порядка слоёв — целиком. Один обычный
+    видимый слой сводится сам в себя без копирования.
+    """
+
+    def __init__(self, size, layers=None, active=0):
+        self.size = size
+        self.layers = layers or [Layer(TiledFace(size))]
+        self.active = active
+        self._composite = None
+        self._seen = None  # подписи слоёв на момент последнего сведения
+
+    @property
+    def active_layer(self):
+        return self.layers[self.active]
+
+    def snapshot(self, memo=None):
+        """Копия стека с общими тайлами; кэш сведения переносится, если он актуален"""
+        copy_ = LayerStack(self.size, [layer.copy(memo) for layer in self.layers], self.active)
+        if self._composite is not None and self._seen == self._signature():
+            copy_._composite = self._composite.snapshot()
+            copy_._seen = copy_._signature()
+        return copy_
+
+    def invalidate(self):
+        self._composite = None
+        self._seen = None
+
+    def _signature(self):
+        return [(id(l.pixels), l.pixels.generation, l.opacity, l.visible, l.blend) for l in self.layers]
+
+    def flatten(self):
+        """Сведённая грань (TiledFace); не изменять — это кэш"""
+        visible = [l for l in self.layers if l.visible and l.opacity > 0]
+        if len(visible) == 1 and visible[0].opacity >= 1 and visible[0].blend == "normal":
+            return visible[0].pixels
+        sig = self._signature()
+        if self._composite is None or len(sig) != len(self._seen) or any(
+                a[0] != b[0] or a[2:] != b[2:] for a, b in zip(sig, self._seen)):
+            # Изменились слои или их свойства — сводим всё
+            self._composite = TiledFace(self.size)
+            keys = set()
+            for layer in visible:
+                keys.update(layer.pixels.tiles)
+        else:
+            keys = set()
+            for layer, new, old in zip(self.layers, sig, self._seen):
+                if new[1] != old[1]:
+                    keys |= layer.pixels.changed_since(old[1])
+        for key in keys:
+            parts = [(l.pixels.tiles.get(key), l.opacity, l.blend) for l in visible]
+            tile = composite_tiles(parts, self._composite._tile_shape(*key))
+            self._composite.write(key[0] * TILE_SIZE, key[1] * TILE_SIZE, tile)
+        self._seen = sig
+        return self._composite
+
+
+class ActiveLayers:
+    """
+    Представление «грань → пиксели активного слоя» с интерфейсом словаря.
+    Инструменты, фильтры и преобразования читают и пишут через него.
+    """
+
+    def __init__(self, stacks):
+        self.stacks = stacks
+
+    def __getitem__(self, face):
+        return self.stacks[face].active_layer.pixels
+
+    def __setitem__(self, face, pixels):
+        self.stacks[face].active_layer.pixels = pixels
+
+    def __iter__(self):
+        return iter(self.stacks)
+
+    def __len__(self):
+        return len(self.stacks)
+
+    def keys(self):
+        return self.stacks.keys()
+
+
+# =============================================
+#  РАБОЧАЯ ОБЛАСТЬ (НЕСКОЛЬКО БЛОКОВ)
+# =============================================
+
+BLOCK_FACES = ("top", "bottom", "front", "back", "left", "right")
+
+
+def _pixels_to_json(pixels):
+    return {f"{x},{y}": c for x, y, c in pixels.opaque_pixels()}
+
+
+def _pixels_from_json(size, pixels):
+    """{'x,y': '#rrggbb[aa]'} → TiledFace; ключи и цвета разбираются одной строкой каждые"""
+    arr = np.zeros((size, size, 4), dtype=np.uint8)
+    if pixels:
+        xy = np.array(",".join(pixels).split(","), dtype=np.int32).reshape(-1, 2)
+        joined = "".join(pixels.values())
+        if len(joined) == 7 * len(pixels):
+            # Все пиксели непрозрачные '#rrggbb'
+            rgb = np.frombuffer(bytes.fromhex(joined.replace("#", "")), dtype=np.uint8).reshape(-1, 3)
+            arr[xy[:, 1], xy[:, 0], :3] = rgb
+            arr[xy[:, 1], xy[:, 0], 3] = 255
+        else:
+            hexes = "".join(v[1:] if len(v) == 9 else v[1:] + "ff" for v in pixels.values())
+            rgba = np.frombuffer(bytes.fromhex(hexes), dtype=np.uint8).reshape(-1, 4).copy()
+            rgba[rgba[:, 3] == 0] = 0
+            arr[xy[:, 1], xy[:, 0]] = rgba
+    return TiledFace.from_array(arr)
+
+
+def project_to_json(size, layers):
+    """
+    Блок ({грань: LayerStack}) → словарь формата проекта. Грани хранятся
+    сведёнными (их читают и старые версии), слои — отдельно и только у
+    граней, где слой не один или у него не обычные свойства.
+    """
+    data = {"size": size}
+    saved_layers = {}
+    for face in BLOCK_FACES:
+        stack = layers[face]
+        data[face] = _pixels_to_json(stack.flatten())
+        only = stack.layers[0]
+        if len(stack.layers) > 1 or (only.opacity, only.visible, only.blend) != (1.0, True, "normal"):
+            saved_layers[face] = {"active": stack.active, "stack": [
+                {"name": layer.name, "opacity": layer.opacity, "visible": layer.visible,
+                 "blend": layer.blend, "pixels": _pixels_to_json(layer.pixels)}
+                for layer in stack.layers]}
+    if saved_layers:
+        data["layers"] = saved_layers
+    return data
+
+
+def project_from_json(data):
+    """Словарь формата проекта → (размер, {грань: LayerStack})"""
+    size = data.get("size", 16)
+    saved_layers = data.get("layers", {})
+    layers = {}
+    for face in BLOCK_FACES:
+        entry = saved_layers.get(face)
+        if entry:
+            stack = [Layer(_pixels_from_json(size, item.get("pixels", {})), item.get("name", "Слой"),
+                           item.get("opacity", 1.0), item.get("visible", True), item.get("blend", "normal"))
+                     for item in entry["stack"]]
+            layers[face] = LayerStack(size, stack, min(entry.get("active", 0), len(stack) - 1))
+        else:
+            # Старый формат — один слой
+            layers[face] = LayerStack(size, [Layer(_pixels_from_json(size, data.get(face, {})))])
+    return size, layers
+
+
+@traced("io")
+def write_project(path, size, layers):
+    """Записать проект атомарно (через временный файл); можно вызывать из фонового потока"""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(project_to_json(size, layers), f)
+    os.replace(tmp, path)
+    return path
+
+
+def face_content_hash(pix):
+    """Хэш содержимого грани; кэшируется в самой грани по её поколению"""
+    cached = getattr(pix, "_content_hash", None)
+    if cached is not None and cached[0] == pix.generation:
+        return cached[1]
+    h = hashlib.blake2b(str(pix.size).encode(), digest_size=16)
+    for key in sorted(pix.tiles):
+        h.update(repr(key).encode())
+        h.update(pix.tiles[key].tobytes())
+    digest = h.hexdigest()
+    pix._content_hash = (pix.generation, digest)
+    return digest
+
+
+class BlockEntry:
+    """Блок рабочей области: слои граней, своя история и откуда его перечитать"""
+
+    def __init__(self, name, size=16, layers=None, path=None):
+        self.name = name
+        self.size = size
+        self.layers = layers  # {грань: LayerStack}; None — блок выгружен из памяти
+        self.path = path  # файл проекта; None — блок ещё не сохранялся
+        self.spill = None  # временный файл выгруженного несохранённого блока
+        self.history = []  # заводится при первом открытии блока в редакторе
+        self.history_index = -1
+        self.current_face = "front"
+        self.modified = path is None and layers is not None
+        self.opened_sig = None  # поколения слоёв на момент открытия в редакторе
+
+    @property
+    def loaded(self):
+        return self.layers is not None
+
+    def sync_size(self):
+        """Размер берётся из слоёв: у текущего блока он меняется в редакторе"""
+        if self.layers is not None:
+            self.size = self.layers[BLOCK_FACES[0]].size
+        return self.size
+
+    @staticmethod
+    def signature(layers):
+        return tuple((face, tuple((l.pixels.generation, l.name, l.opacity, l.visible, l.blend)
+                                  for l in layers[face].layers), layers[face].active)
+                     for face in BLOCK_FACES)
+
+
+def face_nbytes(pix, seen):
+    """Байты тайлов грани, ещё не учтённых в seen (id тайлов)"""
+    total = 0
+    for tile in pix.tiles.values():
+        if id(tile) not in seen:
+            seen.add(id(tile))
+            total += tile.nbytes
+    return total
+
+
+def tiles_nbytes(states, seen):
+    """Байты тайлов состояний ({грань: LayerStack}), ещё не учтённых в seen (id тайлов)"""
+    return sum(face_nbytes(layer.pixels, seen)
+               for state in states for stack in state.values() for layer in stack.layers)
+
+
+def tile_sizes(states):
+    """{id тайла: байты} всех тайлов состояний ({грань: LayerStack}), каждый тайл один раз"""
+    return {id(tile): tile.nbytes
+            for state in states for stack in state.values()
+            for layer in stack.layers for tile in layer.pixels.tiles.values()}
+
+
+def image_nbytes(img):
+    """Байты пикселей PIL-картинки"""
+    return img.width * img.height * len(img.getbands())
+
+
+def format_bytes(n):
+    """Размер для подписей: КБ до мегабайта, дальше МБ"""
+    if n < 2 ** 20:
+        return f"{n / 1024:.0f} КБ"
+    return f"{n / 2 ** 20:.1f} МБ"
+
+
+class Workspace:
+    """
+    Несколько открытых блоков. Одинаковые буферы граней (по хэшу содержимого)
+    делятся между блоками. Блоки в памяти образуют LRU: когда тайлы всех
+    загруженных блоков и их историй занимают больше memory_limit байт,
+    давно открытые блоки выгружаются — сохранённый и неизменённый просто
+    забывается (перечитается из файла), изменённый пишется во временный
+    файл тайлами в двоичном виде (как в журнале восстановления) вместе с
+    историей — она возвращается при следующем открытии блока.
+    """
+
+    def __init__(self, memory_limit=256 * 2 ** 20):
+        self.memory_limit = memory_limit
+        self.blocks = collections.OrderedDict()  # имя → BlockEntry, от давно открытого к недавнему
+        self._interned = weakref.WeakValueDictionary()  # хэш содержимого → TiledFace
+        self._spill_dir = None
+
+    def _unique_name(self, name):
+        base, n = name, 2
+        while name in self.blocks:
+            name = f"{base} ({n})"
+            n += 1
+        return name
+
+    def add_block(self, name, size=16, layers=None, path=None):
+        """Добавить блок; с path и без layers он загрузится при первом открытии"""
+        if layers is None and path is None:
+            layers = {face: LayerStack(size) for face in BLOCK_FACES}
+        entry = BlockEntry(self._unique_name(name), size, layers, path)
+        if layers is not None:
+            self.intern(layers)
+        self.blocks[entry.name] = entry
+        return entry
+
+    def close_block(self, name):
+        entry = self.blocks.pop(name)
+        if entry.spill:
+            os.remove(entry.spill)
+
+    def intern(self, layers):
+        """Заменить буферы слоёв на уже известные с тем же содержимым"""
+        for stack in layers.values():
+            for layer in stack.layers:
+                key = face_content_hash(layer.pixels)
+                known = self._interned.get(key)
+                if known is None:
+                    self._interned[key] = layer.pixels
+                elif known is not layer.pixels and known == layer.pixels:
+                    layer.pixels = known
+                    stack.invalidate()
+
+    def activate(self, name):
+        """Блок для редактора: загружается при необходимости, становится самым недавним"""
+        entry = self.blocks[name]
+        if not entry.loaded:
+            self._load(entry)
+        self.blocks.move_to_end(name)
+        self.evict(keep=name)
+        return entry
+
+    def park(self, entry, layers, history, history_index, current_face):
+        """Вернуть состояние блока из редактора (при переключении на другой блок)"""
+        if entry.opened_sig is not None and BlockEntry.signature(layers) != entry.opened_sig:
+            entry.modified = True
+        entry.layers = layers
+        entry.history, entry.history_index = history, history_index
+        entry.current_face = current_face
+        entry.opened_sig = None
+        entry.sync_size()
+        self.intern(layers)
+
+    def memory_usage(self):
+        """Байты тайлов загруженных блоков и их историй; общие тайлы считаются один раз"""
+        seen = set()
+        return sum(tiles_nbytes([entry.layers] + entry.history, seen)
+                   for entry in self.blocks.values() if entry.loaded)
+
+    def evict(self, keep=None):
+        """
+        Выгружать давно открытые блоки, пока память не уложится в предел.
+        Тайлы обходятся один раз: у каждого считается число загруженных
+        блоков, которые на него ссылаются, и при выгрузке блока из занятой
+        памяти вычитаются тайлы, на которые больше никто не ссылается.
+        """
+        owned = {name: tile_sizes([entry.layers] + entry.history) for name, entry in self.blocks.items() if entry.loaded}
+        refs = collections.Counter()
+        sizes = {}
+        for tiles in owned.values():
+            refs.update(tiles.keys())
+            sizes.update(tiles)
+        usage = sum(sizes.values())
+        for name in list(self.blocks):
+            if usage <= self.memory_limit:
+                return
+            if name != keep and name in owned:
+                self._unload(self.blocks[name])
+                for tid in owned[name]:
+                    refs[tid] -= 1
+                    if not refs[tid]:
+                        usage -= sizes[tid]
+
+    @traced("io")
+    def _unload(self, entry):
+        # Сохранённый блок без истории правок перечитается из файла проекта
+        if entry.modified or entry.path is None or len(entry.history) > 1:
+            if self._spill_dir is None:
+                self._spill_dir = tempfile.mkdtemp(prefix="mc_painter_")
+            if entry.spill is None:
+                entry.spill = os.path.join(self._spill_dir, f"block_{next(_generations)}.bin")
+            # Общие тайлы слоёв и шагов истории pickle записывает один раз
+            states = [(next(iter(state.values())).size, *_state_tiles(state))
+                      for state in [entry.layers] + entry.history]
+            body = zlib.compress(pickle.dumps({"states": states, "history_index": entry.history_index},
+                                              protocol=pickle.HIGHEST_PROTOCOL), 1)
+            with open(entry.spill, "wb") as f:
+                f.write(body)
+        entry.layers = None
+        entry.history, entry.history_index = [], -1
+
+    @traced("io")
+    def _load(self, entry):
+        if entry.spill:
+            with open(entry.spill, "rb") as f:
+                rec = pickle.loads(zlib.decompress(f.read()))
+            states = [_layers_from_tiles(size, meta, tiles) for size, tiles, meta in rec["states"]]
+            entry.layers, entry.history, entry.history_index = states[0], states[1:], rec["history_index"]
+            entry.sync_size()
+        else:
+            with open(entry.path, "r") as f:
+                entry.size, entry.layers = project_from_json(json.load(f))
+        self.intern(entry.layers)
+
+    def block_snapshot(self, entry):
+        """(размер, {грань: LayerStack}) — снимок слоёв блока для записи в фоне; выгруженный загружается"""
+        if not entry.loaded:
+            self._load(entry)
+        memo = {}
+        return entry.sync_size(), {face: stack.snapshot(memo) for face, stack in entry.layers.items()}
+
+    def mark_saved(self, entry, path):
+        """Блок записан в path: при выгрузке он перечитается оттуда, временный файл не нужен"""
+        entry.path = path
+        entry.modified = False
+        if entry.spill:
+            os.remove(entry.spill)
+            entry.spill = None
+
+
+# =============================================
+#  ЖУРНАЛ ВОССТАНОВЛЕНИЯ (АВТОСОХРАНЕНИЕ В ФОНЕ)
+# =============================================
+
+_RECORD_HEADER = struct.Struct("<II")  # длина сжатой записи, crc32
+
+
+def _state_tiles(state):
+    """Состояние блока из истории → ({(грань, i): тайлы слоя}, {грань: описание стека})"""
+    tiles, meta = {}, {}
+    for face, stack in state.items():
+        meta[face] = {"active": stack.active,
+                      "layers": [(l.name, l.opacity, l.visible, l.blend) for l in stack.layers]}
+        for i, layer in enumerate(stack.layers):
+            tiles[(face, i)] = layer.pixels.tiles
+    return tiles, meta
+
+
+def _layers_from_tiles(size, meta, tiles):
+    """Обратно к _state_tiles: {грань: LayerStack} из тайлов слоёв и описаний стеков"""
+    layers = {}
+    for face, stack_meta in meta.items():
+        stack = [Layer(TiledFace(size, dict(tiles.get((face, i), {}))), *props)
+                 for i, props in enumerate(stack_meta["layers"])]
+        layers[face] = LayerStack(size, stack, stack_meta["active"])
+    return layers
+
+
+def _read_records(path):
+    """Записи файла журнала по порядку; оборванный хвост (сбой во время записи) отбрасывается"""
+    records = []
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return records
+    pos = 0
+    while pos + _RECORD_HEADER.size <= len(data):
+        size, crc = _RECORD_HEADER.unpack_from(data, pos)
+        body = data[pos + _RECORD_HEADER.size:pos + _RECORD_HEADER.size + size]
+        if len(body) < size or zlib.crc32(body) != crc:
+            break
+        records.append(pickle.loads(zlib.decompress(body)))
+        pos += _RECORD_HEADER.size + size
+    return records
+
+
+def _lock_folder(folder):
+    """
+    Исключительная блокировка папки журнала (файл lock) — открытый файл;
+    None, если папку держит другой запущенный редактор. Блокировку снимает
+    ОС при завершении процесса, в том числе при сбое.
+    """
+    os.makedirs(folder, exist_ok=True)
+    f = open(os.path.join(folder, "lock"), "a+b")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class Journal:
+    """
+    Журнал для восстановления после сбоя. Главный поток только кладёт в
+    очередь снимки из истории — они неизменяемы и делят тайлы с редактором.
+    Фоновый поток сравнивает снимок с последним записанным состоянием блока
+    по идентичности тайлов (изменённый тайл — всегда новый массив) и
+    дописывает в journal.bin лишь изменённые тайлы. Каждые COMPACT_RECORDS
+    записей состояние всех блоков пишется снимком snapshot.bin (атомарной
+    заменой), и журнал начинается заново. fsync — только в фоне, не чаще
+    раза в FSYNC_S секунд. Тот же поток выполняет фоновые задачи (запись
+    проектов), результаты забираются через poll() из главного потока.
+    Папка журнала заблокирована, пока редактор работает (см. claim):
+    второй запущенный редактор пишет в свою папку instance-N и не трогает
+    журнал первого.
+    """
+
+    COMPACT_RECORDS = 200
+    FSYNC_S = 2.0
+
+    def __init__(self, folder, lock=None):
+        """lock — блокировка папки из claim(); снимается при close()"""
+        self.folder = folder
+        self._lock = lock
+        os.makedirs(folder, exist_ok=True)
+        self._journal_path = os.path.join(folder, "journal.bin")
+        self._snapshot_path = os.path.join(folder, "snapshot.bin")
+        self._queue = queue.Queue()
+        self._results = queue.Queue()
+        self._busy = 0
+        self._prev = {}  # блок → (путь, размер, тайлы, описание) последнего записанного состояния
+        self._seq = 0
+        self._records = 0
+        self._unsynced = False
+        self._last_sync = 0.0
+        self._file = open(self._journal_path, "wb")
+        if os.path.exists(self._snapshot_path):
+            os.remove(self._snapshot_path)
+        self._thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self._thread.start()
+
+    # ---------- главный поток ----------
+
+    def log(self, block, path, state):
+        """Записать состояние блока (элемент истории); O(1) для вызывающего"""
+        self._queue.put(("state", block, path, state))
+
+    def forget(self, block):
+        self._queue.put(("forget", block))
+
+    def submit(self, func, args, on_done):
+        """Выполнить func(*args) в потоке журнала; on_done(результат) — из poll()"""
+        self._busy += 1
+        self._queue.put(("task", func, args, on_done))
+
+    def is_idle(self):
+        return self._busy == 0
+
+    def poll(self):
+        """Только из главного потока: выдать результаты фоновых задач"""
+        while True:
+            try:
+                on_done, result = self._results.get_nowait()
+            except queue.Empty:
+                return
+            self._busy -= 1
+            on_done(result)
+
+    def close(self, discard=True, timeout=5.0):
+        """Дописать очередь и остановить поток; discard — штатный выход, журнал не нужен"""
+        self._queue.put(("close", discard))
+        self._thread.join(timeout)
+
+    @staticmethod
+    def claim(base):
+        """
+        Папка журнала для этого редактора и её блокировка: base или
+        base/instance-N. Сначала — свободная папка с журналом прерванной
+        сессии (его можно восстановить), иначе первая свободная.
+        """
+        slots = [base]
+        if os.path.isdir(base):
+            slots += sorted(os.path.join(base, name) for name in os.listdir(base) if name.startswith("instance-"))
+        for folder in slots:
+            if Journal.pending(folder):
+                lock = _lock_folder(folder)
+                if lock is not None:
+                    return folder, lock
+        for n in itertools.count(1):
+            folder = base if n == 1 else os.path.join(base, f"instance-{n}")
+            lock = _lock_folder(folder)
+            if lock is not None:
+                return folder, lock
+
+    @staticmethod
+    def set_aside(folder):
+        """Переименовать журнал, который не удалось восстановить, — новый журнал его не затрёт"""
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        for name in ("journal.bin", "snapshot.bin"):
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                os.replace(path, os.path.join(folder, f"failed-{stamp}-{name}"))
+
+    @staticmethod
+    def pending(folder):
+        """Есть ли в папке журнал прерванной сессии"""
+        return any(os.path.isfile(os.path.join(folder, name)) and os.path.getsize(os.path.join(folder, name))
+                   for name in ("journal.bin", "snapshot.bin"))
+
+    @staticmethod
+    def recover(folder):
+        """Блоки прерванной сессии: {имя: (путь, размер, {грань: LayerStack})} в порядке последней правки"""
+        blocks = collections.OrderedDict()
+        base = _read_records(os.path.join(folder, "snapshot.bin"))
+        seq = base[0]["seq"] if base else 0
+        for name, rec in (base[0]["blocks"].items() if base else ()):
+            blocks[name] = rec
+        for rec in _read_records(os.path.join(folder, "journal.bin")):
+            if rec["seq"] <= seq:
+                continue
+            name = rec["block"]
+            if rec["kind"] == "forget":
+                blocks.pop(name, None)
+                continue
+            old = blocks.pop(name, None)
+            if old is None or rec["full"]:
+                tiles = {}
+            else:
+                tiles = old["tiles"]
+            for slot in set(rec["tiles"]) | set(rec["removed"]):
+                merged = dict(tiles.get(slot, {}))
+                merged.update(rec["tiles"].get(slot, {}))
+                for key in rec["removed"].get(slot, ()):
+                    merged.pop(key, None)
+                tiles[slot] = merged
+            # Слоты удалённых слоёв не переживают запись (как и в потоке журнала)
+            tiles = {(face, i): t for (face, i), t in tiles.items() if i < len(rec["meta"][face]["layers"])}
+            blocks[name] = {"path": rec["path"], "size": rec["size"], "meta": rec["meta"], "tiles": tiles}
+        return collections.OrderedDict(
+            (name, (rec["path"], rec["size"], _layers_from_tiles(rec["size"], rec["meta"], rec["tiles"])))
+            for name, rec in blocks.items())
+
+    @staticmethod
+    def discard(folder):
+        for name in ("journal.bin", "snapshot.bin"):
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    # ---------- поток журнала ----------
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.FSYNC_S)
+            except queue.Empty:
+                self._sync()
+                continue
+            items = [item]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for i, item in enumerate(items):
+                kind = item[0]
+                if kind == "state":
+                    # Из подряд идущих состояний блока пишется только последнее
+                    later = items[i + 1] if i + 1 < len(items) else None
+                    if later is not None and later[0] == "state" and later[1] == item[1]:
+                        continue
+                    self._write_state(*item[1:])
+                elif kind == "forget":
+                    self._prev.pop(item[1], None)
+                    self._seq += 1
+                    self._append({"seq": self._seq, "kind": "forget", "block": item[1]})
+                elif kind == "task":
+                    _, func, args, on_done = item
+                    try:
+                        result = func(*args)
+                    except Exception as e:
+                        traceback.print_exc()
+                        result = e
+                    self._results.put((on_done, result))
+                elif kind == "close":
+                    self._file.close()
+                    if item[1]:
+                        Journal.discard(self.folder)
+                    if self._lock is not None:
+                        self._lock.close()
+                    return
+            if time.monotonic() - self._last_sync >= self.FSYNC_S:
+                self._sync()
+
+    @traced("journal")
+    def _write_state(self, block, path, state):
+        tiles, meta = _state_tiles(state)
+        size = next(iter(state.values())).size
+        prev = self._prev.get(block)
+        full = prev is None or prev[1] != size
+        changed, removed = {}, {}
+        for slot, cur in tiles.items():
+            old = {} if full else prev[2].get(slot, {})
+            diff = {key: tile for key, tile in cur.items() if old.get(key) is not tile}
+            gone = [key for key in old if key not in cur]
+            if diff:
+                changed[slot] = diff
+            if gone:
+                removed[slot] = gone
+        if not full and not changed and not removed and prev[3] == meta and prev[0] == path:
+            return
+        self._prev[block] = (path, size, tiles, meta)
+        self._seq += 1
+        self._append({"seq": self._seq, "kind": "state", "block": block, "path": path, "size": size,
+                      "meta": meta, "full": full, "tiles": changed, "removed": removed})
+        if self._records >= self.COMPACT_RECORDS:
+            self._compact()
+
+    def _append(self, record):
+        body = zlib.compress(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        self._file.write(_RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body)
+        self._file.flush()  # в буфер ОС: переживает падение программы
+        self._records += 1
+        self._unsynced = True
+
+    @traced("journal")
+    def _compact(self):
+        """Снимок всех блоков вместо накопленного журнала"""
+        blocks = {name: {"path": path, "size": size, "meta": meta,
+                         "tiles": {slot: dict(t) for slot, t in tiles.items()}}
+                  for name, (path, size, tiles, meta) in self._prev.items()}
+        body = zlib.compress(pickle.dumps({"seq": self._seq, "blocks": blocks},
+                                          protocol=pickle.HIGHEST_PROTOCOL), 1)
+        tmp = self._snapshot_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._snapshot_path)
+        self._file.close()
+        self._file = open(self._journal_path, "wb")
+        self._records = 0
+        self._unsynced = False
+
+    def _sync(self):
+        self._last_sync = time.monotonic()
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+
+
+# =============================================
+#  ЖУРНАЛ ОПЕРАЦИЙ (ЗАПИСЬ И ВОСПРОИЗВЕДЕНИЕ)
+# =============================================
+
+# Настройки редактора, от которых зависит результат правок: в журнал пишутся при изменении
+OP_SETTINGS = ("current_face", "current_tool", "current_color", "secondary_color", "paint_alpha",
+               "symmetry", "brush_size", "brush_shape", "brush_antialias", "line_width",
+               "link_all_faces", "link_sides", "resample_mode")
+
+# Горячие пути, время которых отчёт воспроизведения показывает отдельно
+OP_HOT_PATHS = ("set_pixel", "plot_texels", "flood_fill", "save_state", "_face_to_pil")
+
+
+def recorded(method=None, *, seeded=False):
+    """
+    Метод-правка редактора: при включённой записи вызов (имя и аргументы)
+    попадает в журнал операций. Вложенные правки не пишутся — при
+    воспроизведении их повторит внешний вызов. seeded — правка случайная:
+    генераторы засеваются зерном, которое пишется в журнал перед ней.
+    """
+    if method is None:
+        return functools.partial(recorded, seeded=seeded)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        log = self.op_log
+        if log is None or log.busy:
+            return method(self, *args, **kwargs)
+        log.busy = True
+        try:
+            log.record(self, method.__name__, args, kwargs, seeded)
+            result = method(self, *args, **kwargs)
+            log.done(self)
+            return result
+        finally:
+            log.busy = False
+
+    wrapper.recorded = True
+    return wrapper
+
+
+def _json_default(obj):
+    # Скаляры и массивы NumPy в аргументах правок
+    return obj.tolist()
+
+
+def face_checksum(pix):
+    """Контрольная сумма пикселей грани (не зависит от того, как грань разбита на тайлы)"""
+    return hashlib.blake2b(pix.read().tobytes(), digest_size=8).hexdigest()
+
+
+class OpLog:
+    """
+    Журнал операций: каждая правка — строка JSON [имя, аргументы] или
+    [имя, аргументы, именованные]. Служебные команды:
+      ["set", {настройка: значение}] — изменившиеся OP_SETTINGS;
+      ["seed", n] — зерно генераторов для следующей случайной правки;
+      ["load", проект] — содержимое блока пришло извне (файл, другой блок);
+      ["check", {грань: сумма}] — контрольные суммы сведённых граней,
+      каждые CHECK_EVERY правок и в конце записи.
+    Журнал воспроизводится без Tk (replay_op_log) — записанные сессии
+    служат детерминированными тестами и бенчмарками.
+    """
+
+    FORMAT = "mc-texture-oplog"
+    VERSION = 1
+    CHECK_EVERY = 50
+
+    def __init__(self, path, editor):
+        self.path = path
+        self.busy = False
+        self.count = 0
+        self._settings = {}
+        self._file = open(path, "w", encoding="utf-8")
+        self._write({"format": self.FORMAT, "version": self.VERSION})
+        self.load(editor)
+
+    def _write(self, op):
+        self._file.write(json.dumps(op, ensure_ascii=False, separators=(",", ":"),
+                                    default=_json_default) + "\n")
+
+    def record(self, editor, name, args, kwargs, seeded):
+        """Перед правкой: изменившиеся настройки, зерно, сама команда"""
+        changed = {}
+        for key in OP_SETTINGS:
+            value = getattr(editor, key)
+            if key not in self._settings or self._settings[key] != value:
+                changed[key] = self._settings[key] = value
+        if changed:
+            self._write(["set", changed])
+        if seeded:
+            seed = random.getrandbits(32)
+            random.seed(seed)
+            np.random.seed(seed)
+            self._write(["seed", seed])
+        op = [name, list(args)]
+        if kwargs:
+            op.append(kwargs)
+        self._write(op)
+        self.count += 1
+
+    def done(self, editor):
+        """После правки: контрольные суммы каждые CHECK_EVERY правок"""
+        if self.count % self.CHECK_EVERY == 0:
+            self.check(editor)
+
+    def check(self, editor):
+        self._write(["check", {face: face_checksum(editor.composite(face)) for face in BLOCK_FACES}])
+
+    def load(self, editor):
+        self._write(["load", project_to_json(editor.texture_size, editor.layers)])
+
+    def close(self, editor):
+        self.check(editor)
+        self._file.close()
+
+    @staticmethod
+    def read(path):
+        """Команды журнала (без заголовка)"""
+        with open(path, "r", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if not isinstance(header, dict) or header.get("format") != OpLog.FORMAT:
+                raise ValueError(f"{path}: не журнал операций")
+            if header.get("version", 0) > OpLog.VERSION:
+                raise ValueError(f"{path}: журнал более новой версии ({header['version']})")
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def replay_op_log(ops, render=True, app=None):
+    """
+    Воспроизвести команды журнала (OpLog.read) на редакторе без интерфейса
+    (app — уже созданный редактор без интерфейса, иначе создаётся новый).
+    render — после каждой правки сводить текущую грань в картинку
+    (_face_to_pil), как это делает перерисовка в редакторе.
+    История после команды "load" начинается заново: отмена за точку
+    загрузки повторяет не историю живой сессии, а только журнал.
+    Возвращает отчёт: число правок, время, правок в секунду, время по видам
+    правок и в горячих путях (OP_HOT_PATHS), несовпавшие контрольные суммы.
+    """
+    if app is None:
+        app = MinecraftBlockTexturePainter(None)
+    hot = {name: [0, 0.0] for name in OP_HOT_PATHS}
+
+    def timed(name, func):
+        def call(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hot[name][0] += 1
+                hot[name][1] += time.perf_counter() - t0
+        return call
+
+    # Метод экземпляра перекрывает метод класса — внутренние вызовы тоже замеряются
+    for name in OP_HOT_PATHS:
+        setattr(app, name, timed(name, getattr(app, name)))
+
+    per_op = {}
+    mismatches = []
+    count = 0
+    start = time.perf_counter()
+    for index, op in enumerate(ops):
+        kind = op[0]
+        if kind == "set":
+            for key, value in op[1].items():
+                if key not in OP_SETTINGS:
+                    raise ValueError(f"Команда {index}: неизвестная настройка {key!r}")
+                setattr(app, key, value)
+        elif kind == "seed":
+            random.seed(op[1])
+            np.random.seed(op[1])
+        elif kind == "load":
+            app.texture_size, layers = project_from_json(op[1])
+            app.layers.update(layers)
+            app.share_identical_faces()
+            app.save_state()
+        elif kind == "check":
+            for face, expected in op[1].items():
+                if face_checksum(app.composite(face)) != expected:
+                    mismatches.append((index, face))
+        else:
+            method = getattr(type(app), kind, None)
+            if not getattr(method, "recorded", False):
+                raise ValueError(f"Команда {index}: {kind!r} — не правка редактора")
+            t0 = time.perf_counter()
+            getattr(app, kind)(*op[1], **(op[2] if len(op) > 2 else {}))
+            if render:
+                app._face_to_pil(app.current_face)
+            stat = per_op.setdefault(kind, [0, 0.0])
+            stat[0] += 1
+            stat[1] += time.perf_counter() - t0
+            count += 1
+    elapsed = time.perf_counter() - start
+    return {
+        "ops": count,
+        "seconds": elapsed,
+        "ops_per_sec": count / elapsed if elapsed > 0 else 0.0,
+        "per_op": {k: {"count": n, "seconds": s} for k, (n, s) in sorted(per_op.items())},
+        "hot_paths": {k: {"calls": n, "seconds": s} for k, (n, s) in hot.items()},
+        "mismatches": mismatches,
+        "final": {face: face_checksum(app.composite(face)) for face in BLOCK_FACES},
+    }
+
+
+def format_replay_report(report):
+    """Отчёт replay_op_log в виде текста для консоли"""
+    lines = [f"Правок: {report['ops']}, {report['seconds']:.3f} с, {report['ops_per_sec']:.1f} правок/с"]
+    for name, stat in report["per_op"].items():
+        lines.append(f"  {name:<20} {stat['count']:>6} × {1000 * stat['seconds'] / stat['count']:8.3f} мс")
+    lines.append("Горячие пути:")
+    for name, stat in report["hot_paths"].items():
+        lines.append(f"  {name:<20} {stat['calls']:>6} вызовов, {1000 * stat['seconds']:9.1f} мс")
+    if report["mismatches"]:
+        lines.append(f"Несовпадений контрольных сумм: {len(report['mismatches'])} "
+                     f"(первое — команда {report['mismatches'][0][0]})")
+    else:
+        lines.append("Контрольные суммы совпали")
+    return "\n".join(lines)
+
+
+# =============================================
+#  РЕСЕМПЛИНГ И МИПМАПЫ
+# =============================================
+
+RESAMPLE_MODES = {
+    "crop": "Обрезка / дополнение",
+    "nearest": "Ближайший сосед",
+    "box": "Усреднение (box)",
+    "bilinear": "Билинейный",
+    "lanczos": "Lanczos-3",
+    "epx": "Scale2x / EPX (пиксель-арт)",
+}
+
+_FILTER_RADIUS = {"box": 0.5, "bilinear": 1.0, "lanczos": 3.0}
+
+
+def _filter_kernel(mode, t):
+    if mode == "box":
+        return ((t >= -0.5) & (t < 0.5)).astype(np.float32)
+    if mode == "bilinear":
+        return np.maximum(0.0, 1.0 - np.abs(t)).astype(np.float32)
+    return np.where(np.abs(t) < 3.0, np.sinc(t) * np.sinc(t / 3.0), 0.0).astype(np.float32)
+
+
+def _filter_taps(src, dst, mode):
+    """
+    Индексы и веса отсчётов одномерного фильтра (dst × K). При уменьшении
+    ядро растягивается на 1/масштаб. Края заворачиваются: текстуры блоков тайлятся.
+    """
+    scale = dst / src
+    stretch = max(1.0, 1.0 / scale)
+    radius = _FILTER_RADIUS[mode] * stretch
+    centers = (np.arange(dst) + 0.5) / scale - 0.5
+    reach = int(math.ceil(radius))
+    idx = np.floor(centers).astype(np.int64)[:, None] + np.arange(-reach, reach + 2)[None, :]
+    w = _filter_kernel(mode, (idx - centers[:, None]) / stretch)
+    total = w.sum(axis=1, keepdims=True)
+    w /= np.where(total == 0, 1, total)
+    return idx % src, w
+
+
+def _filter_axis(data, taps, axis):
+    """Свёртка стопки граней (F, H, W, C) вдоль оси 1 или 2 — один проход на отсчёт"""
+    idx, w = taps
+    shape = [1] * data.ndim
+    shape[axis] = w.shape[0]
+    out = None
+    for k in range(w.shape[1]):
+        part = np.take(data, idx[:, k], axis=axis) * w[:, k].reshape(shape)
+        out = part if out is None else out + part
+    return out
+
+
+def _scale2x(stack):
+    """Один шаг Scale2x (EPX) для стопки граней (F, S, S, 4), края заворачиваются"""
+    packed = stack.view(np.uint32)[..., 0]
+    p = packed
+    a = np.roll(p, 1, axis=1)    # сверху
+    d = np.roll(p, -1, axis=1)   # снизу
+    c = np.roll(p, 1, axis=2)    # слева
+    b = np.roll(p, -1, axis=2)   # справа
+    f, h, w = p.shape
+    out = np.empty((f, h * 2, w * 2), dtype=np.uint32)
+    out[:, 0::2, 0::2] = np.where((c == a) & (c != d) & (a != b), a, p)
+    out[:, 0::2, 1::2] = np.where((a == b) & (a != c) & (b != d), b, p)
+    out[:, 1::2, 0::2] = np.where((d == c) & (d != b) & (c != a), c, p)
+    out[:, 1::2, 1::2] = np.where((b == d) & (b != a) & (d != c), d, p)
+    return out[..., None].view(np.uint8).reshape(f, h * 2, w * 2, 4)
+
+
+def resample_faces(stack, new_size, mode):
+    """
+    Изменить размер всех граней сразу. stack — (F, S, S, 4) uint8, результат —
+    (F, new_size, new_size, 4). Фильтры считаются в premultiplied alpha, чтобы
+    прозрачные пиксели не давали тёмной каймы.
+    """
+    f, src = stack.shape[:2]
+    if new_size == src:
+        return stack.copy()
+    if mode == "crop":
+        out = np.zeros((f, new_size, new_size, 4), dtype=np.uint8)
+        keep = min(src, new_size)
+        out[:, :keep, :keep] = stack[:, :keep, :keep]
+        return out
+    if mode == "epx":
+        # Удваиваем, пока не дорастём до нужного размера, остаток — ближайшим соседом
+        while stack.shape[1] < new_size:
+            stack = _scale2x(np.ascontiguousarray(stack))
+        mode, src = "nearest", stack.shape[1]
+        if src == new_size:
+            return stack
+    if mode == "nearest":
+        idx = ((np.arange(new_size) + 0.5) * src / new_size).astype(np.int64)
+        return stack[:, idx][:, :, idx]
+
+    taps = _filter_taps(src, new_size, mode)
+    data = stack.astype(np.float32) / 255.0
+    data[..., :3] *= data[..., 3:]
+    data = _filter_axis(_filter_axis(data, taps, 1), taps, 2)
+    alpha = np.clip(data[..., 3:], 0.0, 1.0)
+    rgb = np.where(alpha > 0, data[..., :3] / np.maximum(alpha, 1e-6), 0.0)
+    out = np.empty(data.shape, dtype=np.uint8)
+    out[..., :3] = np.clip(rgb * 255.0 + 0.5, 0, 255)
+    out[..., 3] = np.clip(alpha[..., 0] * 255.0 + 0.5, 0, 255)
+    return out
+
+
+def mip_chain(arr, levels=4):
+    """
+    Мип-уровни как в игре: каждый следующий вдвое меньше, 2×2 пикселя
+    усредняются в линейном свете (гамма 2.2) с весом по прозрачности.
+    Цепочка обрывается на нечётном размере. arr — (S, S, 4) uint8.
+    """
+    chain = [arr]
+    cur = arr
+    while len(chain) <= levels and cur.shape[0] > 1 and cur.shape[0] % 2 == 0:
+        data = cur.astype(np.float32) / 255.0
+        alpha = data[..., 3:]
+        lin = data[..., :3] ** 2.2 * alpha
+        h = cur.shape[0] // 2
+        lin = lin.reshape(h, 2, h, 2, 3).mean(axis=(1, 3))
+        alpha = alpha.reshape(h, 2, h, 2, 1).mean(axis=(1, 3))
+        rgb = np.where(alpha > 0, lin / np.maximum(alpha, 1e-6), 0.0) ** (1 / 2.2)
+        nxt = np.empty((h, h, 4), dtype=np.uint8)
+        nxt[..., :3] = np.clip(rgb * 255.0 + 0.5, 0, 255)
+        nxt[..., 3] = np.clip(alpha[..., 0] * 255.0 + 0.5, 0, 255)
+        chain.append(nxt)
+        cur = nxt
+    return chain
+
+
+# =============================================
+#  РАСТЕРИЗАТОР СЦЕНЫ (NumPy, z-буфер)
+# =============================================
+
+# Направленное затенение граней как в игре: верх светлее, низ темнее,
+# север/юг (front/back) ярче, чем запад/восток (left/right)
+MC_FACE_SHADE = {"top": 1.0, "bottom": 0.5, "front": 0.8, "back": 0.8, "left": 0.6, "right": 0.6}
+
+# Грань единичного блока: (нормаль, левый верхний угол, ось U, ось V).
+# Мир: x — восток (right), y — вверх, z — юг (front)
+_FACE_GEOMETRY = {
+    "front": ((0, 0, 1), (0, 1, 1), (1, 0, 0), (0, -1, 0)),
+    "back": ((0, 0, -1), (1, 1, 0), (-1, 0, 0), (0, -1, 0)),
+    "right": ((1, 0, 0), (1, 1, 1), (0, 0, -1), (0, -1, 0)),
+    "left": ((-1, 0, 0), (0, 1, 0), (0, 0, 1), (0, -1, 0)),
+    "top": ((0, 1, 0), (0, 1, 0), (1, 0, 0), (0, 0, 1)),
+    "bottom": ((0, -1, 0), (0, 0, 1), (1, 0, 0), (0, 0, -1)),
+}
+
+
+def _scene_rotation(yaw, pitch):
+    """Матрица поворота мира: сначала рыскание вокруг Y, затем наклон вокруг X"""
+    cy, sy = math.cos(yaw), math.sin(yaw)
+    cp, sp = math.cos(pitch), math.sin(pitch)
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rx = np.array([[1, 0, 0], [0, cp, -sp], [0, sp, cp]])
+    # Переход в координаты камеры: Y вниз, глубина растёт от наблюдателя
+    flip = np.array([[1, 0, 0], [0, -1, 0], [0, 0, -1]])
+    return flip @ rx @ ry
+
+
+def render_block_scene(textures, dims, yaw, pitch, width, height, perspective=True,
+                       background=(17, 17, 34)):
+    """
+    Отрисовать параллелепипед из dims = (nx, ny, nz) одинаковых блоков.
+
+    textures — {грань: массив RGBA (h, w, 4) uint8}. Внешняя поверхность
+    сплошного параллелепипеда — это 6 больших прямоугольников с повторяющейся
+    текстурой, поэтому растеризуется не более 6 четырёхугольников независимо
+    от числа блоков. Возвращает массив RGB (height, width, 3) uint8.
+    """
+    dims = np.array(dims, dtype=np.float64)
+    rot = _scene_rotation(yaw, pitch)
+    center = dims / 2.0
+    radius = float(np.linalg.norm(dims)) / 2.0
+    dist = radius * 3.0
+
+    def to_cam(p):
+        c = rot @ (np.asarray(p, dtype=np.float64) - center)
+        if perspective:
+            c[2] += dist
+        return c
+
+    # Подгонка масштаба: проецируем 8 углов с единичным масштабом
+    corners = np.array([to_cam(dims * np.array([i, j, k]))
+                        for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+    if perspective:
+        proj = corners[:, :2] / corners[:, 2:3]
+    else:
+        proj = corners[:, :2]
+    lo, hi = proj.min(axis=0), proj.max(axis=0)
+    span = np.maximum(hi - lo, 1e-6)
+    k = 0.9 * min(width / span[0], height / span[1])
+    ox = width / 2.0 - k * (lo[0] + hi[0]) / 2.0
+    oy = height / 2.0 - k * (lo[1] + hi[1]) / 2.0
+
+    out = np.empty((height, width, 3), dtype=np.uint8)
+    out[:] = background
+    zbuf = np.full((height, width), np.inf, dtype=np.float32)
+
+    for face, (normal, origin, u_axis, v_axis) in _FACE_GEOMETRY.items():
+        tex = textures.get(face)
+        if tex is None:
+            continue
+        n_cam = rot @ np.array(normal, dtype=np.float64)
+        o_cam = to_cam(dims * np.array(origin))
+        u_world = np.array(u_axis) * dims
+        v_world = np.array(v_axis) * dims
+        u_cam, v_cam = rot @ u_world, rot @ v_world
+        # Отсечение задних граней
+        eye_dir = -o_cam if perspective else np.array([0.0, 0.0, -1.0])
+        if n_cam @ eye_dir <= 0:
+            continue
+
+        # Ограничивающий прямоугольник на экране
+        quad = np.array([o_cam, o_cam + u_cam, o_cam + u_cam + v_cam, o_cam + v_cam])
+        qp = quad[:, :2] / quad[:, 2:3] if perspective else quad[:, :2]
+        sx0 = max(0, int(math.floor((qp[:, 0] * k + ox).min())))
+        sx1 = min(width, int(math.ceil((qp[:, 0] * k + ox).max())) + 1)
+        sy0 = max(0, int(math.floor((qp[:, 1] * k + oy).min())))
+        sy1 = min(height, int(math.ceil((qp[:, 1] * k + oy).max())) + 1)
+        if sx0 >= sx1 or sy0 >= sy1:
+            continue
+
+        a = ((np.arange(sx0, sx1, dtype=np.float32) + 0.5 - ox) / k)[None, :]
+        b = ((np.arange(sy0, sy1, dtype=np.float32) + 0.5 - oy) / k)[:, None]
+
+        # Пересечение лучей с плоскостью грани: O + u*U + v*V
+        n = np.cross(u_cam, v_cam)
+        if perspective:
+            denom = n[0] * a + n[1] * b + n[2]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                t = (n @ o_cam) / denom
+            hx, hy, hz = t * a - o_cam[0], t * b - o_cam[1], t - o_cam[2]
+        else:
+            t = ((n @ o_cam) - n[0] * a - n[1] * b) / n[2]
+            hx, hy, hz = a - o_cam[0], b - o_cam[1], t - o_cam[2]
+        vn = np.cross(v_cam, n)
+        nu = np.cross(n, u_cam)
+        u = (hx * vn[0] + hy * vn[1] + hz * vn[2]) / (u_cam @ vn)
+        v = (hx * nu[0] + hy * nu[1] + hz * nu[2]) / (v_cam @ nu)
+
+        inside = (u >= 0) & (u < 1) & (v >= 0) & (v < 1)
+        if perspective:
+            inside &= t > 0
+        if not inside.any():
+            continue
+
+        # Повторение текстуры по количеству блоков вдоль осей
+        th, tw = tex.shape[:2]
+        rep_u = float(np.abs(u_world).sum())
+        rep_v = float(np.abs(v_world).sum())
+        tu = np.clip(((u * rep_u) % 1.0 * tw).astype(np.int32), 0, tw - 1)
+        tv = np.clip(((v * rep_v) % 1.0 * th).astype(np.int32), 0, th - 1)
+        texel = tex[tv, tu]
+
+        zsub = zbuf[sy0:sy1, sx0:sx1]
+        mask = inside & (texel[..., 3] > 0) & (t < zsub)
+        shade = MC_FACE_SHADE[face]
+        # Видимые грани выпуклого тела не перекрываются — полупрозрачный
+        # тексель смешивается прямо с фоном
+        a = texel[mask][:, 3:].astype(np.float32) / 255.0
+        rgb = texel[mask][:, :3].astype(np.float32) * shade
+        osub = out[sy0:sy1, sx0:sx1]
+        osub[mask] = (rgb * a + osub[mask] * (1 - a) + 0.5).astype(np.uint8)
+        zsub[mask] = t[mask]
+
+    return out
+
+
+# =============================================
+#  ФОНОВЫЙ РЕНДЕР ПРЕВЬЮ
+# =============================================
+
+_checker_cache = {}
+
+
+def checker_image(w, h, cell=8):
+    """Шахматный фон прозрачности w×h (кэшируется по размеру)"""
+    key = (w, h, cell)
+    img = _checker_cache.get(key)
+    if img is None:
+        if len(_checker_cache) > 8:
+            _checker_cache.clear()
+        yy, xx = np.mgrid[0:h, 0:w]
+        light = ((xx // cell + yy // cell) % 2 == 0)
+        arr = np.where(light[..., None], np.uint8(0xc0), np.uint8(0x90)).repeat(3, axis=2)
+        img = Image.fromarray(arr, "RGB").convert("RGBA")
+        _checker_cache[key] = img
+    return img
+
+
+class PreviewSnapshot:
+    """
+    Неизменяемый снимок граней для потока рендера. Главный поток только
+    делает копии граней с общими тайлами; PIL-картинки строятся лениво уже в потоке.
+    """
+
+    def __init__(self, size, faces):
+        self.size = size
+        self.faces = faces
+        self._images = {}
+
+    def image(self, face):
+        img = self._images.get(face)
+        if img is None:
+            img = self.faces[face].to_image()
+            self._images[face] = img
+        return img
+
+
+class PreviewWorker:
+    """
+    Поток рендера превью с правилом «побеждает последний»: для каждого ключа
+    ("3d", "tile", ...) ожидающий запрос заменяется новым, а результат,
+    устаревший за время рендера, отбрасывается. Tk трогает только главный
+    поток — он забирает готовые картинки через poll() из root.after.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._latest = {}
+        self._running = False
+        self._results = queue.Queue()
+        threading.Thread(target=self._run, name="preview-worker", daemon=True).start()
+
+    def submit(self, key, func, args, on_done):
+        with self._cond:
+            gen = self._latest.get(key, 0) + 1
+            self._latest[key] = gen
+            self._pending[key] = (gen, func, args, on_done)
+            self._cond.notify()
+
+    def is_idle(self):
+        with self._cond:
+            return not self._pending and not self._running and self._results.empty()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key = next(iter(self._pending))
+                gen, func, args, on_done = self._pending.pop(key)
+                self._running = True
+            try:
+                result = func(*args)
+            except Exception:
+                traceback.print_exc()
+                result = None
+            with self._cond:
+                self._running = False
+                stale = self._latest[key] != gen
+            if result is not None and not stale:
+                self._results.put((key, gen, result, on_done))
+
+    def poll(self):
+        """Только из главного потока: выдать свежие результаты обработчикам"""
+        while True:
+            try:
+                key, gen, result, on_done = self._results.get_nowait()
+            except queue.Empty:
+                return
+            with self._cond:
+                stale = self._latest[key] != gen
+            if not stale:
+                on_done(result)
+
+
+# =============================================
+#  HUD ЗАДЕРЖЕК
+# =============================================
+
+class LatencyStats:
+    """
+    Замеры для HUD задержек: задержка от события ввода до показа на экране,
+    кадры штриха (и пропущенные — главный поток не успел к сроку), время
+    последней отрисовки каждого вида в мс. Время рендера превью пишет
+    поток превью; одиночное присваивание в словарь потокобезопасно.
+    """
+
+    def __init__(self):
+        self.views = {}
+        self.input_ms = None
+        self.input_max_ms = None  # за текущий штрих
+        self.frames = 0
+        self.dropped = 0
+
+    def view(self, name, seconds):
+        self.views[name] = seconds * 1000
+
+    def stroke_started(self):
+        self.frames = self.dropped = 0
+        self.input_max_ms = None
+
+    def frame(self, late_s, frame_s):
+        """Кадр штриха применён на late_s позже срока; целые периоды опоздания — пропущенные кадры"""
+        self.frames += 1
+        self.dropped += max(0, int(late_s / frame_s))
+
+    def displayed(self, input_t, now):
+        ms = (now - input_t) * 1000
+        self.input_ms = ms
+        self.input_max_ms = ms if self.input_max_ms is None else max(self.input_max_ms, ms)
+
+
+# =============================================
+#  ЗАМЕР ЗАПУСКА
+# =============================================
+
+def photo_image(*args):
+    """ImageTk.PhotoImage; PIL.ImageTk подгружается при первой картинке, а не при импорте модуля"""
+    from PIL import ImageTk
+    return ImageTk.PhotoImage(*args)
+
+
+class StartupTimer:
+    """
+    Этапы запуска редактора: каждый длится от конца предыдущего до mark().
+    Время до готовности к вводу — конец этапа «первый кадр»: холст
+    нарисован, цикл событий принимает ввод; вторичные панели, превью и
+    журнал достраиваются после него. При включённой трассировке этапы
+    пишутся и в неё (категория "startup").
+    """
+
+    def __init__(self, origin=START_TIME):
+        self.origin = origin
+        self._last = origin
+        self.phases = []  # (имя, начало, длительность) в секундах от origin
+        self.interactive = None  # секунд до готовности к вводу
+        self.done = False
+        self.on_done = None  # вызывается один раз, когда запуск завершён
+
+    def mark(self, name, interactive=False):
+        now = time.perf_counter()
+        self.phases.append((name, self._last - self.origin, now - self._last))
+        if TRACER.enabled:
+            TRACER.add(name, "startup", int(self._last * 1e9), int((now - self._last) * 1e9))
+        self._last = now
+        if interactive:
+            self.interactive = now - self.origin
+
+    def finish(self):
+        self.done = True
+        if self.on_done is not None:
+            self.on_done()
+
+    def report(self):
+        return {
+            "time_to_interactive_ms": None if self.interactive is None else self.interactive * 1000,
+            "total_ms": (self._last - self.origin) * 1000,
+            "phases": [{"name": name, "start_ms": start * 1000, "ms": dur * 1000}
+                       for name, start, dur in self.phases],
+        }
+
+    def format(self):
+        lines = [f"{name:<24} {dur * 1000:8.1f} мс  (с {start * 1000:.1f})" for name, start, dur in self.phases]
+        if self.interactive is not None:
+            lines.append(f"{'готов к вводу через':<24} {self.interactive * 1000:8.1f} мс")
+        lines.append(f"{'всего':<24} {(self._last - self.origin) * 1000:8.1f} мс")
+        return "\n".join(lines)
 
 
 class MinecraftBlockTexturePainter:
     """Редактор текстур Minecraft с поддержкой всех 6 граней блока"""
 
-    FACE_NAMES = ["top", "bottom", "front", "back", "left", "right"]
+    FACE_NAMES = list(BLOCK_FACES)
     FACE_LABELS = {
         "top": "⬆ Верх (Top)",
         "bottom": "⬇ Низ (Bottom)",
@@ -21,33 +2457,87 @@ class MinecraftBlockTexturePainter:
         "right": "▶ Право (Right)"
     }
 
+    # Пауза ввода (мс), после которой грубые превью перерисовываются в полном качестве
+    PREVIEW_REFINE_MS = 150
+
+    # Пределы масштаба холста (экранных пикселей на тексель)
+    ZOOM_MIN = 0.25
+    ZOOM_MAX = 64
+
+    # Журнал восстановления после сбоя и период опроса фоновых задач (мс)
+    JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".mc_texture_painter", "journal")
+    JOURNAL_POLL_MS = 100
+
+    # Инструменты-штрихи: события движения копятся и применяются раз в кадр
+    STROKE_TOOLS = ("pencil", "eraser", "brush", "dither", "blur")
+    STROKE_FRAME_MS = 16
+
+    # Период обновления HUD задержек (мс) и подписи видов
+    HUD_REFRESH_MS = 250
+    HUD_VIEWS = {"canvas": "холст", "minis": "мини", "3d": "3D", "tile": "тайл"}
+
+    # Примерная высота панели мини-превью до её построения — чтобы холст не менял размер
+    MINIS_PANEL_HEIGHT = 250
+
+    # Подсистемы отчёта о памяти (см. memory_report)
+    MEMORY_LABELS = {
+        "faces": "Грани (все слои)",
+        "history": "История",
+        "clipboard": "Буфер обмена",
+        "photos": "Картинки Tk",
+        "caches": "Кэши",
+        "other_blocks": "Другие блоки",
+        "total": "Всего",
+    }
+
     def __init__(self, root):
+        """root=None — редактор без интерфейса (воспроизведение журнала операций, тесты)"""
         self.root = root
-        self.root.title("Minecraft Block Texture Painter — Java Edition")
-        self.root.geometry("1500x900")
-        self.root.configure(bg="#1e1e2e")
-        self.root.minsize(1200, 700)
+        self.startup = StartupTimer()
+        if root is not None:
+            self.startup.mark("импорт и окно Tk")
+            self.root.title("Minecraft Block Texture Painter — Java Edition")
+            self.root.geometry("1500x900")
+            self.root.configure(bg="#1e1e2e")
+            self.root.minsize(1200, 700)
 
         # --- Настройки ---
         self.texture_size = 16
-        self.pixel_size = 22
+        self.pixel_size = 22  # масштаб холста, может быть дробным и меньше 1
+        self.pan_x = 0.0  # положение левого верхнего угла текстуры на холсте
+        self.pan_y = 0.0
+        self._view_centered = False
+        self._pan_start = None
         self.current_color = "#b5503c"
         self.secondary_color = "#8e8e86"
         self.current_tool = "pencil"
         self.grid_visible = True
-        self.symmetry_x = False
-        self.symmetry_y = False
+        self.symmetry = "none"  # см. SYMMETRY_MODES
         self.current_face = "front"
-
-        # --- Данные текстур для каждой грани ---
-        self.faces = {}
-        for face in self.FACE_NAMES:
-            self.faces[face] = {}
-            for x in range(self.texture_size):
-                for y in range(self.texture_size):
-                    self.faces[face][(x, y)] = None
+        self.resample_mode = "nearest"  # см. RESAMPLE_MODES
+
+        # --- Данные текстур: стек слоёв на каждую грань ---
+        self.layers = {face: LayerStack(self.texture_size) for face in self.FACE_NAMES}
+        self.faces = ActiveLayers(self.layers)  # пиксели активного слоя каждой грани
+        self.layers_window = None
+
+        # --- Рабочая область: открытые блоки; слои текущего — в редакторе ---
+        self.workspace = Workspace()
+        self.block_name = self.workspace.add_block("Блок 1", self.texture_size, self.layers).name
+        self.workspace.blocks[self.block_name].opened_sig = BlockEntry.signature(self.layers)
+        self.workspace_window = None
+        self.journal = None  # заводится в конце __init__, после возможного восстановления
+        self._journal_poll_job = None
+        self.op_log = None  # запись журнала операций (OpLog), см. toggle_op_log
+        self.trace_window = None
 
         # --- Режим: одинаковые все грани ---
+        self.brush_size = 3
+        self.brush_shape = "square"  # см. BRUSH_SHAPES
+        self.brush_antialias = False  # сглаженный край по покрытию штампа
+        self.line_width = 1  # толщина линий и контуров фигур
+        self.paint_alpha = 255  # непрозрачность рисования 0..255
+        self._custom_stamp = (None, None)  # (поколение буфера, штамп)
         self.link_all_faces = False
         self.link_sides = False  # Связать 4 боковые грани
 
@@ -64,6 +2554,41 @@ class MinecraftBlockTexturePainter:
         # --- Drag для фигур ---
         self.drag_start = None
 
+        # --- Очередь преобразований: подряд идущие сливаются в один проход ---
+        self._transform_queue = []
+        self._transform_job = None
+
+        # --- Штрих: последний закрашенный тексель и ещё не применённые точки ---
+        self._stroke_last = None
+        self._stroke_points = []
+        self._stroke_job = None
+        self._stroke_cov = None  # покрытие текущего штриха (texture_size²), None вне штриха
+        self._stroke_base = {}  # грани на момент начала штриха
+        self._stroke_input_t = None  # время первого ещё не показанного события штриха
+        self._stroke_due = None  # срок применения запланированного кадра штриха
+
+        # --- HUD задержек: замеры идут всегда, показ — по меню «Вид» ---
+        self.latency = LatencyStats()
+        self.hud_visible = False
+        self._hud_job = None
+        self._hud_history = (None, {}, 0)  # (ключ истории, {id тайла: байты}, всего байт) — см. hud_text
+
+        # --- Окно превью сцены (стена/пол из блоков) ---
+        self.scene_window = None
+
+        # --- Окно мип-уровней, кэш цепочек по поколению грани ---
+        self.mip_window = None
+        self._mip_cache = {}
+
+        # --- Прогрессивные превью: грубо во время ввода, полностью в паузе ---
+        self.interactive = False
+        self._refine_job = None
+
+        # --- Фоновый рендер превью ---
+        self.preview_worker = PreviewWorker()
+        self._preview_poll_job = None
+        self._snapshot = None
+
         # --- Палитра Minecraft ---
         self.mc_palette = [
             "#000000", "#ffffff", "#ff0000", "#00ff00", "#0000ff",
@@ -95,10 +2620,40 @@ class MinecraftBlockTexturePainter:
             "TNT": self.tpl_tnt,
         }
 
+        self.panels_ready = False  # превью и палитра строятся после первого кадра (finish_startup)
+
+        if root is None:
+            return
+        self.startup.mark("модель")
         self.build_ui()
         self.bind_shortcuts()
+        self.startup.mark("интерфейс")
         self.draw_face_canvas()
+        self.startup.mark("холст")
+        self.root.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+        """Первый кадр показан: достроить вторичные панели, превью и журнал восстановления"""
+        self.root.update_idletasks()
+        self.startup.mark("первый кадр", interactive=True)
+        self.build_3d_preview(self.preview_3d_frame)
+        self.build_all_faces_preview(self.minis_frame)
+        self.build_mc_palette()
+        self.panels_ready = True
+        self.startup.mark("панели")
+        self.update_mini_previews()
         self.update_3d_preview()
+        self.update_tile_preview()
+        self.start_journal()
+        self.startup.mark("журнал")
+        self._wait_startup_previews()
+
+    def _wait_startup_previews(self):
+        if not self.preview_worker.is_idle():
+            self.root.after(10, self._wait_startup_previews)
+            return
+        self.startup.mark("превью")
+        self.startup.finish()
 
     # =============================================
     #  ИНТЕРФЕЙС
@@ -123,10 +2678,15 @@ class MinecraftBlockTexturePainter:
 
         self.build_face_selector(top_center)
         self.build_canvas_area(top_center)
-        self.build_3d_preview(top_center)
+        # Превью строятся после первого кадра (finish_startup); здесь — только их места
+        self.preview_3d_frame = tk.Frame(top_center, bg="#1e1e2e", width=260)
+        self.preview_3d_frame.pack(side=tk.LEFT, fill=tk.Y, padx=8)
 
         # Нижняя часть центра — 6 мини-превью
-        self.build_all_faces_preview(center)
+        self.minis_frame = tk.LabelFrame(center, text="  Все грани блока  ", bg="#1e1e2e", fg="#aaa",
+                                         font=("Arial", 10, "bold"), relief=tk.GROOVE, bd=1,
+                                         height=self.MINIS_PANEL_HEIGHT)
+        self.minis_frame.pack(fill=tk.X, padx=8, pady=4)
 
         # Правая панель — цвета
         self.build_right_panel(main)
@@ -155,7 +2715,9 @@ class MinecraftBlockTexturePainter:
         fm.add_separator()
         fm.add_command(label="Экспорт ресурспака", command=self.export_resourcepack)
         fm.add_separator()
-        fm.add_command(label="Выход", command=self.root.quit)
+        fm.add_command(label="Запись журнала операций вкл/выкл...", command=self.toggle_op_log)
+        fm.add_separator()
+        fm.add_command(label="Выход", command=self.on_exit)
 
         # Редактирование
         em = tk.Menu(mb, tearoff=0)
@@ -195,19 +2757,31 @@ class MinecraftBlockTexturePainter:
         flm.add_command(label="Оттенки серого", command=self.grayscale_face)
         flm.add_command(label="Инвертировать цвета", command=self.invert_face)
         flm.add_command(label="Добавить шум", command=self.noise_face)
+        flm.add_separator()
+        for kind, label in CONV_FILTERS.items():
+            if kind in ("box_blur", "gaussian_blur"):
+                flm.add_command(label=label + "...", command=lambda k=kind: self.ask_filter(k))
+            else:
+                flm.add_command(label=label, command=lambda k=kind: self.apply_filter(k))
 
-        # Шаблоны
+        # Шаблоны — пункты добавляются при первом открытии меню
         tplm = tk.Menu(mb, tearoff=0)
+        tplm.configure(postcommand=lambda: self.fill_templates_menu(tplm))
         mb.add_cascade(label="Шаблоны", menu=tplm)
-        for name, func in self.templates.items():
-            tplm.add_command(label=name, command=func)
 
         # Размер
         sm = tk.Menu(mb, tearoff=0)
         mb.add_cascade(label="Размер", menu=sm)
-        for s in [16, 32, 64, 128]:
+        for s in [16, 32, 64, 128, 256, 512, 1024]:
             sm.add_command(label=f"{s}×{s}", command=lambda sz=s: self.resize_texture(sz))
         sm.add_command(label="Свой размер...", command=self.custom_resize)
+        sm.add_separator()
+        self.resample_var = tk.StringVar(value=self.resample_mode)
+        rsm = tk.Menu(sm, tearoff=0)
+        sm.add_cascade(label="Ресемплинг", menu=rsm)
+        for mode, label in RESAMPLE_MODES.items():
+            rsm.add_radiobutton(label=label, value=mode, variable=self.resample_var,
+                                command=lambda: setattr(self, "resample_mode", self.resample_var.get()))
 
         # Вид
         vm = tk.Menu(mb, tearoff=0)
@@ -215,6 +2789,53 @@ class MinecraftBlockTexturePainter:
         vm.add_command(label="Сетка вкл/выкл", command=self.toggle_grid, accelerator="G")
         vm.add_command(label="Увеличить", command=self.zoom_in, accelerator="+")
         vm.add_command(label="Уменьшить", command=self.zoom_out, accelerator="-")
+        vm.add_command(label="Вписать в окно", command=self.zoom_fit, accelerator="0")
+        vm.add_separator()
+        vm.add_command(label="Превью сцены (стена / пол)...", command=self.open_scene_preview)
+        vm.add_command(label="Мип-уровни...", command=self.open_mip_preview)
+        vm.add_separator()
+        self.hud_visible_var = tk.BooleanVar(value=self.hud_visible)
+        vm.add_checkbutton(label="HUD задержек", variable=self.hud_visible_var, command=self.toggle_hud)
+        vm.add_command(label="Память...", command=self.show_memory_report)
+        self.trace_var = tk.BooleanVar(value=TRACER.enabled)
+        prm = tk.Menu(vm, tearoff=0)
+        vm.add_cascade(label="Профилирование", menu=prm)
+        prm.add_checkbutton(label="Трассировка", variable=self.trace_var, command=self.toggle_tracing)
+        prm.add_command(label="Сводка (p50 / p95 / p99)...", command=self.open_trace_window)
+        prm.add_command(label="Экспорт Chrome trace (.json)...", command=self.export_chrome_trace)
+        prm.add_command(label="Очистить интервалы", command=self.clear_trace)
+        prm.add_command(label="Замер запуска...", command=self.show_startup_report)
+
+        # Слои
+        lm = tk.Menu(mb, tearoff=0)
+        mb.add_cascade(label="Слои", menu=lm)
+        lm.add_command(label="Новый слой", command=self.add_layer)
+        lm.add_command(label="Дублировать слой", command=self.duplicate_layer)
+        lm.add_command(label="Удалить слой", command=self.delete_layer)
+        lm.add_separator()
+        lm.add_command(label="Слой выше", command=lambda: self.move_layer(1))
+        lm.add_command(label="Слой ниже", command=lambda: self.move_layer(-1))
+        lm.add_command(label="Объединить с нижним", command=self.merge_layer_down)
+        lm.add_separator()
+        lm.add_command(label="Окно слоёв...", command=self.open_layers_window)
+
+        # Блоки (рабочая область)
+        bm = tk.Menu(mb, tearoff=0)
+        mb.add_cascade(label="Блоки", menu=bm)
+        bm.add_command(label="Новый блок в рабочей области", command=self.new_workspace_block)
+        bm.add_command(label="Открыть проекты в рабочую область...", command=self.open_projects_to_workspace)
+        bm.add_command(label="Следующий блок", command=self.next_block, accelerator="Ctrl+Tab")
+        bm.add_command(label="Закрыть блок", command=self.close_block)
+        bm.add_separator()
+        bm.add_command(label="Сохранить все блоки", command=self.save_all_blocks)
+        bm.add_command(label="Предел памяти...", command=self.ask_memory_limit)
+        bm.add_command(label="Окно рабочей области...", command=self.open_workspace_window)
+
+    def fill_templates_menu(self, menu):
+        if menu.index(tk.END) is not None:
+            return
+        for name, func in self.templates.items():
+            menu.add_command(label=name, command=func)
 
     # ---------- ИНСТРУМЕНТЫ ----------
 
@@ -239,8 +2860,7 @@ class MinecraftBlockTexturePainter:
             ("🌈  Градиент", "gradient"),
             ("💨  Размытие", "blur"),
             ("✨  Замена цвета", "replace"),
-            ("🖌️  Кисть 2px", "brush2"),
-            ("🖌️  Кисть 3px", "brush3"),
+            ("🖌️  Кисть", "brush"),
             ("🎨  Дизеринг", "dither"),
         ]
 
@@ -253,18 +2873,45 @@ class MinecraftBlockTexturePainter:
             self.tool_buttons[tool] = btn
         self.tool_buttons["pencil"].configure(bg="#0078d4")
 
+        # Кисть: размер, форма, сглаживание
+        row = tk.Frame(frame, bg="#2a2a3d")
+        row.pack(fill=tk.X, padx=8, pady=(6, 0))
+        tk.Label(row, text="Кисть:", bg="#2a2a3d", fg="#ccc", font=("Arial", 9)).pack(side=tk.LEFT)
+        self.brush_size_var = tk.IntVar(value=self.brush_size)
+        spin = tk.Spinbox(row, from_=1, to=64, width=3, textvariable=self.brush_size_var,
+                          command=self.on_brush_change)
+        spin.pack(side=tk.LEFT, padx=4)
+        spin.bind("<Return>", lambda e: self.on_brush_change())
+        spin.bind("<FocusOut>", lambda e: self.on_brush_change())
+        self.brush_shape_var = tk.StringVar(value=BRUSH_SHAPES[self.brush_shape])
+        shape_menu = tk.OptionMenu(row, self.brush_shape_var, *BRUSH_SHAPES.values(),
+                                   command=lambda _: self.on_brush_change())
+        shape_menu.configure(bg="#3b3b55", fg="#ddd", relief=tk.FLAT, highlightthickness=0, font=("Arial", 8))
+        shape_menu.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.brush_aa_var = tk.BooleanVar(value=self.brush_antialias)
+        tk.Checkbutton(frame, text="Сглаженный край", variable=self.brush_aa_var,
+                       bg="#2a2a3d", fg="#ccc", selectcolor="#3b3b55",
+                       command=self.on_brush_change).pack(anchor="w", padx=16)
+        row = tk.Frame(frame, bg="#2a2a3d")
+        row.pack(fill=tk.X, padx=8)
+        tk.Label(row, text="Толщина линий:", bg="#2a2a3d", fg="#ccc", font=("Arial", 9)).pack(side=tk.LEFT)
+        self.line_width_var = tk.IntVar(value=self.line_width)
+        spin = tk.Spinbox(row, from_=1, to=32, width=3, textvariable=self.line_width_var,
+                          command=self.on_brush_change)
+        spin.pack(side=tk.LEFT, padx=4)
+        spin.bind("<Return>", lambda e: self.on_brush_change())
+        spin.bind("<FocusOut>", lambda e: self.on_brush_change())
+
         ttk.Separator(frame, orient="horizontal").pack(fill=tk.X, padx=4, pady=8)
 
         # Симметрия
         tk.Label(frame, text="Симметрия:", bg="#2a2a3d", fg="#ccc", font=("Arial", 9)).pack(anchor="w", padx=8)
-        self.sym_x_var = tk.BooleanVar()
-        self.sym_y_var = tk.BooleanVar()
-        tk.Checkbutton(frame, text="X (гориз.)", variable=self.sym_x_var,
-                       bg="#2a2a3d", fg="#ccc", selectcolor="#3b3b55",
-                       command=lambda: setattr(self, 'symmetry_x', self.sym_x_var.get())).pack(anchor="w", padx=16)
-        tk.Checkbutton(frame, text="Y (верт.)", variable=self.sym_y_var,
-                       bg="#2a2a3d", fg="#ccc", selectcolor="#3b3b55",
-                       command=lambda: setattr(self, 'symmetry_y', self.sym_y_var.get())).pack(anchor="w", padx=16)
+        self.sym_var = tk.StringVar(value=SYMMETRY_MODES[self.symmetry])
+        sym_menu = tk.OptionMenu(frame, self.sym_var, *SYMMETRY_MODES.values(),
+                                 command=lambda label: setattr(self, 'symmetry', next(
+                                     k for k, v in SYMMETRY_MODES.items() if v == label)))
+        sym_menu.configure(bg="#3b3b55", fg="#ddd", relief=tk.FLAT, highlightthickness=0, font=("Arial", 8))
+        sym_menu.pack(fill=tk.X, padx=16)
 
         ttk.Separator(frame, orient="horizontal").pack(fill=tk.X, padx=4, pady=8)
 
@@ -285,10 +2932,10 @@ class MinecraftBlockTexturePainter:
 
         # Прозрачность
         tk.Label(frame, text="Прозрачность:", bg="#2a2a3d", fg="#ccc", font=("Arial", 9)).pack(anchor="w", padx=8)
-        self.alpha_var = tk.IntVar(value=255)
+        self.alpha_var = tk.IntVar(value=self.paint_alpha)
         tk.Scale(frame, from_=0, to=255, orient=tk.HORIZONTAL, variable=self.alpha_var,
                  bg="#2a2a3d", fg="#ccc", highlightthickness=0, troughcolor="#3b3b55",
-                 length=140).pack(padx=8)
+                 length=140, command=lambda v: setattr(self, 'paint_alpha', int(float(v)))).pack(padx=8)
 
     # ---------- ВЫБОР ГРАНИ ----------
 
@@ -338,23 +2985,45 @@ class MinecraftBlockTexturePainter:
         tk.Label(frame, textvariable=self.face_title_var, font=("Arial", 12, "bold"),
                  bg="#111122", fg="#7cacf8").pack(pady=4)
 
-        canvas_size = self.texture_size * self.pixel_size + 1
-        self.canvas = tk.Canvas(frame, bg="#111122", width=canvas_size, height=canvas_size,
+        # Окно просмотра: рисуется только видимая часть грани
+        view = tk.Frame(frame, bg="#111122")
+        view.pack(fill=tk.BOTH, expand=True, pady=4)
+        view.rowconfigure(0, weight=1)
+        view.columnconfigure(0, weight=1)
+
+        self.canvas = tk.Canvas(view, bg="#111122", width=500, height=500,
                                 cursor="crosshair", highlightthickness=0)
-        self.canvas.pack(expand=True, pady=4)
+        self.canvas.grid(row=0, column=0, sticky="nsew")
+        self.vscroll = tk.Scrollbar(view, orient=tk.VERTICAL, command=self.on_scroll_y)
+        self.vscroll.grid(row=0, column=1, sticky="ns")
+        self.hscroll = tk.Scrollbar(view, orient=tk.HORIZONTAL, command=self.on_scroll_x)
+        self.hscroll.grid(row=1, column=0, sticky="ew")
+
+        self.canvas_photo = None
+        self._patch_photo = None  # черновик для частичной перерисовки, растёт по самой большой заплатке
+        self._view_geom = None  # геометрия последней полной отрисовки (для частичной)
+        self._view_item = self.canvas.create_image(0, 0, anchor=tk.NW)
+        # Слой превью фигур поверх грани: при перетаскивании меняется только он
+        self.overlay_photo = None
+        self._overlay_item = self.canvas.create_image(0, 0, anchor=tk.NW, state=tk.HIDDEN)
 
         self.canvas.bind("<Button-1>", self.on_click)
         self.canvas.bind("<B1-Motion>", self.on_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_release)
         self.canvas.bind("<Button-3>", self.on_right_click)
         self.canvas.bind("<Motion>", self.on_move)
+        self.canvas.bind("<Configure>", self.on_canvas_resize)
+        # Панорама средней кнопкой, масштаб колесом вокруг курсора
+        self.canvas.bind("<Button-2>", self.on_pan_start)
+        self.canvas.bind("<B2-Motion>", self.on_pan_drag)
+        self.canvas.bind("<ButtonRelease-2>", self.on_pan_end)
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-4>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-5>", self.on_mouse_wheel)
 
     # ---------- 3D ПРЕВЬЮ ----------
 
-    def build_3d_preview(self, parent):
-        frame = tk.Frame(parent, bg="#1e1e2e")
-        frame.pack(side=tk.LEFT, fill=tk.Y, padx=8)
-
+    def build_3d_preview(self, frame):
         tk.Label(frame, text="🧊 3D Превью", font=("Arial", 11, "bold"),
                  bg="#1e1e2e", fg="#e0e0e0").pack(pady=6)
 
@@ -370,11 +3039,11 @@ class MinecraftBlockTexturePainter:
 
         tk.Label(rot_frame, text="Гориз:", bg="#1e1e2e", fg="#aaa", font=("Arial", 8)).grid(row=0, column=0)
         tk.Scale(rot_frame, from_=-180, to=180, orient=tk.HORIZONTAL, variable=self.rot_y,
-                 command=lambda e: self.update_3d_preview(), bg="#1e1e2e", fg="#aaa",
+                 command=lambda e: self.on_preview_rotate(), bg="#1e1e2e", fg="#aaa",
                  highlightthickness=0, troughcolor="#3b3b55", length=140).grid(row=0, column=1)
         tk.Label(rot_frame, text="Верт:", bg="#1e1e2e", fg="#aaa", font=("Arial", 8)).grid(row=1, column=0)
         tk.Scale(rot_frame, from_=-90, to=90, orient=tk.HORIZONTAL, variable=self.rot_x,
-                 command=lambda e: self.update_3d_preview(), bg="#1e1e2e", fg="#aaa",
+                 command=lambda e: self.on_preview_rotate(), bg="#1e1e2e", fg="#aaa",
                  highlightthickness=0, troughcolor="#3b3b55", length=140).grid(row=1, column=1)
 
         # Превью тайл
@@ -382,18 +3051,20 @@ class MinecraftBlockTexturePainter:
         self.tile_canvas = tk.Canvas(frame, width=150, height=150, bg="#111122",
                                      highlightthickness=1, highlightbackground="#444")
         self.tile_canvas.pack()
+        # Один PhotoImage на всё время работы — обновляется через paste()
+        self.tile_photo = photo_image("RGBA", (150, 150))
+        self.tile_canvas.create_image(75, 75, image=self.tile_photo)
+        self._tile_shown = None
 
     # ---------- ВСЕ 6 ГРАНЕЙ МИНИ ПРЕВЬЮ ----------
 
-    def build_all_faces_preview(self, parent):
-        frame = tk.LabelFrame(parent, text="  Все грани блока  ", bg="#1e1e2e", fg="#aaa",
-                              font=("Arial", 10, "bold"), relief=tk.GROOVE, bd=1)
-        frame.pack(fill=tk.X, padx=8, pady=4)
-
+    def build_all_faces_preview(self, frame):
         inner = tk.Frame(frame, bg="#1e1e2e")
         inner.pack(pady=6)
 
         self.mini_canvases = {}
+        self.mini_photos = {}
+        self._mini_shown = {}
         #         Top    Bottom   Front   Back    Left    Right
         layout = [
             (None, "top", None, None, None, None),
@@ -422,6 +3093,9 @@ class MinecraftBlockTexturePainter:
             cv.pack()
             cv.bind("<Button-1>", lambda e, f=face: self.select_face(f))
             self.mini_canvases[face] = cv
+            photo = photo_image("RGBA", (52, 52))
+            cv.create_image(26, 26, image=photo)
+            self.mini_photos[face] = photo
 
     # ---------- ПРАВАЯ ПАНЕЛЬ (ЦВЕТА) ----------
 
@@ -477,12 +3151,8 @@ class MinecraftBlockTexturePainter:
 
         # MC палитра
         tk.Label(frame, text="MC Палитра:", bg="#2a2a3d", fg="#ccc", font=("Arial", 9)).pack()
-        pf = tk.Frame(frame, bg="#2a2a3d")
-        pf.pack(padx=4, pady=4)
-        for i, c in enumerate(self.mc_palette):
-            r, col = divmod(i, 10)
-            tk.Button(pf, bg=c, width=2, height=1, relief=tk.FLAT, bd=0,
-                      command=lambda cc=c: self.set_color(cc)).grid(row=r, column=col, padx=1, pady=1)
+        self.mc_palette_frame = tk.Frame(frame, bg="#2a2a3d")
+        self.mc_palette_frame.pack(padx=4, pady=4)
 
         ttk.Separator(frame, orient="horizontal").pack(fill=tk.X, padx=4, pady=4)
 
@@ -498,6 +3168,12 @@ class MinecraftBlockTexturePainter:
         tk.Button(cpf, text="Из грани", command=self.extract_palette,
                   bg="#3b3b55", fg="#ccc", font=("Arial", 8), relief=tk.FLAT).pack(side=tk.LEFT, padx=2)
 
+    def build_mc_palette(self):
+        for i, c in enumerate(self.mc_palette):
+            r, col = divmod(i, 10)
+            tk.Button(self.mc_palette_frame, bg=c, width=2, height=1, relief=tk.FLAT, bd=0,
+                      command=lambda cc=c: self.set_color(cc)).grid(row=r, column=col, padx=1, pady=1)
+
     # ---------- СТАТУС ----------
 
     def build_status_bar(self):
@@ -513,6 +3189,11 @@ class MinecraftBlockTexturePainter:
         tk.Label(sf, textvariable=self.coord_var, bg="#2a2a3d", fg="#888",
                  font=("Courier", 9), padx=8).pack(side=tk.RIGHT)
 
+        # HUD задержек — показывается по меню «Вид»
+        self.hud_var = tk.StringVar()
+        self.hud_label = tk.Label(sf, textvariable=self.hud_var, bg="#2a2a3d", fg="#e0c060",
+                                  font=("Courier", 9), padx=8)
+
     # =============================================
     #  ПРИВЯЗКА КЛАВИШ
     # =============================================
@@ -523,73 +3204,178 @@ class MinecraftBlockTexturePainter:
         self.root.bind("<Control-s>", lambda e: self.save_atlas())
         self.root.bind("<Control-o>", lambda e: self.open_atlas())
         self.root.bind("<Control-n>", lambda e: self.new_block())
+        self.root.bind("<Control-Tab>", lambda e: self.next_block())
         self.root.bind("<Control-c>", lambda e: self.copy_face())
         self.root.bind("<Control-v>", lambda e: self.paste_face())
-        self.root.bind("<g>", lambda e: self.toggle_grid())
-        self.root.bind("<plus>", lambda e: self.zoom_in())
-        self.root.bind("<equal>", lambda e: self.zoom_in())
-        self.root.bind("<minus>", lambda e: self.zoom_out())
+        # Клавиши без модификаторов не срабатывают при вводе в поля (HEX, размер кисти)
+        self.root.bind("<g>", lambda e: self._typing(e) or self.toggle_grid())
+        self.root.bind("<plus>", lambda e: self._typing(e) or self.zoom_in())
+        self.root.bind("<equal>", lambda e: self._typing(e) or self.zoom_in())
+        self.root.bind("<minus>", lambda e: self._typing(e) or self.zoom_out())
+        self.root.bind("<Key-0>", lambda e: self._typing(e) or self.zoom_fit())
         # 1-6 выбор грани
         for i, face in enumerate(self.FACE_NAMES):
             self.root.bind(f"<F{i + 1}>", lambda e, f=face: self.select_face(f))
 
+    @staticmethod
+    def _typing(event):
+        return isinstance(event.widget, (tk.Entry, tk.Spinbox))
+
     # =============================================
     #  РИСОВАНИЕ ХОЛСТА
     # =============================================
 
-    def draw_face_canvas(self):
-        self.canvas.delete("all")
-        pixels = self.faces[self.current_face]
-        sz = self.pixel_size
+    @traced("redraw")
+    def draw_face_canvas(self, dirty=None):
+        """dirty = (x0, y0, x1, y1) — изменилась только эта область текущей грани"""
+        self._snapshot = None
+        if self.root is None:
+            return
+        t0 = time.perf_counter()
+        self.render_viewport(dirty)
+        self.latency.view("canvas", time.perf_counter() - t0)
+
+        if self.panels_ready:
+            self.update_mini_previews()
+            self.update_3d_preview()
+            self.update_tile_preview()
+        self.update_scene_preview()
+        self.update_mip_preview()
+
+    def _viewport_size(self):
+        w, h = self.canvas.winfo_width(), self.canvas.winfo_height()
+        if w <= 1 or h <= 1:  # окно ещё не показано
+            w, h = int(self.canvas.cget("width")), int(self.canvas.cget("height"))
+        return w, h
+
+    def _clamp_pan(self):
+        """Не дать текстуре уехать за пределы окна больше чем на половину окна"""
+        w, h = self._viewport_size()
+        ext = self.texture_size * self.pixel_size
+        self.pan_x = max(min(0, w - ext) - w / 2, min(max(0, w - ext) + w / 2, self.pan_x))
+        self.pan_y = max(min(0, h - ext) - h / 2, min(max(0, h - ext) + h / 2, self.pan_y))
+
+    @traced("redraw")
+    def render_viewport(self, dirty=None):
+        """Отрисовать видимую часть текущей грани одной картинкой + сетку"""
+        cv = self.canvas
+        w, h = self._viewport_size()
+        if not self._view_centered:
+            self._view_centered = True
+            self.zoom_fit(redraw=False)
+        self._clamp_pan()
+        ps = self.pixel_size
         ts = self.texture_size
-        csz = ts * sz
-
-        # Шахматный фон
-        hs = sz // 2
-        for x in range(ts):
-            for y in range(ts):
-                px, py = x * sz, y * sz
-                for cx in range(2):
-                    for cy in range(2):
-                        c = "#c0c0c0" if (cx + cy) % 2 == 0 else "#909090"
-                        self.canvas.create_rectangle(px + cx * hs, py + cy * hs,
-                                                     px + (cx + 1) * hs, py + (cy + 1) * hs,
-                                                     fill=c, outline="")
-                color = pixels.get((x, y))
-                if color:
-                    self.canvas.create_rectangle(px, py, px + sz, py + sz, fill=color, outline="")
-
-        if self.grid_visible:
-            for i in range(ts + 1):
-                p = i * sz
-                lc = "#444" if i % 4 != 0 else "#666"
-                w = 1 if i % 4 != 0 else 2
-                self.canvas.create_line(p, 0, p, csz, fill=lc, width=w)
-                self.canvas.create_line(0, p, csz, p, fill=lc, width=w)
-
-        self.canvas.create_rectangle(0, 0, csz, csz, outline="#666", width=2)
-
-        self.update_mini_previews()
-        self.update_3d_preview()
-        self.update_tile_preview()
+        geom = (self.pan_x, self.pan_y, ps, w, h, ts, self.current_face)
+        if dirty is not None and self._view_geom is not None and self._view_geom[0] == geom:
+            self._repaint_texels(dirty)
+            return
+        self._view_geom = None
+        cv.delete("grid")
+        cv.itemconfigure(self._overlay_item, state=tk.HIDDEN)
+
+        # Видимый диапазон текселей
+        tx0 = max(0, int(math.floor(-self.pan_x / ps)))
+        ty0 = max(0, int(math.floor(-self.pan_y / ps)))
+        tx1 = min(ts, int(math.ceil((w - self.pan_x) / ps)))
+        ty1 = min(ts, int(math.ceil((h - self.pan_y) / ps)))
+
+        if tx0 < tx1 and ty0 < ty1:
+            sx0, sy0 = round(self.pan_x + tx0 * ps), round(self.pan_y + ty0 * ps)
+            sx1, sy1 = round(self.pan_x + tx1 * ps), round(self.pan_y + ty1 * ps)
+            region = self.composite(self.current_face).to_image((tx0, ty0, tx1, ty1))
+            # Увеличение — без сглаживания, уменьшение меньше 1:1 — усреднением
+            region = region.resize((max(1, sx1 - sx0), max(1, sy1 - sy0)),
+                                   Image.NEAREST if ps >= 1 else Image.BOX)
+            img = Image.alpha_composite(checker_image(*region.size), region)
+            if self.canvas_photo is not None and (self.canvas_photo.width(), self.canvas_photo.height()) == img.size:
+                self.canvas_photo.paste(img)
+            else:
+                self.canvas_photo = photo_image(img)
+                cv.itemconfigure(self._view_item, image=self.canvas_photo)
+            cv.coords(self._view_item, sx0, sy0)
+            cv.itemconfigure(self._view_item, state=tk.NORMAL)
+            self._view_geom = (geom, tx0, ty0, tx1, ty1, sx0, sy0)
+        else:
+            cv.itemconfigure(self._view_item, state=tk.HIDDEN)
+
+        # Сетка только для видимых линий и при достаточном масштабе
+        if self.grid_visible and ps >= 6:
+            gy0, gy1 = self.pan_y + ty0 * ps, self.pan_y + ty1 * ps
+            gx0, gx1 = self.pan_x + tx0 * ps, self.pan_x + tx1 * ps
+            for i in range(tx0, tx1 + 1):
+                p = self.pan_x + i * ps
+                major = i % 4 == 0
+                cv.create_line(p, gy0, p, gy1, fill="#666" if major else "#444",
+                               width=2 if major else 1, tags="grid")
+            for i in range(ty0, ty1 + 1):
+                p = self.pan_y + i * ps
+                major = i % 4 == 0
+                cv.create_line(gx0, p, gx1, p, fill="#666" if major else "#444",
+                               width=2 if major else 1, tags="grid")
+
+        ext = ts * ps
+        cv.create_rectangle(self.pan_x, self.pan_y, self.pan_x + ext, self.pan_y + ext,
+                            outline="#666", width=2, tags="grid")
+
+        # Полосы прокрутки
+        self.hscroll.set(max(0.0, -self.pan_x / ext), min(1.0, (w - self.pan_x) / ext))
+        self.vscroll.set(max(0.0, -self.pan_y / ext), min(1.0, (h - self.pan_y) / ext))
+
+    @traced("redraw")
+    def _repaint_texels(self, dirty):
+        """Перерисовать на холсте только тексели dirty — вид не сдвигался с прошлой отрисовки"""
+        _, tx0, ty0, tx1, ty1, sx0, sy0 = self._view_geom
+        dx0, dy0 = max(dirty[0], tx0), max(dirty[1], ty0)
+        dx1, dy1 = min(dirty[2], tx1), min(dirty[3], ty1)
+        if dx0 >= dx1 or dy0 >= dy1:
+            return
+        ps = self.pixel_size
+        bx0, by0 = round(self.pan_x + dx0 * ps) - sx0, round(self.pan_y + dy0 * ps) - sy0
+        bx1, by1 = round(self.pan_x + dx1 * ps) - sx0, round(self.pan_y + dy1 * ps) - sy0
+        if bx0 >= bx1 or by0 >= by1:
+            return
+        region = self.composite(self.current_face).to_image((dx0, dy0, dx1, dy1))
+        region = region.resize((bx1 - bx0, by1 - by0), Image.NEAREST if ps >= 1 else Image.BOX)
+        # Клетки фона вырезаются из общей подложки, чтобы не сбивался узор
+        back = checker_image(self.canvas_photo.width(), self.canvas_photo.height())
+        patch = Image.alpha_composite(back.crop((bx0, by0, bx1, by1)), region)
+        # Заплатка пишется в левый верхний угол черновика и копируется оттуда в нужное место —
+        # новый PhotoImage создаётся, только когда заплатка больше черновика
+        w, h = patch.size
+        scratch = self._patch_photo
+        if scratch is None or scratch.width() < w or scratch.height() < h:
+            size = (max(w, scratch.width() if scratch else 0), max(h, scratch.height() if scratch else 0))
+            scratch = self._patch_photo = photo_image("RGBA", size)
+        scratch.paste(patch)
+        self.root.tk.call(str(self.canvas_photo), "copy", str(scratch), "-from", 0, 0, w, h, "-to", bx0, by0)
 
     # =============================================
     #  ОБРАБОТКА МЫШИ
     # =============================================
 
+    def _event_texel(self, event):
+        """Тексель под курсором, без проверки границ"""
+        return (int(math.floor((event.x - self.pan_x) / self.pixel_size)),
+                int(math.floor((event.y - self.pan_y) / self.pixel_size)))
+
     def get_px(self, event):
-        x = event.x // self.pixel_size
-        y = event.y // self.pixel_size
+        x, y = self._event_texel(event)
         if 0 <= x < self.texture_size and 0 <= y < self.texture_size:
             return x, y
         return None, None
 
+    @traced("input")
     def on_move(self, event):
         x, y = self.get_px(event)
         if x is not None:
-            c = self.faces[self.current_face].get((x, y), "transparent")
+            px = self.composite(self.current_face).get(x, y)
+            c = rgba_to_hex(px)
+            if c and px[3] < 255:
+                c += f" α{px[3]}"
             self.coord_var.set(f"X:{x} Y:{y} | {c or 'прозрачный'}")
 
+    @traced("input")
     def on_click(self, event):
         x, y = self.get_px(event)
         if x is None:
@@ -598,48 +3384,113 @@ class MinecraftBlockTexturePainter:
                                   "filled_circle", "gradient"):
             self.drag_start = (x, y)
             return
+        if self.current_tool in self.STROKE_TOOLS:
+            t_input = time.perf_counter()
+            self.latency.stroke_started()
+            self.begin_stroke(x, y)
+            self.root.after_idle(self._stroke_displayed, t_input)
+            return
         self.apply_tool(x, y)
 
+    @traced("input")
     def on_drag(self, event):
+        if self._stroke_last is not None:
+            # Точки копятся и соединяются отрезками раз в кадр — быстрый штрих без разрывов
+            self.begin_interaction()
+            self._stroke_points.append(self._event_texel(event))
+            if self._stroke_input_t is None:
+                self._stroke_input_t = time.perf_counter()
+            if self._stroke_job is None:
+                self._stroke_due = time.perf_counter() + self.STROKE_FRAME_MS / 1000
+                self._stroke_job = self.root.after(self.STROKE_FRAME_MS, self.flush_stroke)
+            return
         x, y = self.get_px(event)
         if x is None:
             return
+        self.begin_interaction()
         if self.current_tool in ("line", "rectangle", "circle", "filled_rect",
                                   "filled_circle", "gradient"):
             if self.drag_start:
-                self.draw_face_canvas()
                 self.draw_shape_preview(self.drag_start, (x, y))
-            return
-        if self.current_tool in ("pencil", "eraser", "brush2", "brush3", "dither", "blur"):
-            self.apply_tool(x, y, save=False)
 
+    @traced("input")
     def on_release(self, event):
+        if self._stroke_last is not None:
+            self.flush_stroke()
+            self.end_stroke()
+            return
         x, y = self.get_px(event)
         if self.drag_start and x is not None:
             sx, sy = self.drag_start
-            if self.current_tool == "line":
-                self.draw_line(sx, sy, x, y)
-            elif self.current_tool == "rectangle":
-                self.draw_rect(sx, sy, x, y, False)
-            elif self.current_tool == "filled_rect":
-                self.draw_rect(sx, sy, x, y, True)
-            elif self.current_tool == "circle":
-                self.draw_ellipse(sx, sy, x, y, False)
-            elif self.current_tool == "filled_circle":
-                self.draw_ellipse(sx, sy, x, y, True)
-            elif self.current_tool == "gradient":
-                self.draw_gradient(sx, sy, x, y)
             self.drag_start = None
-            self.save_state()
-            self.draw_face_canvas()
+            self.apply_shape(self.current_tool, sx, sy, x, y)
+        elif self.drag_start:
+            # Отпущено за краем грани — фигура не рисуется, превью убирается
+            self.canvas.itemconfigure(self._overlay_item, state=tk.HIDDEN)
+
+    def flush_stroke(self):
+        """Применить накопленные за кадр точки штриха"""
+        if self._stroke_job is not None:
+            self.root.after_cancel(self._stroke_job)
+            self._stroke_job = None
+        if self._stroke_due is not None:
+            self.latency.frame(time.perf_counter() - self._stroke_due, self.STROKE_FRAME_MS / 1000)
+            self._stroke_due = None
+        points, self._stroke_points = self._stroke_points, []
+        if points:
+            self.stroke_to(points)
+        if self._stroke_input_t is not None:
+            # Холст перерисовывается Tk в простое — задержка засекается следующим за ней обработчиком
+            self.root.after_idle(self._stroke_displayed, self._stroke_input_t)
+            self._stroke_input_t = None
+
+    def _stroke_displayed(self, t_input):
+        self.latency.displayed(t_input, time.perf_counter())
+
+    @traced("tool")
+    @recorded
+    def begin_stroke(self, x, y):
+        """Начать штрих текущим инструментом-штрихом с текселя (x, y)"""
+        self._stroke_last = None
+        self._stroke_points = []
+        self._stroke_cov = np.zeros((self.texture_size, self.texture_size), dtype=np.float32)
+        self._stroke_base = {}
+        self.stroke_to([(x, y)])
+
+    @traced("tool")
+    @recorded
+    def stroke_to(self, points):
+        """Продолжить штрих через тексели points: отрезки между ними, одна перерисовка"""
+        path = []
+        last = self._stroke_last
+        for pt in points:
+            pt = tuple(pt)
+            if last is None:
+                path.append(pt)
+            elif pt != last:
+                path.extend(line_points(*last, *pt)[1:])
+            last = pt
+        self._stroke_last = last
+        if not path:
             return
-        if self.current_tool in ("pencil", "eraser", "brush2", "brush3", "dither", "blur"):
-            self.save_state()
-
+        xs, ys = np.array(path).T
+        dirty = self.paint_texels(xs, ys)
+        if dirty is not None:
+            self.draw_face_canvas(dirty)
+
+    @traced("tool")
+    @recorded
+    def end_stroke(self):
+        self._stroke_last = None
+        self._stroke_cov = None
+        self._stroke_base = {}
+        self.save_state()  # одна запись истории на весь штрих
+
+    @traced("input")
     def on_right_click(self, event):
         x, y = self.get_px(event)
         if x is not None:
-            c = self.faces[self.current_face].get((x, y))
+            c = self.composite(self.current_face).get_hex(x, y)
             if c:
                 self.set_color(c)
 
@@ -655,7 +3506,7 @@ class MinecraftBlockTexturePainter:
                  "eyedropper": "Пипетка", "line": "Линия", "rectangle": "Прямоуг.",
                  "circle": "Круг", "filled_rect": "Прям.(зал.)", "filled_circle": "Круг(зал.)",
                  "gradient": "Градиент", "blur": "Размытие", "replace": "Замена цвета",
-                 "brush2": "Кисть 2px", "brush3": "Кисть 3px", "dither": "Дизеринг"}
+                 "brush": "Кисть", "dither": "Дизеринг"}
         self.update_status(tool=names.get(tool, tool))
 
     def get_target_faces(self):
@@ -669,128 +3520,235 @@ class MinecraftBlockTexturePainter:
                 targets = sides
         return targets
 
+    def write_targets(self, names=None):
+        """
+        Грани для записи на месте — по одной на общий буфер (связанные грани
+        пишутся один раз). Буфер, общий с гранью, которая не меняется,
+        сначала копируется: грань отвязывается только при расхождении.
+        """
+        names = self.get_target_faces() if names is None else names
+        users = {}
+        for face in self.FACE_NAMES:
+            users.setdefault(id(self.faces[face]), []).append(face)
+        copies = {}
+        for face in names:
+            pix = self.faces[face]
+            if any(f not in names for f in users[id(pix)]):
+                if id(pix) not in copies:
+                    copies[id(pix)] = pix.snapshot()
+                self.faces[face] = copies[id(pix)]
+        return distinct_buffers(self.faces, names)
+
+    def share_identical_faces(self):
+        """Грани с одинаковыми пикселями активного слоя — на один общий буфер"""
+        kept = []
+        for face in self.FACE_NAMES:
+            pix = self.faces[face]
+            same = next((k for k in kept if k is pix or k == pix), None)
+            if same is None:
+                kept.append(pix)
+            else:
+                self.faces[face] = same
+
+    def apply_symmetry(self, xs, ys, alpha):
+        """
+        Точки вместе с их симметричными копиями. Точки за краем грани
+        отбрасываются; копии берутся из таблиц symmetry_maps одной выборкой.
+        """
+        ts = self.texture_size
+        inside = (xs >= 0) & (xs < ts) & (ys >= 0) & (ys < ts)
+        xs, ys, alpha = xs[inside], ys[inside], alpha[inside]
+        if self.symmetry == "none":
+            return xs, ys, alpha
+        map_x, map_y = symmetry_maps(self.symmetry, ts)
+        xs, ys = map_x[:, ys, xs].ravel(), map_y[:, ys, xs].ravel()
+        alpha = np.tile(alpha, map_x.shape[0])
+        keep = xs >= 0
+        return xs[keep], ys[keep], alpha[keep]
+
+    def paint_rgba(self, color):
+        """Цвет '#rrggbb' с текущей прозрачностью рисования"""
+        return hex_to_rgba(color, self.paint_alpha)
+
+    @traced("tool")
+    @recorded
     def set_pixel(self, x, y, color):
         if not (0 <= x < self.texture_size and 0 <= y < self.texture_size):
             return
-        for face in self.get_target_faces():
-            self.faces[face][(x, y)] = color
-            if self.symmetry_x:
-                self.faces[face][(self.texture_size - 1 - x, y)] = color
-            if self.symmetry_y:
-                self.faces[face][(x, self.texture_size - 1 - y)] = color
-            if self.symmetry_x and self.symmetry_y:
-                self.faces[face][(self.texture_size - 1 - x, self.texture_size - 1 - y)] = color
+        self.plot_texels(np.array([x]), np.array([y]), self.paint_rgba(color))
 
+    def on_brush_change(self):
+        try:
+            self.brush_size = max(1, min(64, self.brush_size_var.get()))
+            self.line_width = max(1, min(32, self.line_width_var.get()))
+        except tk.TclError:
+            pass
+        label = self.brush_shape_var.get()
+        self.brush_shape = next(k for k, v in BRUSH_SHAPES.items() if v == label)
+        self.brush_antialias = self.brush_aa_var.get()
+
+    def get_brush_stamp(self):
+        """Текущий штамп (маска, покрытие); штамп «из буфера» кэшируется по поколению буфера"""
+        if self.brush_shape == "custom" and self.clipboard is not None:
+            gen, stamp = self._custom_stamp
+            if gen != self.clipboard.generation:
+                stamp = stamp_from_array(self.clipboard.read())
+                self._custom_stamp = (self.clipboard.generation, stamp)
+            if stamp is not None:
+                return stamp
+        shape = self.brush_shape if self.brush_shape != "custom" else "square"
+        return brush_stamp(shape, self.brush_size)
+
+    @traced("tool")
+    def plot_texels(self, xs, ys, rgba, alpha=None):
+        """
+        Закрасить тексели (xs, ys) на всех целевых гранях с учётом симметрии:
+        одна запись по маске на грань. alpha — покрытие каждой точки (0..1),
+        частично покрытые тексели смешиваются с тем, что уже нарисовано.
+        Возвращает изменённую область или None.
+        """
+        if alpha is None:
+            alpha = np.ones(len(xs), dtype=np.float32)
+        xs, ys, alpha = self.apply_symmetry(xs, ys, alpha)
+        if not len(xs):
+            return None
+        x0, y0 = int(xs.min()), int(ys.min())
+        x1, y1 = int(xs.max()) + 1, int(ys.max()) + 1
+        cov = np.zeros((y1 - y0, x1 - x0), dtype=np.float32)
+        np.maximum.at(cov, (ys - y0, xs - x0), alpha)
+        stroke = None if self._stroke_cov is None else self._stroke_cov[y0:y1, x0:x1]
+        if rgba[3] in (0, 255) and (alpha >= 1).all():
+            # Жёсткий край непрозрачным цветом или ластиком: одна запись по маске
+            mask = cov > 0
+            for face in self.write_targets():
+                self.faces[face].write(x0, y0, rgba, mask=mask)
+            if stroke is not None:
+                np.maximum(stroke, cov, out=stroke)
+            return x0, y0, x1, y1
+        mask = cov > 0
+        if stroke is not None:
+            # За штрих цвет кладётся не больше одного раза: покрытие копится
+            # в буфере штриха и смешивается с гранью на момент начала штриха
+            cov = np.maximum(stroke, cov)
+            mask = cov > stroke
+            stroke[...] = cov
+        for face in self.write_targets():
+            pix = self.faces[face]
+            src = pix
+            if stroke is not None:
+                src = self._stroke_base.get(face)
+                if src is None:
+                    src = self._stroke_base[face] = pix.snapshot()
+            pix.write(x0, y0, blend_color(src.read(x0, y0, x1, y1), rgba, cov), mask=mask)
+        return x0, y0, x1, y1
+
+    @traced("tool")
+    def paint_texels(self, xs, ys):
+        """Применить инструмент-штрих ко всем точкам сразу; возвращает изменённую область"""
+        tool = self.current_tool
+        if tool == "blur":
+            # Размытие 3×3 по маске штриха — одна свёртка рамки штриха на все грани
+            xs, ys, _ = self.apply_symmetry(xs, ys, np.ones(len(xs)))
+            if not len(xs):
+                return None
+            mask = np.zeros((self.texture_size, self.texture_size), dtype=bool)
+            mask[ys, xs] = True
+            return filter_faces(self.faces, self.write_targets(), "box_blur", 1, mask)
+        if tool == "dither":
+            even = (xs + ys) % 2 == 0
+            boxes = [self.plot_texels(xs[even], ys[even], self.paint_rgba(self.current_color)),
+                     self.plot_texels(xs[~even], ys[~even], self.paint_rgba(self.secondary_color))]
+            boxes = [b for b in boxes if b]
+            if not boxes:
+                return None
+            return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                    max(b[2] for b in boxes), max(b[3] for b in boxes))
+        rgba = TRANSPARENT if tool == "eraser" else self.paint_rgba(self.current_color)
+        if tool == "brush":
+            mask, alpha = self.get_brush_stamp()
+            x0, y0, cov = stamp_coverage(xs, ys, alpha if self.brush_antialias else mask)
+            sy, sx = np.nonzero(cov)
+            return self.plot_texels(sx + x0, sy + y0, rgba, cov[sy, sx])
+        return self.plot_texels(xs, ys, rgba)
+
+    @traced("tool")
+    @recorded
     def apply_tool(self, x, y, save=True):
         pix = self.faces[self.current_face]
-        if self.current_tool == "pencil":
-            self.set_pixel(x, y, self.current_color)
-        elif self.current_tool == "eraser":
-            self.set_pixel(x, y, None)
+        if self.current_tool in self.STROKE_TOOLS:
+            self.paint_texels(np.array([x]), np.array([y]))
         elif self.current_tool == "fill":
             self.flood_fill(x, y, self.current_color)
         elif self.current_tool == "eyedropper":
-            c = pix.get((x, y))
-            if c:
-                self.set_color(c)
+            px = self.composite(self.current_face).get(x, y)
+            if px[3]:
+                self.set_color(rgba_to_hex(px))
+                self.set_paint_alpha(px[3])
         elif self.current_tool == "replace":
-            old = pix.get((x, y))
-            if old:
-                for face in self.get_target_faces():
-                    for k in self.faces[face]:
-                        if self.faces[face][k] == old:
-                            self.faces[face][k] = self.current_color
-        elif self.current_tool == "brush2":
-            self._brush(x, y, 2)
-        elif self.current_tool == "brush3":
-            self._brush(x, y, 3)
-        elif self.current_tool == "dither":
-            if (x + y) % 2 == 0:
-                self.set_pixel(x, y, self.current_color)
-            else:
-                self.set_pixel(x, y, self.secondary_color)
-        elif self.current_tool == "blur":
-            self._blur(x, y)
+            old = pix.get(x, y)
+            if old[3]:
+                old = np.array(old, dtype=np.uint8)
+                new = np.array(self.paint_rgba(self.current_color), dtype=np.uint8)
+
+                def replace(tile):
+                    return np.where((tile == old).all(axis=-1, keepdims=True), new, tile)
+
+                for face in self.write_targets():
+                    self.faces[face].map_tiles(replace)
 
         if save and self.current_tool in ("fill", "replace"):
             self.save_state()
         self.draw_face_canvas()
 
-    def _brush(self, cx, cy, size):
-        off = size // 2
-        for dx in range(-off, off + 1):
-            for dy in range(-off, off + 1):
-                self.set_pixel(cx + dx, cy + dy, self.current_color)
-
-    def _blur(self, x, y):
-        pix = self.faces[self.current_face]
-        nb = []
-        for dx in range(-1, 2):
-            for dy in range(-1, 2):
-                c = pix.get((x + dx, y + dy))
-                if c:
-                    nb.append(c)
-        if nb:
-            ar = sum(int(c[1:3], 16) for c in nb) // len(nb)
-            ag = sum(int(c[3:5], 16) for c in nb) // len(nb)
-            ab = sum(int(c[5:7], 16) for c in nb) // len(nb)
-            self.set_pixel(x, y, f"#{ar:02x}{ag:02x}{ab:02x}")
-
+    @traced("tool")
     def flood_fill(self, x, y, new_color):
-        for face in self.get_target_faces():
+        new = self.paint_rgba(new_color)
+        for face in self.write_targets():
             pix = self.faces[face]
-            target = pix.get((x, y))
-            if target == new_color:
+            target = pix.get(x, y)
+            if target == new:
                 continue
-            stack = [(x, y)]
-            visited = set()
-            while stack:
-                cx, cy = stack.pop()
-                if (cx, cy) in visited:
-                    continue
-                if not (0 <= cx < self.texture_size and 0 <= cy < self.texture_size):
-                    continue
-                if pix.get((cx, cy)) != target:
-                    continue
-                visited.add((cx, cy))
-                pix[(cx, cy)] = new_color
-                stack.extend([(cx + 1, cy), (cx - 1, cy), (cx, cy + 1), (cx, cy - 1)])
+            region = pix.read()
+            mask = flood_fill_mask((region == np.array(target, dtype=np.uint8)).all(axis=-1), x, y)
+            if new[3] == 255:
+                pix.write(0, 0, new, mask=mask)
+            else:
+                # Полупрозрачная заливка смешивается с областью
+                pix.write(0, 0, blend_color(region, new, mask.astype(np.float32)), mask=mask)
 
     # --------- ФИГУРЫ ---------
 
+    @traced("tool")
+    @recorded
+    def apply_shape(self, tool, x0, y0, x1, y1):
+        """Фигура инструментом tool от (x0, y0) до (x1, y1): одна запись истории"""
+        if tool == "line":
+            self.draw_line(x0, y0, x1, y1)
+        elif tool == "rectangle":
+            self.draw_rect(x0, y0, x1, y1, False)
+        elif tool == "filled_rect":
+            self.draw_rect(x0, y0, x1, y1, True)
+        elif tool == "circle":
+            self.draw_ellipse(x0, y0, x1, y1, False)
+        elif tool == "filled_circle":
+            self.draw_ellipse(x0, y0, x1, y1, True)
+        elif tool == "gradient":
+            self.draw_gradient(x0, y0, x1, y1)
+        self.save_state()
+        self.draw_face_canvas()
+
+    def _draw_shape(self, tool, x0, y0, x1, y1):
+        xs, ys = shape_points(tool, (x0, y0), (x1, y1), self.line_width)
+        self.plot_texels(xs, ys, self.paint_rgba(self.current_color))
+
     def draw_line(self, x0, y0, x1, y1):
-        dx, dy = abs(x1 - x0), abs(y1 - y0)
-        sx = 1 if x0 < x1 else -1
-        sy = 1 if y0 < y1 else -1
-        err = dx - dy
-        while True:
-            self.set_pixel(x0, y0, self.current_color)
-            if x0 == x1 and y0 == y1:
-                break
-            e2 = 2 * err
-            if e2 > -dy:
-                err -= dy; x0 += sx
-            if e2 < dx:
-                err += dx; y0 += sy
+        self._draw_shape("line", x0, y0, x1, y1)
 
     def draw_rect(self, x0, y0, x1, y1, filled):
-        mnx, mxx = min(x0, x1), max(x0, x1)
-        mny, mxy = min(y0, y1), max(y0, y1)
-        for x in range(mnx, mxx + 1):
-            for y in range(mny, mxy + 1):
-                if filled or x in (mnx, mxx) or y in (mny, mxy):
-                    self.set_pixel(x, y, self.current_color)
+        self._draw_shape("filled_rect" if filled else "rectangle", x0, y0, x1, y1)
 
     def draw_ellipse(self, x0, y0, x1, y1, filled):
-        cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
-        rx, ry = abs(x1 - x0) / 2, abs(y1 - y0) / 2
-        if rx == 0 or ry == 0:
-            self.draw_line(x0, y0, x1, y1); return
-        for x in range(min(x0, x1), max(x0, x1) + 1):
-            for y in range(min(y0, y1), max(y0, y1) + 1):
-                v = ((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2
-                if (filled and v <= 1.0) or (not filled and 0.5 <= v <= 1.5):
-                    self.set_pixel(x, y, self.current_color)
+        self._draw_shape("filled_circle" if filled else "circle", x0, y0, x1, y1)
 
     def draw_gradient(self, x0, y0, x1, y1):
         r0, g0, b0 = self._hex2rgb(self.current_color)
@@ -798,53 +3756,50 @@ class MinecraftBlockTexturePainter:
         mnx, mxx = min(x0, x1), max(x0, x1)
         mny, mxy = min(y0, y1), max(y0, y1)
         w = max(1, mxx - mnx)
+        ys = np.arange(mny, mxy + 1)
         for x in range(mnx, mxx + 1):
             t = (x - mnx) / w
             r = int(r0 + (r1 - r0) * t)
             g = int(g0 + (g1 - g0) * t)
             b = int(b0 + (b1 - b0) * t)
-            c = f"#{r:02x}{g:02x}{b:02x}"
-            for y in range(mny, mxy + 1):
-                self.set_pixel(x, y, c)
+            # Столбец одного цвета — одна запись
+            self.plot_texels(np.full(len(ys), x), ys, (r, g, b, self.paint_alpha))
 
+    @traced("tool")
     def draw_shape_preview(self, start, end):
-        x0, y0 = start
-        x1, y1 = end
-        pts = []
-        if self.current_tool == "line":
-            dx, dy = abs(x1 - x0), abs(y1 - y0)
-            sx = 1 if x0 < x1 else -1
-            sy = 1 if y0 < y1 else -1
-            err = dx - dy
-            px, py = x0, y0
-            while True:
-                pts.append((px, py))
-                if px == x1 and py == y1: break
-                e2 = 2 * err
-                if e2 > -dy: err -= dy; px += sx
-                if e2 < dx: err += dx; py += sy
-        elif self.current_tool in ("rectangle", "filled_rect"):
-            for x in range(min(x0, x1), max(x0, x1) + 1):
-                for y in range(min(y0, y1), max(y0, y1) + 1):
-                    if self.current_tool == "filled_rect" or x in (min(x0, x1), max(x0, x1)) or y in (
-                    min(y0, y1), max(y0, y1)):
-                        pts.append((x, y))
-        elif self.current_tool in ("circle", "filled_circle"):
-            cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
-            rx, ry = abs(x1 - x0) / 2, abs(y1 - y0) / 2
-            if rx > 0 and ry > 0:
-                for x in range(min(x0, x1), max(x0, x1) + 1):
-                    for y in range(min(y0, y1), max(y0, y1) + 1):
-                        v = ((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2
-                        if (self.current_tool == "filled_circle" and v <= 1.0) or (
-                                self.current_tool == "circle" and 0.5 <= v <= 1.5):
-                            pts.append((x, y))
-
-        sz = self.pixel_size
-        for px, py in pts:
-            if 0 <= px < self.texture_size and 0 <= py < self.texture_size:
-                self.canvas.create_rectangle(px * sz, py * sz, px * sz + sz, py * sz + sz,
-                                             fill=self.current_color, outline="#fff", stipple="gray50")
+        """Показать фигуру в слое поверх холста — сама грань и превью не перерисовываются"""
+        cv = self.canvas
+        pts = shape_points(self.current_tool, start, end, self.line_width)
+        if self._view_geom is None:
+            self.render_viewport()
+        if pts is None or self._view_geom is None:
+            cv.itemconfigure(self._overlay_item, state=tk.HIDDEN)
+            return
+        _, tx0, ty0, tx1, ty1, _, _ = self._view_geom
+        xs, ys = pts
+        visible = (xs >= tx0) & (xs < tx1) & (ys >= ty0) & (ys < ty1)
+        if not visible.any():
+            cv.itemconfigure(self._overlay_item, state=tk.HIDDEN)
+            return
+        xs, ys = xs[visible], ys[visible]
+        bx0, by0 = int(xs.min()), int(ys.min())
+        bx1, by1 = int(xs.max()) + 1, int(ys.max()) + 1
+        arr = np.zeros((by1 - by0, bx1 - bx0, 4), dtype=np.uint8)
+        arr[ys - by0, xs - bx0] = (*hex_to_rgba(self.current_color)[:3], max(1, self.paint_alpha * 2 // 3))
+
+        ps = self.pixel_size
+        sx0, sy0 = round(self.pan_x + bx0 * ps), round(self.pan_y + by0 * ps)
+        sx1, sy1 = round(self.pan_x + bx1 * ps), round(self.pan_y + by1 * ps)
+        img = Image.fromarray(arr, "RGBA").resize((max(1, sx1 - sx0), max(1, sy1 - sy0)),
+                                                  Image.NEAREST if ps >= 1 else Image.BOX)
+        if self.overlay_photo is not None and (self.overlay_photo.width(), self.overlay_photo.height()) == img.size:
+            self.overlay_photo.paste(img)
+        else:
+            self.overlay_photo = photo_image(img)
+            cv.itemconfigure(self._overlay_item, image=self.overlay_photo)
+        cv.coords(self._overlay_item, sx0, sy0)
+        cv.itemconfigure(self._overlay_item, state=tk.NORMAL)
+        cv.tag_raise(self._overlay_item)
 
     # =============================================
     #  ЦВЕТА
@@ -856,8 +3811,15 @@ class MinecraftBlockTexturePainter:
     def _rgb2hex(self, r, g, b):
         return f"#{max(0, min(255, r)):02x}{max(0, min(255, g)):02x}{max(0, min(255, b)):02x}"
 
+    def set_paint_alpha(self, alpha):
+        self.paint_alpha = int(alpha)
+        if self.root is not None:
+            self.alpha_var.set(self.paint_alpha)
+
     def set_color(self, c):
         self.current_color = c
+        if self.root is None:
+            return
         self.primary_btn.configure(bg=c)
         self.hex_entry.delete(0, tk.END)
         self.hex_entry.insert(0, c)
@@ -909,10 +3871,7 @@ class MinecraftBlockTexturePainter:
                       command=lambda cc=self.current_color: self.set_color(cc)).grid(row=r, column=c, padx=1, pady=1)
 
     def extract_palette(self):
-        colors = set()
-        for c in self.faces[self.current_face].values():
-            if c: colors.add(c)
-        self.custom_palette = list(colors)
+        self.custom_palette = sorted(self.composite(self.current_face).colors())
         for w in self.cust_pal_frame.winfo_children(): w.destroy()
         for i, c in enumerate(self.custom_palette):
             r, col = divmod(i, 10)
@@ -925,225 +3884,925 @@ class MinecraftBlockTexturePainter:
 
     def select_face(self, face):
         self.current_face = face
+        if self.root is None:
+            return
         for f, btn in self.face_buttons.items():
             btn.configure(bg="#0078d4" if f == face else "#3b3b55")
         self.face_title_var.set(self.FACE_LABELS[face])
         self.update_status()
         self.draw_face_canvas()
+        self.update_layers_window()
 
     # =============================================
     #  ПРЕВЬЮ
     # =============================================
 
+    def begin_interaction(self):
+        """Идёт ввод (штрих, вращение): превью рисуются грубо до паузы PREVIEW_REFINE_MS"""
+        self.interactive = True
+        if self._refine_job is not None:
+            self.root.after_cancel(self._refine_job)
+        self._refine_job = self.root.after(self.PREVIEW_REFINE_MS, self._refine_previews)
+
+    def _refine_previews(self):
+        """Ввод затих — перерисовать грубые превью в полном качестве"""
+        self._refine_job = None
+        self.interactive = False
+        if self.panels_ready:
+            self.update_3d_preview()
+        self.update_scene_preview()
+        self.update_mip_preview()
+
+    def on_preview_rotate(self):
+        self.begin_interaction()
+        self.update_3d_preview()
+
+    def _preview_snapshot(self):
+        """Снимок граней для потока рендера; один на все превью до следующей правки"""
+        if self._snapshot is None:
+            self._snapshot = PreviewSnapshot(
+                self.texture_size, {f: self.composite(f).snapshot() for f in self.FACE_NAMES})
+        return self._snapshot
+
+    def _submit_preview(self, key, func, args, on_done):
+        """Отправить рендер в фоновый поток; результат придёт в on_done в главном потоке"""
+        latency = self.latency
+
+        def render(*a):
+            t0 = time.perf_counter()
+            result = func(*a)
+            latency.view(key, time.perf_counter() - t0)
+            return result
+
+        def show(result):
+            # Время вида — рендер в фоне плюс показ в главном потоке
+            t0 = time.perf_counter()
+            on_done(result)
+            latency.views[key] = latency.views.get(key, 0.0) + (time.perf_counter() - t0) * 1000
+
+        self.preview_worker.submit(key, render, args, show)
+        if self._preview_poll_job is None:
+            self._preview_poll_job = self.root.after(10, self._poll_previews)
+
+    def _poll_previews(self):
+        self._preview_poll_job = None
+        self.preview_worker.poll()
+        if not self.preview_worker.is_idle():
+            self._preview_poll_job = self.root.after(10, self._poll_previews)
+
+    @traced("preview")
     def update_mini_previews(self):
         for face, cv in self.mini_canvases.items():
-            img = self._face_to_pil(face)
-            img = img.resize((52, 52), Image.NEAREST)
-            photo = ImageTk.PhotoImage(img)
-            cv.delete("all")
-            cv.create_image(26, 26, image=photo)
-            cv._photo = photo
             # Подсветка текущей грани
             if face == self.current_face:
                 cv.configure(highlightbackground="#0078d4", highlightthickness=2)
             else:
                 cv.configure(highlightbackground="#444", highlightthickness=1)
-
+        self._submit_preview("minis", self._render_minis, (self._preview_snapshot(), dict(self._mini_shown)),
+                             self._show_minis)
+
+    @staticmethod
+    def _same_pixels(a, b):
+        return a is b or a == b
+
+    @traced("preview")
+    def _render_minis(self, snap, shown):
+        """Поток рендера: мини-превью 52×52 только для граней, изменившихся с прошлого показа"""
+        images = {f: Image.alpha_composite(checker_image(52, 52, 13),
+                                           snap.image(f).resize((52, 52), Image.NEAREST))
+                  for f in self.FACE_NAMES if not self._same_pixels(shown.get(f), snap.faces[f])}
+        return snap, images
+
+    @traced("preview")
+    def _show_minis(self, result):
+        snap, images = result
+        for face, img in images.items():
+            self.mini_photos[face].paste(img)
+            self._mini_shown[face] = snap.faces[face]
+
+    @traced("preview")
     def update_tile_preview(self):
-        img = self._face_to_pil(self.current_face)
-        tile = Image.new("RGBA", (self.texture_size * 3, self.texture_size * 3))
+        self._submit_preview("tile", self._render_tile,
+                             (self._preview_snapshot(), self.current_face, self._tile_shown),
+                             self._show_tile)
+
+    @traced("preview")
+    def _render_tile(self, snap, face, shown):
+        """Поток рендера: тайл 3×3 текущей грани (None — показанный тайл актуален)"""
+        if shown is not None and shown[0] == face and self._same_pixels(shown[1], snap.faces[face]):
+            return None
+        img = snap.image(face)
+        tile = Image.new("RGBA", (snap.size * 3, snap.size * 3))
         for tx in range(3):
             for ty in range(3):
-                tile.paste(img, (tx * self.texture_size, ty * self.texture_size))
-        tile = tile.resize((150, 150), Image.NEAREST)
-        self.tile_photo = ImageTk.PhotoImage(tile)
-        self.tile_canvas.delete("all")
-        self.tile_canvas.create_image(75, 75, image=self.tile_photo)
+                tile.paste(img, (tx * snap.size, ty * snap.size))
+        return face, snap.faces[face], Image.alpha_composite(checker_image(150, 150, 10),
+                                                             tile.resize((150, 150), Image.NEAREST))
 
+    @traced("preview")
+    def _show_tile(self, result):
+        face, pixels, tile = result
+        self.tile_photo.paste(tile)
+        self._tile_shown = (face, pixels)
+
+    @traced("preview")
     def update_3d_preview(self):
-        """Изометрическое 3D-превью блока"""
+        """Изометрическое 3D-превью блока (рендер в фоновом потоке)"""
+        # Во время ввода текстура рисуется блоками 3×3
+        step = 3 if self.interactive else 1
+        self._submit_preview("3d", self._render_3d,
+                             (self._preview_snapshot(), self.rot_x.get(), self.rot_y.get(), step),
+                             self._show_3d)
+
+    @traced("preview")
+    def _render_3d(self, snap, rot_x, rot_y, step):
+        """
+        Поток рендера: блок в ортографической проекции тем же векторным
+        растеризатором, что и превью сцены (с полупрозрачностью).
+        Во время ввода рендер идёт в step раз меньше и растягивается.
+        """
         w, h = 240, 260
-        img = Image.new("RGBA", (w, h), (17, 17, 34, 255))
-        draw = ImageDraw.Draw(img)
-
-        # Получить текстуры граней
-        top_img = self._face_to_pil("top").resize((64, 64), Image.NEAREST)
-        front_img = self._face_to_pil("front").resize((64, 64), Image.NEAREST)
-        right_img = self._face_to_pil("right").resize((64, 64), Image.NEAREST)
-
-        rx = math.radians(self.rot_x.get())
-        ry = math.radians(self.rot_y.get())
-
-        # Рисуем простую изометрическую проекцию
-        cx, cy = w // 2, h // 2
-        size = 50
-
-        # Определяем видимые грани на основе вращения
-        show_front = math.cos(ry) > 0
-        show_right = math.sin(ry) < 0
-        show_top = math.cos(rx) > 0
-
-        # Изометрические координаты
-        cos30 = math.cos(math.radians(30))
-        sin30 = math.sin(math.radians(30))
-
-        # Вершины куба в изометрии
-        def iso(x, y, z):
-            sx = cx + (x - z) * cos30 * size / 50
-            sy = cy - y * size / 50 + (x + z) * sin30 * size / 50
-            return int(sx), int(sy)
-
-        # 8 вершин куба
-        v = {
-            'ftl': iso(-1, 1, -1), 'ftr': iso(1, 1, -1),
-            'fbl': iso(-1, -1, -1), 'fbr': iso(1, -1, -1),
-            'btl': iso(-1, 1, 1), 'btr': iso(1, 1, 1),
-            'bbl': iso(-1, -1, 1), 'bbr': iso(1, -1, 1),
-        }
-
-        # Определение видимых граней и их рисование
-        faces_to_draw = []
+        textures = {f: snap.faces[f].read() for f in self.FACE_NAMES}
+        rgb = render_block_scene(textures, (1, 1, 1), math.radians(rot_y), math.radians(rot_x),
+                                 w // step, h // step, perspective=False)
+        img = Image.fromarray(rgb).convert("RGBA")
+        return img if step == 1 else img.resize((w, h), Image.NEAREST)
+
+    @traced("preview")
+    def _show_3d(self, img):
+        self.preview_3d_photo = photo_image(img)
+        self.preview_3d_canvas.delete("all")
+        self.preview_3d_canvas.create_image(img.width // 2, img.height // 2, image=self.preview_3d_photo)
 
-        if show_top:
-            faces_to_draw.append(('top', [v['ftl'], v['ftr'], v['btr'], v['btl']], top_img))
+    def open_scene_preview(self):
+        """Окно с превью стены / пола из нескольких блоков"""
+        if self.scene_window is not None:
+            self.scene_window.lift()
+            return
+        win = tk.Toplevel(self.root)
+        win.title("Превью сцены")
+        win.configure(bg="#1e1e2e")
+        win.resizable(False, False)
+        win.protocol("WM_DELETE_WINDOW", self.close_scene_preview)
+        self.scene_window = win
+
+        self.scene_canvas = tk.Canvas(win, width=400, height=400, bg="#111122",
+                                      highlightthickness=1, highlightbackground="#444")
+        self.scene_canvas.pack(padx=8, pady=8)
+
+        ctrl = tk.Frame(win, bg="#1e1e2e")
+        ctrl.pack(padx=8, pady=(0, 8))
+        redraw = lambda *_: self.update_scene_preview()
+
+        self.scene_layout = tk.StringVar(value="wall")
+        self.scene_n = tk.IntVar(value=5)
+        self.scene_m = tk.IntVar(value=5)
+        self.scene_perspective = tk.BooleanVar(value=True)
+        self.scene_yaw = tk.DoubleVar(value=-35)
+        self.scene_pitch = tk.DoubleVar(value=25)
+
+        row = tk.Frame(ctrl, bg="#1e1e2e")
+        row.grid(row=0, column=0, columnspan=2, sticky="w")
+        for text, val in [("Стена", "wall"), ("Пол", "floor"), ("Куб", "cube")]:
+            tk.Radiobutton(row, text=text, value=val, variable=self.scene_layout, command=redraw,
+                           bg="#1e1e2e", fg="#ccc", selectcolor="#3b3b55").pack(side=tk.LEFT)
+        tk.Checkbutton(row, text="Перспектива", variable=self.scene_perspective, command=redraw,
+                       bg="#1e1e2e", fg="#ccc", selectcolor="#3b3b55").pack(side=tk.LEFT, padx=8)
+
+        row = tk.Frame(ctrl, bg="#1e1e2e")
+        row.grid(row=1, column=0, columnspan=2, sticky="w", pady=4)
+        for text, var in [("N:", self.scene_n), ("M:", self.scene_m)]:
+            tk.Label(row, text=text, bg="#1e1e2e", fg="#aaa", font=("Arial", 9)).pack(side=tk.LEFT)
+            tk.Spinbox(row, from_=1, to=16, width=4, textvariable=var, command=redraw).pack(side=tk.LEFT, padx=(2, 8))
+
+        def rotate(_=None):
+            self.begin_interaction()
+            self.update_scene_preview()
+
+        for r, (text, var, lo, hi) in enumerate([("Гориз:", self.scene_yaw, -180, 180),
+                                                  ("Верт:", self.scene_pitch, -90, 90)], start=2):
+            tk.Label(ctrl, text=text, bg="#1e1e2e", fg="#aaa", font=("Arial", 8)).grid(row=r, column=0)
+            tk.Scale(ctrl, from_=lo, to=hi, orient=tk.HORIZONTAL, variable=var, command=rotate,
+                     bg="#1e1e2e", fg="#aaa", highlightthickness=0, troughcolor="#3b3b55",
+                     length=300).grid(row=r, column=1)
+
+        self.scene_info_var = tk.StringVar()
+        tk.Label(ctrl, textvariable=self.scene_info_var, bg="#1e1e2e", fg="#888",
+                 font=("Courier", 8)).grid(row=4, column=0, columnspan=2, sticky="w")
+
+        self.update_scene_preview()
+
+    def close_scene_preview(self):
+        self.scene_window.destroy()
+        self.scene_window = None
+
+    @traced("preview")
+    def update_scene_preview(self):
+        """Перерисовать сцену N×M блоков программным растеризатором"""
+        if self.scene_window is None:
+            return
+        try:
+            n = max(1, min(16, self.scene_n.get()))
+            m = max(1, min(16, self.scene_m.get()))
+        except tk.TclError:
+            return
+        layout = self.scene_layout.get()
+        if layout == "wall":
+            dims = (n, m, 1)
+        elif layout == "floor":
+            dims = (n, 1, m)
         else:
-            faces_to_draw.append(('bottom', [v['fbl'], v['fbr'], v['bbr'], v['bbl']],
-                                  self._face_to_pil("bottom").resize((64, 64), Image.NEAREST)))
+            dims = (n, m, n)
+
+        # Во время ввода — половинное разрешение с увеличением без сглаживания
+        res = 200 if self.interactive else 400
+        self._submit_preview("scene", self._render_scene,
+                             (self._preview_snapshot(), dims, math.radians(self.scene_yaw.get()),
+                              math.radians(self.scene_pitch.get()), res, self.scene_perspective.get()),
+                             self._show_scene)
+
+    @traced("preview")
+    def _render_scene(self, snap, dims, yaw, pitch, res, perspective):
+        """Поток рендера: сцена из блоков"""
+        t0 = time.perf_counter()
+        textures = {f: np.asarray(snap.image(f)) for f in self.FACE_NAMES}
+        rgb = render_block_scene(textures, dims, yaw, pitch, res, res, perspective=perspective)
+        img = Image.fromarray(rgb)
+        if res != 400:
+            img = img.resize((400, 400), Image.NEAREST)
+        ms = (time.perf_counter() - t0) * 1000
+        quality = "черновик" if res != 400 else "полное"
+        return img, f"{dims[0]}×{dims[1]}×{dims[2]} блоков | {res}px {quality} | {ms:.1f} мс"
+
+    @traced("preview")
+    def _show_scene(self, result):
+        if self.scene_window is None:
+            return
+        img, info = result
+        self.scene_photo = photo_image(img)
+        self.scene_canvas.delete("all")
+        self.scene_canvas.create_image(200, 200, image=self.scene_photo)
+        self.scene_info_var.set(info)
+
+    def get_mip_chain(self, face):
+        """Мип-уровни грани; пересчитываются только при смене поколения грани"""
+        pix = self.composite(face)
+        cached = self._mip_cache.get(face)
+        if cached is None or cached[0] != pix.generation:
+            cached = (pix.generation, mip_chain(pix.read()))
+            self._mip_cache[face] = cached
+        return cached[1]
+
+    @staticmethod
+    def _mip_sizes(size, levels=4):
+        """Размеры мип-уровней грани size×size — как их строит mip_chain"""
+        sizes = [size]
+        while len(sizes) <= levels and size > 1 and size % 2 == 0:
+            size //= 2
+            sizes.append(size)
+        return sizes
+
+    def open_mip_preview(self):
+        """Окно: блок на каждом мип-уровне — как текстура читается издалека"""
+        if self.mip_window is not None:
+            self.mip_window.lift()
+            return
+        win = tk.Toplevel(self.root)
+        win.title("Мип-уровни")
+        win.configure(bg="#1e1e2e")
+        win.resizable(False, False)
+        win.protocol("WM_DELETE_WINDOW", self.close_mip_preview)
+        self.mip_window = win
+        self.mip_row = tk.Frame(win, bg="#1e1e2e")
+        self.mip_row.pack(padx=8, pady=8)
+        self._build_mip_cells(self._mip_sizes(self.texture_size))
+        self.update_mip_preview()
+
+    def _build_mip_cells(self, sizes):
+        """Ячейки уровней с постоянными PhotoImage; пересоздаются только при смене размера текстуры"""
+        for w in self.mip_row.winfo_children():
+            w.destroy()
+        self.mip_level_sizes = sizes
+        self.mip_photos = []
+        for level, size in enumerate(sizes):
+            photo = photo_image("RGB", (128, 128))
+            self.mip_photos.append(photo)
+            cell = tk.Frame(self.mip_row, bg="#1e1e2e")
+            cell.pack(side=tk.LEFT, padx=4)
+            tk.Label(cell, image=photo, bg="#111122").pack()
+            tk.Label(cell, text=f"Уровень {level} — {size}×{size}", bg="#1e1e2e", fg="#aaa",
+                     font=("Arial", 8)).pack()
+
+    def close_mip_preview(self):
+        self.mip_window.destroy()
+        self.mip_window = None
+        self.mip_photos = []
+
+    @traced("preview")
+    def update_mip_preview(self):
+        """Мип-уровни рендерятся в фоне; во время ввода — не обновляются, до паузы (_refine_previews)"""
+        if self.mip_window is None or self.interactive:
+            return
+        self._submit_preview("mips", self._render_mips, (self._preview_snapshot(), dict(self._mip_cache)),
+                             self._show_mips)
 
-        if show_front:
-            faces_to_draw.append(('front', [v['ftl'], v['ftr'], v['fbr'], v['fbl']], front_img))
-        else:
-            faces_to_draw.append(('back', [v['btl'], v['btr'], v['bbr'], v['bbl']],
-                                  self._face_to_pil("back").resize((64, 64), Image.NEAREST)))
+    @traced("preview")
+    def _render_mips(self, snap, cache):
+        """Поток рендера: блок на каждом мип-уровне; цепочки пересчитываются только для изменённых граней"""
+        chains = {}
+        for face in self.FACE_NAMES:
+            pix = snap.faces[face]
+            cached = cache.get(face)
+            if cached is None or cached[0] != pix.generation:
+                cached = (pix.generation, mip_chain(pix.read()))
+            chains[face] = cached
+        levels = min(len(chain) for _, chain in chains.values())
+        images = []
+        for level in range(levels):
+            textures = {f: chains[f][1][level] for f in self.FACE_NAMES}
+            rgb = render_block_scene(textures, (1, 1, 1), math.radians(-35), math.radians(25),
+                                     128, 128, perspective=False)
+            images.append(Image.fromarray(rgb))
+        return chains, images
+
+    @traced("preview")
+    def _show_mips(self, result):
+        chains, images = result
+        self._mip_cache.update(chains)
+        if self.mip_window is None:
+            return
+        sizes = [level.shape[0] for level in chains["front"][1][:len(images)]]
+        if sizes != self.mip_level_sizes:
+            self._build_mip_cells(sizes)
+        for photo, img in zip(self.mip_photos, images):
+            photo.paste(img)
 
-        if show_right:
-            faces_to_draw.append(('left', [v['ftl'], v['btl'], v['bbl'], v['fbl']],
-                                  self._face_to_pil("left").resize((64, 64), Image.NEAREST)))
-        else:
-            faces_to_draw.append(('right', [v['ftr'], v['btr'], v['bbr'], v['fbr']], right_img))
-
-        # Рисуем грани с затенением
-        shade_map = {'top': 1.0, 'bottom': 0.5, 'front': 0.8, 'back': 0.6, 'left': 0.6, 'right': 0.7}
-
-        for face_name, quad, tex in faces_to_draw:
-            shade = shade_map.get(face_name, 0.8)
-            # Получить средний цвет текстуры для заливки полигона
-            avg_colors = []
-            for px in range(0, 64, 8):
-                for py in range(0, 64, 8):
-                    pixel = tex.getpixel((px, py))
-                    if pixel[3] > 0:
-                        avg_colors.append(pixel[:3])
-
-            if avg_colors:
-                ar = int(sum(c[0] for c in avg_colors) / len(avg_colors) * shade)
-                ag = int(sum(c[1] for c in avg_colors) / len(avg_colors) * shade)
-                ab = int(sum(c[2] for c in avg_colors) / len(avg_colors) * shade)
+    def _face_to_pil(self, face):
+        """Конвертировать грань (все слои, сведённые) в PIL Image"""
+        return self.composite(face).to_image()
+
+    # =============================================
+    #  СЛОИ
+    # =============================================
+
+    def composite(self, face):
+        """Сведённые слои грани — из кэша стека, пересчитываются только изменённые тайлы"""
+        return self.layers[face].flatten()
+
+    def _layers_changed(self):
+        self.save_state()
+        self.draw_face_canvas()
+        self.update_layers_window()
+
+    @recorded
+    def add_layer(self):
+        stack = self.layers[self.current_face]
+        stack.layers.insert(stack.active + 1, Layer(TiledFace(self.texture_size), f"Слой {len(stack.layers) + 1}"))
+        stack.active += 1
+        self._layers_changed()
+
+    @recorded
+    def duplicate_layer(self):
+        stack = self.layers[self.current_face]
+        dup = stack.active_layer.copy()
+        dup.name += " (копия)"
+        stack.layers.insert(stack.active + 1, dup)
+        stack.active += 1
+        self._layers_changed()
+
+    @recorded
+    def delete_layer(self):
+        stack = self.layers[self.current_face]
+        if len(stack.layers) == 1:
+            self.update_status(msg="Единственный слой удалить нельзя")
+            return
+        stack.layers.pop(stack.active)
+        stack.active = max(0, stack.active - 1)
+        self._layers_changed()
+
+    @recorded
+    def move_layer(self, delta):
+        stack = self.layers[self.current_face]
+        i, j = stack.active, stack.active + delta
+        if not 0 <= j < len(stack.layers):
+            return
+        stack.layers[i], stack.layers[j] = stack.layers[j], stack.layers[i]
+        stack.active = j
+        self._layers_changed()
+
+    @recorded
+    def merge_layer_down(self):
+        """Свести активный слой в нижний; свойства нижнего сохраняются"""
+        stack = self.layers[self.current_face]
+        if stack.active == 0:
+            return
+        lower, upper = stack.layers[stack.active - 1], stack.layers[stack.active]
+        pair = LayerStack(self.texture_size, [Layer(lower.pixels),
+                                              Layer(upper.pixels, opacity=upper.opacity, blend=upper.blend,
+                                                    visible=upper.visible)])
+        lower.pixels = pair.flatten().snapshot()
+        stack.layers.pop(stack.active)
+        stack.active -= 1
+        self._layers_changed()
+
+    @recorded
+    def select_layer(self, index):
+        self.layers[self.current_face].active = index
+        self.update_layers_window()
+
+    @recorded
+    def set_layer_property(self, **props):
+        """Изменить свойства активного слоя: name, opacity (0..1), visible, blend"""
+        layer = self.layers[self.current_face].active_layer
+        for key, value in props.items():
+            setattr(layer, key, value)
+        self._layers_changed()
+
+    def open_layers_window(self):
+        """Окно слоёв текущей грани"""
+        if self.layers_window is not None:
+            self.layers_window.lift()
+            return
+        win = tk.Toplevel(self.root)
+        win.title("Слои")
+        win.configure(bg="#1e1e2e")
+        win.resizable(False, False)
+        win.protocol("WM_DELETE_WINDOW", self.close_layers_window)
+        self.layers_window = win
+
+        self.layers_list = tk.Listbox(win, height=8, width=34, bg="#2a2a3d", fg="#ddd",
+                                      selectbackground="#0078d4", exportselection=False, font=("Arial", 9))
+        self.layers_list.pack(padx=8, pady=(8, 4))
+        self.layers_list.bind("<<ListboxSelect>>", self.on_layer_select)
+
+        row = tk.Frame(win, bg="#1e1e2e")
+        row.pack(padx=8, pady=2)
+        for text, cmd in [("+", self.add_layer), ("⧉", self.duplicate_layer), ("✕", self.delete_layer),
+                          ("▲", lambda: self.move_layer(1)), ("▼", lambda: self.move_layer(-1)),
+                          ("⤓", self.merge_layer_down)]:
+            tk.Button(row, text=text, width=3, command=cmd, bg="#3b3b55", fg="#ddd", relief=tk.FLAT,
+                      activebackground="#50507a").pack(side=tk.LEFT, padx=1)
+
+        props = tk.Frame(win, bg="#1e1e2e")
+        props.pack(fill=tk.X, padx=8, pady=(4, 8))
+        self.layer_visible_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(props, text="Видимый", variable=self.layer_visible_var, bg="#1e1e2e", fg="#ccc",
+                       selectcolor="#3b3b55",
+                       command=lambda: self.set_layer_property(visible=self.layer_visible_var.get())
+                       ).grid(row=0, column=0, sticky="w")
+        self.layer_blend_var = tk.StringVar(value=BLEND_MODES["normal"])
+        blend_menu = tk.OptionMenu(props, self.layer_blend_var, *BLEND_MODES.values(),
+                                   command=lambda label: self.set_layer_property(blend=next(
+                                       k for k, v in BLEND_MODES.items() if v == label)))
+        blend_menu.configure(bg="#3b3b55", fg="#ddd", relief=tk.FLAT, highlightthickness=0, font=("Arial", 8))
+        blend_menu.grid(row=0, column=1, sticky="e")
+        tk.Label(props, text="Непрозрачность:", bg="#1e1e2e", fg="#aaa", font=("Arial", 8)).grid(row=1, column=0,
+                                                                                               sticky="w")
+        self.layer_opacity_var = tk.IntVar(value=100)
+        scale = tk.Scale(props, from_=0, to=100, orient=tk.HORIZONTAL, variable=self.layer_opacity_var,
+                         bg="#1e1e2e", fg="#aaa", highlightthickness=0, troughcolor="#3b3b55", length=160)
+        scale.grid(row=1, column=1)
+        # Непрозрачность применяется по отпусканию ползунка — одна запись истории
+        scale.bind("<ButtonRelease-1>",
+                   lambda e: self.set_layer_property(opacity=self.layer_opacity_var.get() / 100))
+        self.update_layers_window()
+
+    def close_layers_window(self):
+        self.layers_window.destroy()
+        self.layers_window = None
+
+    def update_layers_window(self):
+        if self.layers_window is None:
+            return
+        stack = self.layers[self.current_face]
+        lb = self.layers_list
+        lb.delete(0, tk.END)
+        # Верхний слой — первой строкой
+        for layer in reversed(stack.layers):
+            eye = "👁" if layer.visible else "  "
+            lb.insert(tk.END, f"{eye} {layer.name} — {round(layer.opacity * 100)}% {BLEND_MODES[layer.blend]}")
+        lb.selection_set(len(stack.layers) - 1 - stack.active)
+        layer = stack.active_layer
+        self.layer_visible_var.set(layer.visible)
+        self.layer_opacity_var.set(round(layer.opacity * 100))
+        self.layer_blend_var.set(BLEND_MODES[layer.blend])
+
+    def on_layer_select(self, event):
+        sel = self.layers_list.curselection()
+        if sel:
+            self.select_layer(len(self.layers[self.current_face].layers) - 1 - sel[0])
+
+    # =============================================
+    #  РАБОЧАЯ ОБЛАСТЬ (НЕСКОЛЬКО БЛОКОВ)
+    # =============================================
+
+    def _block_entry(self):
+        return self.workspace.blocks[self.block_name]
+
+    def _mark_block_saved(self, path):
+        entry = self._block_entry()
+        entry.path = path
+        entry.modified = False
+        entry.opened_sig = BlockEntry.signature(self.layers)
+        self.journal_current()
+        self.update_workspace_window()
+
+    def _block_saved(self, name, path, sig):
+        """Проект блока записан в фоне; правки, сделанные за время записи, остаются несохранёнными"""
+        entry = self.workspace.blocks.get(name)
+        if entry is None:
+            return
+        entry.path = path
+        if entry.loaded and BlockEntry.signature(entry.layers) == sig:
+            self.workspace.mark_saved(entry, path)
+            if name == self.block_name:
+                entry.opened_sig = sig
+        if name == self.block_name:
+            self.journal_current()
+        self.update_workspace_window()
+
+    def _adopt_block(self, entry):
+        """
+        Сделать блок текущим. Редактор получает копии стеков (с общими
+        тайлами): буферы блока могут быть общими с другими блоками.
+        """
+        memo = {}
+        self.layers = {face: entry.layers[face].snapshot(memo) for face in self.FACE_NAMES}
+        self.faces = ActiveLayers(self.layers)
+        entry.layers = self.layers
+        entry.opened_sig = BlockEntry.signature(self.layers)
+        self.block_name = entry.name
+        self.history, self.history_index = entry.history, entry.history_index
+        if not self.history:
+            self.save_state()  # история блока заводится при первом открытии
+        if entry.size != self.texture_size:
+            self.texture_size = entry.size
+            self.zoom_fit(redraw=False)
+        if self.root is not None:
+            self.root.title(f"Minecraft Block Texture Painter — {entry.name}")
+        self.journal_current()
+        self.record_load()
+        self.select_face(entry.current_face)
+        self.update_workspace_window()
+
+    def switch_block(self, name):
+        """Переключиться на другой открытый блок"""
+        if name == self.block_name:
+            return
+        self.workspace.park(self._block_entry(), self.layers, self.history, self.history_index, self.current_face)
+        try:
+            entry = self.workspace.activate(name)
+        except Exception as e:
+            messagebox.showerror("Ошибка", str(e))
+            entry = self.workspace.activate(self.block_name)
+        self._adopt_block(entry)
+
+    def new_workspace_block(self):
+        self.switch_block(self.workspace.add_block("Блок", self.texture_size).name)
+
+    def open_projects_to_workspace(self):
+        """Открыть несколько проектов; блоки загружаются при первом переключении на них"""
+        paths = filedialog.askopenfilenames(filetypes=[("JSON", "*.json")])
+        if not paths:
+            return
+        names = [self.workspace.add_block(os.path.splitext(os.path.basename(p))[0], path=p).name for p in paths]
+        self.switch_block(names[0])
+
+    def next_block(self, step=1):
+        names = sorted(self.workspace.blocks)
+        self.switch_block(names[(names.index(self.block_name) + step) % len(names)])
+
+    def close_block(self):
+        if len(self.workspace.blocks) == 1:
+            self.update_status(msg="Единственный блок закрыть нельзя")
+            return
+        entry = self._block_entry()
+        if (entry.modified or BlockEntry.signature(self.layers) != entry.opened_sig) and not messagebox.askyesno(
+                "Закрыть блок", f"Блок «{entry.name}» не сохранён. Закрыть?"):
+            return
+        name = self.block_name
+        self.switch_block([n for n in self.workspace.blocks if n != name][-1])
+        self.workspace.close_block(name)
+        if self.journal is not None:
+            self.journal.forget(name)
+        self.update_workspace_window()
+
+    def save_all_blocks(self):
+        """Сохранить изменённые блоки, у которых уже есть файл проекта (запись в фоне, как save_project)"""
+        current = self._block_entry()
+        if BlockEntry.signature(self.layers) != current.opened_sig:
+            current.modified = True
+        jobs, skipped = [], []
+        for entry in list(self.workspace.blocks.values()):
+            if not entry.modified:
+                continue
+            if entry.path is None:
+                skipped.append(entry.name)
+                continue
+            try:
+                size, layers = self.workspace.block_snapshot(entry)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"{entry.name}: {e}")
+                continue
+            jobs.append((entry.name, entry.path, size, layers, BlockEntry.signature(entry.layers)))
+        tail = f"; без файла проекта: {', '.join(skipped)}" if skipped else ""
+        if not jobs:
+            self.update_status(msg="Сохранено блоков: 0" + tail)
+            return
+        left, saved, failed = [len(jobs)], [0], []
+
+        def done(name, path, sig, result):
+            if isinstance(result, Exception):
+                failed.append(f"{name}: {result}")
             else:
-                ar, ag, ab = 60, 60, 60
+                self._block_saved(name, path, sig)
+                saved[0] += 1
+            left[0] -= 1
+            if left[0]:
+                return
+            # Выгрузка — после записи: сохранённые блоки просто забываются
+            self.workspace.evict(keep=self.block_name)
+            self.update_status(msg=f"Сохранено блоков: {saved[0]}" + tail)
+            self.update_workspace_window()
+            if failed:
+                messagebox.showerror("Ошибка", "\n".join(failed))
+
+        self.update_status(msg=f"Сохранение блоков: {len(jobs)}...")
+        for name, path, size, layers, sig in jobs:
+            self.run_background(write_project, (path, size, layers),
+                                lambda result, n=name, p=path, g=sig: done(n, p, g, result))
+
+    def ask_memory_limit(self):
+        mb = simpledialog.askinteger("Предел памяти", "Память под блоки рабочей области (МБ):", minvalue=16,
+                                     maxvalue=65536, initialvalue=self.workspace.memory_limit // 2 ** 20)
+        if mb:
+            self.workspace.memory_limit = mb * 2 ** 20
+            self.workspace.evict(keep=self.block_name)
+            self.update_workspace_window()
+
+    def open_workspace_window(self):
+        """Список открытых блоков; двойной щелчок — переключиться"""
+        if self.workspace_window is not None:
+            self.workspace_window.lift()
+            return
+        win = tk.Toplevel(self.root)
+        win.title("Рабочая область")
+        win.configure(bg="#1e1e2e")
+        win.protocol("WM_DELETE_WINDOW", self.close_workspace_window)
+        self.workspace_window = win
+        self.workspace_list = tk.Listbox(win, height=16, width=40, bg="#2a2a3d", fg="#ddd",
+                                         selectbackground="#0078d4", exportselection=False, font=("Arial", 9))
+        self.workspace_list.pack(fill=tk.BOTH, expand=True, padx=8, pady=(8, 4))
+        self.workspace_list.bind("<Double-Button-1>", self.on_workspace_select)
+        self.workspace_mem_var = tk.StringVar()
+        tk.Label(win, textvariable=self.workspace_mem_var, bg="#1e1e2e", fg="#aaa",
+                 font=("Arial", 8)).pack(anchor="w", padx=8, pady=(0, 8))
+        self.update_workspace_window()
+
+    def close_workspace_window(self):
+        self.workspace_window.destroy()
+        self.workspace_window = None
+
+    def update_workspace_window(self):
+        if self.workspace_window is None:
+            return
+        lb = self.workspace_list
+        lb.delete(0, tk.END)
+        self._workspace_names = sorted(self.workspace.blocks)
+        for name in self._workspace_names:
+            entry = self.workspace.blocks[name]
+            mark = "●" if entry.loaded else "○"
+            star = " *" if entry.modified else ""
+            size = entry.sync_size()
+            lb.insert(tk.END, f"{mark} {name}{star} — {size}×{size}")
+        lb.selection_set(self._workspace_names.index(self.block_name))
+        self.workspace_mem_var.set(f"Память: {self.workspace.memory_usage() / 2 ** 20:.1f} МБ "
+                                   f"из {self.workspace.memory_limit // 2 ** 20} МБ")
+
+    def on_workspace_select(self, event):
+        sel = self.workspace_list.curselection()
+        if sel:
+            self.switch_block(self._workspace_names[sel[0]])
 
-            fill_color = f"#{ar:02x}{ag:02x}{ab:02x}"
-            points = []
-            for p in quad:
-                points.extend(p)
+    # =============================================
+    #  ЖУРНАЛ ОПЕРАЦИЙ
+    # =============================================
 
-            if len(points) >= 6:
-                draw.polygon(points, fill=(ar, ag, ab, 255), outline=(40, 40, 40, 255))
+    def toggle_op_log(self):
+        """Начать запись журнала операций в файл или остановить её"""
+        if self.op_log is not None:
+            path, count = self.op_log.path, self.op_log.count
+            self.op_log.close(self)
+            self.op_log = None
+            self.update_status(msg=f"Журнал операций записан: {os.path.basename(path)} ({count} правок)")
+            return
+        fp = filedialog.asksaveasfilename(defaultextension=".oplog",
+                                          filetypes=[("Журнал операций", "*.oplog")])
+        if not fp:
+            return
+        try:
+            self.op_log = OpLog(fp, self)
+        except OSError as e:
+            messagebox.showerror("Ошибка", str(e))
+            return
+        self.update_status(msg="Запись журнала операций…")
 
-            # Нарисовать пиксели текстуры на грани
-            if len(quad) == 4:
-                self._draw_textured_quad(draw, quad, tex, shade)
+    def record_load(self):
+        """Содержимое блока пришло извне (файл, другой блок): в журнал операций — снимок"""
+        if self.op_log is not None:
+            self.op_log.load(self)
 
-        self.preview_3d_photo = ImageTk.PhotoImage(img)
-        self.preview_3d_canvas.delete("all")
-        self.preview_3d_canvas.create_image(w // 2, h // 2, image=self.preview_3d_photo)
-
-    def _draw_textured_quad(self, draw, quad, tex, shade):
-        """Рисует текстуру на четырёхугольнике с помощью билинейной интерполяции"""
-        # Находим bounding box
-        xs = [p[0] for p in quad]
-        ys = [p[1] for p in quad]
-        min_x, max_x = min(xs), max(xs)
-        min_y, max_y = min(ys), max(ys)
-
-        # Для каждого пикселя в bounding box проверяем, внутри ли он quad
-        w = max(1, max_x - min_x)
-        h = max(1, max_y - min_y)
-
-        # Простое текстурирование
-        tex_w, tex_h = tex.size
-        for sy in range(max(0, min_y), min(260, max_y + 1)):
-            for sx in range(max(0, min_x), min(240, max_x + 1)):
-                # Биллинейная интерполяция UV координат
-                if w > 0 and h > 0:
-                    u = (sx - min_x) / w
-                    v = (sy - min_y) / h
-                    tx = int(u * (tex_w - 1))
-                    ty = int(v * (tex_h - 1))
-                    tx = max(0, min(tex_w - 1, tx))
-                    ty = max(0, min(tex_h - 1, ty))
-
-                    pixel = tex.getpixel((tx, ty))
-                    if pixel[3] > 0:
-                        r = int(pixel[0] * shade)
-                        g = int(pixel[1] * shade)
-                        b = int(pixel[2] * shade)
-                        # Проверка внутри полигона (упрощённо)
-                        if self._point_in_quad(sx, sy, quad):
-                            draw.point((sx, sy), fill=(r, g, b, 255))
-
-    def _point_in_quad(self, px, py, quad):
-        """Проверка точки внутри четырёхугольника"""
-        n = len(quad)
-        inside = False
-        j = n - 1
-        for i in range(n):
-            xi, yi = quad[i]
-            xj, yj = quad[j]
-            if ((yi > py) != (yj > py)) and (px < (xj - xi) * (py - yi) / (yj - yi + 0.001) + xi):
-                inside = not inside
-            j = i
-        return inside
+    # =============================================
+    #  ПРОФИЛИРОВАНИЕ
+    # =============================================
 
-    def _face_to_pil(self, face):
-        """Конвертировать грань в PIL Image"""
-        img = Image.new("RGBA", (self.texture_size, self.texture_size), (0, 0, 0, 0))
-        pix = self.faces[face]
-        for (x, y), c in pix.items():
-            if c:
-                r, g, b = self._hex2rgb(c)
-                img.putpixel((x, y), (r, g, b, 255))
-        return img
+    def toggle_hud(self):
+        """Показать или скрыть HUD задержек рядом со строкой состояния"""
+        self.hud_visible = self.hud_visible_var.get()
+        if self.hud_visible:
+            self.hud_label.pack(side=tk.RIGHT)
+            self.update_hud()
+        else:
+            self.hud_label.pack_forget()
+            if self._hud_job is not None:
+                self.root.after_cancel(self._hud_job)
+                self._hud_job = None
+
+    def hud_text(self):
+        """Строка HUD: задержка ввода, кадры штриха, время видов, память граней и истории"""
+        st = self.latency
+        parts = []
+        if st.input_ms is not None:
+            parts.append(f"ввод→экран {st.input_ms:.1f} мс (макс {st.input_max_ms:.1f})")
+        parts.append(f"кадров {st.frames}, пропущено {st.dropped}")
+        views = [f"{label} {st.views[key]:.1f}" for key, label in self.HUD_VIEWS.items() if key in st.views]
+        if views:
+            parts.append(" · ".join(views) + " мс")
+        # Тайлы истории пересчитываются только при её изменении, на каждом тике — лишь живые грани
+        history = self.history
+        key = (id(history), len(history), self.history_index,
+               id(history[0]) if history else None, id(history[-1]) if history else None)
+        if self._hud_history[0] != key:
+            sizes = tile_sizes(history)
+            self._hud_history = (key, sizes, sum(sizes.values()))
+        _, hist_sizes, hist_total = self._hud_history
+        live = tile_sizes([self.layers])
+        faces = sum(live.values())
+        history = hist_total - sum(nbytes for tid, nbytes in live.items() if tid in hist_sizes)
+        parts.append(f"грани {format_bytes(faces)} · история {format_bytes(history)}")
+        return " | ".join(parts)
+
+    def update_hud(self):
+        self._hud_job = None
+        if not self.hud_visible:
+            return
+        self.hud_var.set(self.hud_text())
+        self._hud_job = self.root.after(self.HUD_REFRESH_MS, self.update_hud)
+
+    def memory_report(self):
+        """
+        Байты по подсистемам (ключи MEMORY_LABELS): грани текущего блока,
+        история сверх них, буфер обмена, картинки Tk (4 байта на пиксель),
+        кэши (сведённые слои, снимок превью и его картинки, мип-уровни,
+        фон прозрачности, штамп кисти), другие загруженные блоки. Общий тайл
+        считается один раз — в первой подсистеме, где встретился.
+        Кэши lru_cache (таблицы симметрии и т.п.) не учитываются.
+        """
+        seen = set()
+        report = {"faces": tiles_nbytes([self.layers], seen),
+                  "history": tiles_nbytes(self.history, seen),
+                  "clipboard": face_nbytes(self.clipboard, seen) if self.clipboard is not None else 0}
+
+        photos = [getattr(self, name, None) for name in
+                  ("canvas_photo", "_patch_photo", "overlay_photo", "tile_photo", "preview_3d_photo",
+                   "scene_photo")]
+        photos += list(getattr(self, "mini_photos", {}).values()) + list(getattr(self, "mip_photos", []))
+        report["photos"] = sum(p.width() * p.height() * 4 for p in photos if p is not None)
+
+        caches = 0
+        for state in [self.layers] + self.history:
+            for stack in state.values():
+                if stack._composite is not None:
+                    caches += face_nbytes(stack._composite, seen)
+        snap = self._snapshot
+        if snap is not None:
+            caches += sum(face_nbytes(pix, seen) for pix in snap.faces.values())
+            caches += sum(image_nbytes(img) for img in list(snap._images.values()))
+        caches += sum(image_nbytes(img) for img in list(_checker_cache.values()))
+        caches += sum(level.nbytes for _, chain in self._mip_cache.values() for level in chain)
+        stamp = self._custom_stamp[1]
+        if stamp is not None:
+            caches += sum(arr.nbytes for arr in stamp)
+        report["caches"] = caches
+
+        others = [e for e in self.workspace.blocks.values() if e.loaded and e.name != self.block_name]
+        report["other_blocks"] = tiles_nbytes([state for e in others for state in [e.layers] + e.history], seen)
+        report["total"] = sum(report.values())
+        return report
+
+    def show_memory_report(self):
+        report = self.memory_report()
+        lines = [f"{self.MEMORY_LABELS[key]}: {format_bytes(value)}" for key, value in report.items()]
+        lines.append(f"\nШагов истории: {len(self.history)}, блоков: {len(self.workspace.blocks)}")
+        messagebox.showinfo("Память", "\n".join(lines))
+
+    def show_startup_report(self):
+        messagebox.showinfo("Замер запуска", self.startup.format())
+
+    def toggle_tracing(self):
+        if self.trace_var.get():
+            TRACER.start()
+            self.update_status(msg="Трассировка включена")
+        else:
+            TRACER.stop()
+            self.update_status(msg=f"Трассировка выключена, интервалов: {len(TRACER.spans)}")
+
+    def clear_trace(self):
+        TRACER.clear()
+        self.update_trace_window()
+
+    def export_chrome_trace(self):
+        fp = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("Chrome trace", "*.json")])
+        if not fp: return
+        try:
+            TRACER.write_chrome_trace(fp)
+            self.update_status(msg=f"Трасса записана: {os.path.basename(fp)} — откройте в chrome://tracing")
+        except Exception as e:
+            messagebox.showerror("Ошибка", str(e))
+
+    def open_trace_window(self):
+        """Сводка интервалов: вызовы, общее время, p50/p95/p99 и максимум"""
+        if self.trace_window is not None:
+            self.trace_window.lift()
+            self.update_trace_window()
+            return
+        win = tk.Toplevel(self.root)
+        win.title("Профилирование")
+        win.configure(bg="#1e1e2e")
+        win.protocol("WM_DELETE_WINDOW", self.close_trace_window)
+        self.trace_window = win
+        self.trace_text = tk.Text(win, width=96, height=28, bg="#2a2a3d", fg="#ddd", font=("Courier", 9))
+        self.trace_text.pack(fill=tk.BOTH, expand=True, padx=8, pady=(8, 4))
+        tk.Button(win, text="Обновить", command=self.update_trace_window, bg="#3b3b55", fg="white",
+                  relief=tk.FLAT).pack(anchor="e", padx=8, pady=(0, 8))
+        self.update_trace_window()
+
+    def close_trace_window(self):
+        self.trace_window.destroy()
+        self.trace_window = None
+
+    def update_trace_window(self):
+        if self.trace_window is None:
+            return
+        self.trace_text.delete("1.0", tk.END)
+        if TRACER.spans:
+            self.trace_text.insert(tk.END, TRACER.format_summary())
+        else:
+            self.trace_text.insert(tk.END, "Интервалов нет — включите «Вид → Профилирование → Трассировка»")
 
     # =============================================
     #  ИСТОРИЯ
     # =============================================
 
+    @traced("history")
     def save_state(self):
+        # Общие буферы связанных граней попадают в историю одной копией
         state = {}
+        memo = {}
         for face in self.FACE_NAMES:
-            state[face] = dict(self.faces[face])
+            state[face] = self.layers[face].snapshot(memo)
         self.history = self.history[:self.history_index + 1]
         self.history.append(state)
         if len(self.history) > self.max_history:
             self.history.pop(0)
         self.history_index = len(self.history) - 1
+        self.journal_current()
 
+    @traced("history")
+    @recorded
     def undo(self):
         if self.history_index > 0:
             self.history_index -= 1
             state = self.history[self.history_index]
+            memo = {}
             for face in self.FACE_NAMES:
-                self.faces[face] = dict(state[face])
+                self.layers[face] = state[face].snapshot(memo)
+            self.journal_current()
             self.draw_face_canvas()
+            self.update_layers_window()
 
+    @traced("history")
+    @recorded
     def redo(self):
         if self.history_index < len(self.history) - 1:
             self.history_index += 1
             state = self.history[self.history_index]
+            memo = {}
             for face in self.FACE_NAMES:
-                self.faces[face] = dict(state[face])
+                self.layers[face] = state[face].snapshot(memo)
+            self.journal_current()
             self.draw_face_canvas()
+            self.update_layers_window()
 
     # =============================================
     #  ФАЙЛОВЫЕ ОПЕРАЦИИ
@@ -1151,15 +4810,26 @@ class MinecraftBlockTexturePainter:
 
     def new_block(self):
         if messagebox.askyesno("Новый блок", "Создать новый блок? Несохранённые данные будут потеряны."):
-            for face in self.FACE_NAMES:
-                for x in range(self.texture_size):
-                    for y in range(self.texture_size):
-                        self.faces[face][(x, y)] = None
-            self.history = []
-            self.history_index = -1
-            self.save_state()
-            self.draw_face_canvas()
+            self.reset_block()
 
+    @recorded
+    def reset_block(self):
+        """Пустой блок текущего размера с новой историей"""
+        for face in self.FACE_NAMES:
+            self.layers[face] = LayerStack(self.texture_size)
+        self.history = []
+        self.history_index = -1
+        self.save_state()
+        self.draw_face_canvas()
+
+    @staticmethod
+    def _rgba_array(img):
+        """RGBA-картинка → массив без потерь; у полностью прозрачных пикселей обнуляется цвет"""
+        arr = np.array(img.convert("RGBA"))
+        arr[arr[..., 3] == 0] = 0
+        return arr
+
+    @traced("io")
     def open_single_png(self):
         """Открыть один PNG и загрузить в текущую грань"""
         fp = filedialog.askopenfilename(filetypes=[("PNG", "*.png")])
@@ -1168,14 +4838,12 @@ class MinecraftBlockTexturePainter:
             img = Image.open(fp).convert("RGBA")
             if img.width != img.height:
                 messagebox.showwarning("Предупреждение", "Текстура не квадратная, будет обрезана")
-            sz = min(img.width, img.height)
+            sz = min(img.width, img.height, MAX_TEXTURE_SIZE)
             if sz != self.texture_size:
-                self.resize_texture(sz)
-            for x in range(sz):
-                for y in range(sz):
-                    r, g, b, a = img.getpixel((x, y))
-                    self.faces[self.current_face][(x, y)] = self._rgb2hex(r, g, b) if a > 0 else None
+                self.resize_texture(sz, mode="crop")
+            self.faces[self.current_face] = TiledFace.from_array(self._rgba_array(img.crop((0, 0, sz, sz))))
             self.save_state()
+            self.record_load()
             self.draw_face_canvas()
         except Exception as e:
             messagebox.showerror("Ошибка", str(e))
@@ -1191,73 +4859,82 @@ class MinecraftBlockTexturePainter:
         fp = filedialog.askopenfilename(filetypes=[("PNG", "*.png")])
         if not fp: return
         try:
-            img = Image.open(fp).convert("RGBA")
-            # Определяем размер грани
-            # Пробуем 3×2 (ш×в) или 2×3
-            w, h = img.width, img.height
-
-            if w > h:
-                # 3 колонки, 2 ряда
-                face_w = w // 3
-                face_h = h // 2
-                layout = [
-                    ("top", 0, 0), ("front", 1, 0), ("right", 2, 0),
-                    ("bottom", 0, 1), ("back", 1, 1), ("left", 2, 1),
-                ]
-            elif h > w:
-                # 2 колонки, 3 ряда
-                face_w = w // 2
-                face_h = h // 3
-                layout = [
-                    ("top", 0, 0), ("bottom", 1, 0),
-                    ("front", 0, 1), ("back", 1, 1),
-                    ("left", 0, 2), ("right", 1, 2),
-                ]
-            else:
-                # Квадрат — одна текстура на все грани
-                face_w = w
-                face_h = h
-                layout = [(f, 0, 0) for f in self.FACE_NAMES]
-
-            sz = min(face_w, face_h)
-            if sz != self.texture_size:
-                self.resize_texture(sz)
-
-            for face, col, row in layout:
-                for x in range(sz):
-                    for y in range(sz):
-                        px = col * face_w + x
-                        py = row * face_h + y
-                        if px < w and py < h:
-                            r, g, b, a = img.getpixel((px, py))
-                            self.faces[face][(x, y)] = self._rgb2hex(r, g, b) if a > 0 else None
-
-            self.save_state()
-            self.draw_face_canvas()
+            self.load_atlas(fp)
             messagebox.showinfo("Открыто", f"Атлас загружен: {os.path.basename(fp)}")
         except Exception as e:
             messagebox.showerror("Ошибка", str(e))
 
+    @traced("io")
+    def load_atlas(self, fp):
+        """Загрузить атлас из файла без диалогов (расположение — см. open_atlas)"""
+        img = Image.open(fp).convert("RGBA")
+        # Определяем размер грани
+        # Пробуем 3×2 (ш×в) или 2×3
+        w, h = img.width, img.height
+
+        if w > h:
+            # 3 колонки, 2 ряда
+            face_w = w // 3
+            face_h = h // 2
+            layout = [
+                ("top", 0, 0), ("front", 1, 0), ("right", 2, 0),
+                ("bottom", 0, 1), ("back", 1, 1), ("left", 2, 1),
+            ]
+        elif h > w:
+            # 2 колонки, 3 ряда
+            face_w = w // 2
+            face_h = h // 3
+            layout = [
+                ("top", 0, 0), ("bottom", 1, 0),
+                ("front", 0, 1), ("back", 1, 1),
+                ("left", 0, 2), ("right", 1, 2),
+            ]
+        else:
+            # Квадрат — одна текстура на все грани
+            face_w = w
+            face_h = h
+            layout = [(f, 0, 0) for f in self.FACE_NAMES]
+
+        sz = min(face_w, face_h, MAX_TEXTURE_SIZE)
+        if sz != self.texture_size:
+            self.resize_texture(sz, mode="crop")
+
+        for face, col, row in layout:
+            x0, y0 = col * face_w, row * face_h
+            self.faces[face] = TiledFace.from_array(self._rgba_array(img.crop((x0, y0, x0 + sz, y0 + sz))))
+
+        self.share_identical_faces()
+        self.save_state()
+        self.record_load()
+        self.draw_face_canvas()
+
     def open_project(self):
         """Открыть JSON проект"""
         fp = filedialog.askopenfilename(filetypes=[("JSON", "*.json")])
         if not fp: return
         try:
-            with open(fp, "r") as f:
-                data = json.load(f)
-            sz = data.get("size", 16)
-            if sz != self.texture_size:
-                self.resize_texture(sz)
-            for face in self.FACE_NAMES:
-                face_data = data.get(face, {})
-                for key, val in face_data.items():
-                    x, y = map(int, key.split(","))
-                    self.faces[face][(x, y)] = val
-            self.save_state()
-            self.draw_face_canvas()
+            self.load_project(fp)
         except Exception as e:
             messagebox.showerror("Ошибка", str(e))
 
+    @traced("io")
+    def load_project(self, fp):
+        """Загрузить JSON проект в текущий блок без диалогов"""
+        with open(fp, "r") as f:
+            data = json.load(f)
+        sz, layers = project_from_json(data)
+        if sz != self.texture_size:
+            self.texture_size = sz
+            self.zoom_fit(redraw=False)
+            self.update_status()
+        self.layers.update(layers)
+        self.share_identical_faces()
+        self.save_state()
+        self.record_load()
+        self.draw_face_canvas()
+        self.update_layers_window()
+        self._mark_block_saved(fp)
+
     def save_atlas(self):
         """
         Сохранить атлас 3×2:
@@ -1267,20 +4944,26 @@ class MinecraftBlockTexturePainter:
         fp = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG", "*.png")])
         if not fp: return
         try:
-            sz = self.texture_size
-            atlas = Image.new("RGBA", (sz * 3, sz * 2), (0, 0, 0, 0))
-            layout = [
-                ("top", 0, 0), ("front", 1, 0), ("right", 2, 0),
-                ("bottom", 0, 1), ("back", 1, 1), ("left", 2, 1),
-            ]
-            for face, col, row in layout:
-                face_img = self._face_to_pil(face)
-                atlas.paste(face_img, (col * sz, row * sz))
-            atlas.save(fp, "PNG")
+            self.write_atlas(fp)
             messagebox.showinfo("Сохранено", f"Атлас сохранён: {fp}\n\nРасположение:\ntop | front | right\nbottom | back | left")
         except Exception as e:
             messagebox.showerror("Ошибка", str(e))
 
+    @traced("io")
+    def write_atlas(self, fp):
+        """Записать атлас 3×2 без диалогов (расположение — см. save_atlas)"""
+        sz = self.texture_size
+        atlas = Image.new("RGBA", (sz * 3, sz * 2), (0, 0, 0, 0))
+        layout = [
+            ("top", 0, 0), ("front", 1, 0), ("right", 2, 0),
+            ("bottom", 0, 1), ("back", 1, 1), ("left", 2, 1),
+        ]
+        for face, col, row in layout:
+            face_img = self._face_to_pil(face)
+            atlas.paste(face_img, (col * sz, row * sz))
+        atlas.save(fp, "PNG")
+
+    @traced("io")
     def save_faces_separate(self):
         """Сохранить каждую грань отдельным PNG"""
         folder = filedialog.askdirectory(title="Выберите папку")
@@ -1300,19 +4983,112 @@ class MinecraftBlockTexturePainter:
         """Сохранить проект как JSON"""
         fp = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")])
         if not fp: return
+        # Запись идёт в фоне по снимку слоёв — интерфейс не ждёт
+        memo = {}
+        layers = {face: self.layers[face].snapshot(memo) for face in self.FACE_NAMES}
+        name, sig = self.block_name, BlockEntry.signature(self.layers)
+
+        def done(result):
+            if isinstance(result, Exception):
+                messagebox.showerror("Ошибка", str(result))
+                return
+            self._block_saved(name, fp, sig)
+            self.update_status(msg=f"Проект сохранён: {os.path.basename(fp)}")
+
+        self.run_background(write_project, (fp, self.texture_size, layers), done)
+
+    # =============================================
+    #  ЖУРНАЛ И ФОНОВАЯ ЗАПИСЬ
+    # =============================================
+
+    def start_journal(self):
+        """Предложить восстановить прерванную сессию и начать новый журнал"""
         try:
-            data = {"size": self.texture_size}
-            for face in self.FACE_NAMES:
-                face_data = {}
-                for (x, y), c in self.faces[face].items():
-                    if c:
-                        face_data[f"{x},{y}"] = c
-                data[face] = face_data
-            with open(fp, "w") as f:
-                json.dump(data, f)
-            messagebox.showinfo("Сохранено", f"Проект сохранён: {fp}")
-        except Exception as e:
-            messagebox.showerror("Ошибка", str(e))
+            folder, lock = Journal.claim(self.JOURNAL_DIR)
+        except OSError:
+            traceback.print_exc()
+            return
+        if Journal.pending(folder):
+            try:
+                blocks = Journal.recover(folder)
+            except Exception:
+                traceback.print_exc()
+                Journal.set_aside(folder)
+                messagebox.showwarning("Восстановление", "Прерванную сессию восстановить не удалось.\n"
+                                                         f"Журнал сохранён в папке: {folder}")
+                blocks = None
+            if blocks and messagebox.askyesno(
+                    "Восстановление", f"Найдена прерванная сессия (блоков: {len(blocks)}). Восстановить?"):
+                self.restore_blocks(blocks)
+        try:
+            self.journal = Journal(folder, lock)
+        except OSError:
+            traceback.print_exc()
+            lock.close()
+            return
+        self.root.protocol("WM_DELETE_WINDOW", self.on_exit)
+        self.journal_all_blocks()
+
+    def restore_blocks(self, blocks):
+        """Заменить рабочую область блоками из журнала; текущим станет последний изменённый"""
+        self.workspace.blocks.clear()
+        for name, (path, size, layers) in blocks.items():
+            entry = self.workspace.add_block(name, size, layers, path)
+            entry.modified = True
+        self._adopt_block(self.workspace.activate(entry.name))
+        self.update_status(msg="Сессия восстановлена")
+
+    def journal_all_blocks(self):
+        """
+        Отдать новому журналу все загруженные блоки, а не только текущий:
+        прежний журнал уже затёрт, и восстановленные блоки иначе не попали
+        бы никуда до первого переключения на них. Выгруженные блоки лежат
+        в файлах (проект или временный файл выгрузки).
+        """
+        for name, entry in self.workspace.blocks.items():
+            if name == self.block_name:
+                self.journal_current()
+            elif entry.loaded:
+                if entry.history:
+                    state = entry.history[entry.history_index]
+                else:
+                    memo = {}
+                    state = {face: stack.snapshot(memo) for face, stack in entry.layers.items()}
+                self.journal.log(name, entry.path, state)
+
+    def journal_current(self):
+        """Отдать журналу текущее состояние блока (снимок из истории — без копирования)"""
+        if self.journal is not None and self.history:
+            self.journal.log(self.block_name, self._block_entry().path, self.history[self.history_index])
+
+    def run_background(self, func, args, on_done):
+        """func(*args) в потоке журнала, on_done(результат или исключение) — в главном потоке"""
+        if self.journal is None:
+            try:
+                result = func(*args)
+            except Exception as e:
+                result = e
+            on_done(result)
+            return
+        self.journal.submit(func, args, on_done)
+        if self._journal_poll_job is None:
+            self._journal_poll_job = self.root.after(self.JOURNAL_POLL_MS, self._poll_journal)
+
+    def _poll_journal(self):
+        self._journal_poll_job = None
+        self.journal.poll()
+        if not self.journal.is_idle():
+            self._journal_poll_job = self.root.after(self.JOURNAL_POLL_MS, self._poll_journal)
+
+    def on_exit(self):
+        """Штатный выход: журнал дописывается и удаляется — восстанавливать нечего"""
+        if self.op_log is not None:
+            self.op_log.close(self)
+            self.op_log = None
+        if self.journal is not None:
+            self.journal.close(discard=True)
+            self.journal = None
+        self.root.quit()
 
     def export_resourcepack(self):
         """Экспорт полного ресурспака с моделью блока"""
@@ -1325,91 +5101,7 @@ class MinecraftBlockTexturePainter:
         if not block_name: return
 
         try:
-            base = os.path.join(folder, pack_name)
-            tex_dir = os.path.join(base, "assets", "minecraft", "textures", "block")
-            model_dir = os.path.join(base, "assets", "minecraft", "models", "block")
-            bs_dir = os.path.join(base, "assets", "minecraft", "blockstates")
-            os.makedirs(tex_dir, exist_ok=True)
-            os.makedirs(model_dir, exist_ok=True)
-            os.makedirs(bs_dir, exist_ok=True)
-
-            # pack.mcmeta
-            with open(os.path.join(base, "pack.mcmeta"), "w") as f:
-                json.dump({"pack": {"pack_format": 15,
-                                    "description": f"Block texture pack: {block_name}"}}, f, indent=2)
-
-            # Проверяем, все ли грани одинаковы
-            all_same = all(
-                self.faces[f] == self.faces["front"] for f in self.FACE_NAMES
-            )
-            top_bottom_same = self.faces["top"] == self.faces["bottom"]
-            sides_same = all(
-                self.faces[f] == self.faces["front"] for f in ["back", "left", "right"]
-            )
-
-            if all_same:
-                # Одна текстура
-                self._face_to_pil("front").save(os.path.join(tex_dir, f"{block_name}.png"), "PNG")
-                model = {
-                    "parent": "minecraft:block/cube_all",
-                    "textures": {"all": f"minecraft:block/{block_name}"}
-                }
-            elif sides_same and top_bottom_same:
-                # Верх/низ + бок
-                self._face_to_pil("top").save(os.path.join(tex_dir, f"{block_name}_top.png"), "PNG")
-                self._face_to_pil("front").save(os.path.join(tex_dir, f"{block_name}_side.png"), "PNG")
-                model = {
-                    "parent": "minecraft:block/cube_column",
-                    "textures": {
-                        "end": f"minecraft:block/{block_name}_top",
-                        "side": f"minecraft:block/{block_name}_side"
-                    }
-                }
-            elif sides_same:
-                # Верх + низ + бок
-                self._face_to_pil("top").save(os.path.join(tex_dir, f"{block_name}_top.png"), "PNG")
-                self._face_to_pil("bottom").save(os.path.join(tex_dir, f"{block_name}_bottom.png"), "PNG")
-                self._face_to_pil("front").save(os.path.join(tex_dir, f"{block_name}_side.png"), "PNG")
-                model = {
-                    "parent": "minecraft:block/cube_bottom_top",
-                    "textures": {
-                        "top": f"minecraft:block/{block_name}_top",
-                        "bottom": f"minecraft:block/{block_name}_bottom",
-                        "side": f"minecraft:block/{block_name}_side"
-                    }
-                }
-            else:
-                # Все 6 разные
-                for face in self.FACE_NAMES:
-                    self._face_to_pil(face).save(os.path.join(tex_dir, f"{block_name}_{face}.png"), "PNG")
-
-                mc_face_map = {
-                    "top": "up", "bottom": "down",
-                    "front": "south", "back": "north",
-                    "left": "west", "right": "east"
-                }
-                textures = {}
-                for face in self.FACE_NAMES:
-                    mc_name = mc_face_map[face]
-                    textures[mc_name] = f"minecraft:block/{block_name}_{face}"
-
-                model = {
-                    "parent": "minecraft:block/cube",
-                    "textures": textures
-                }
-
-            with open(os.path.join(model_dir, f"{block_name}.json"), "w") as f:
-                json.dump(model, f, indent=2)
-
-            # blockstates
-            blockstate = {
-                "variants": {
-                    "": {"model": f"minecraft:block/{block_name}"}
-                }
-            }
-            with open(os.path.join(bs_dir, f"{block_name}.json"), "w") as f:
-                json.dump(blockstate, f, indent=2)
-
+            base = self.write_resourcepack(folder, pack_name, block_name)
             messagebox.showinfo("Экспорт", f"Ресурспак создан: {base}\n\n"
                                             f"Структура:\n"
                                             f"├── pack.mcmeta\n"
@@ -1421,56 +5113,148 @@ class MinecraftBlockTexturePainter:
         except Exception as e:
             messagebox.showerror("Ошибка", str(e))
 
+    @traced("io")
+    def write_resourcepack(self, folder, pack_name, block_name):
+        """Записать ресурспак в folder/pack_name без диалогов; возвращает путь к нему"""
+        base = os.path.join(folder, pack_name)
+        tex_dir = os.path.join(base, "assets", "minecraft", "textures", "block")
+        model_dir = os.path.join(base, "assets", "minecraft", "models", "block")
+        bs_dir = os.path.join(base, "assets", "minecraft", "blockstates")
+        os.makedirs(tex_dir, exist_ok=True)
+        os.makedirs(model_dir, exist_ok=True)
+        os.makedirs(bs_dir, exist_ok=True)
+
+        # pack.mcmeta
+        with open(os.path.join(base, "pack.mcmeta"), "w") as f:
+            json.dump({"pack": {"pack_format": 15,
+                                "description": f"Block texture pack: {block_name}"}}, f, indent=2)
+
+        # Проверяем, все ли грани одинаковы
+        flat = {f: self.composite(f) for f in self.FACE_NAMES}
+        all_same = all(
+            flat[f] == flat["front"] for f in self.FACE_NAMES
+        )
+        top_bottom_same = flat["top"] == flat["bottom"]
+        sides_same = all(
+            flat[f] == flat["front"] for f in ["back", "left", "right"]
+        )
+
+        if all_same:
+            # Одна текстура
+            self._face_to_pil("front").save(os.path.join(tex_dir, f"{block_name}.png"), "PNG")
+            model = {
+                "parent": "minecraft:block/cube_all",
+                "textures": {"all": f"minecraft:block/{block_name}"}
+            }
+        elif sides_same and top_bottom_same:
+            # Верх/низ + бок
+            self._face_to_pil("top").save(os.path.join(tex_dir, f"{block_name}_top.png"), "PNG")
+            self._face_to_pil("front").save(os.path.join(tex_dir, f"{block_name}_side.png"), "PNG")
+            model = {
+                "parent": "minecraft:block/cube_column",
+                "textures": {
+                    "end": f"minecraft:block/{block_name}_top",
+                    "side": f"minecraft:block/{block_name}_side"
+                }
+            }
+        elif sides_same:
+            # Верх + низ + бок
+            self._face_to_pil("top").save(os.path.join(tex_dir, f"{block_name}_top.png"), "PNG")
+            self._face_to_pil("bottom").save(os.path.join(tex_dir, f"{block_name}_bottom.png"), "PNG")
+            self._face_to_pil("front").save(os.path.join(tex_dir, f"{block_name}_side.png"), "PNG")
+            model = {
+                "parent": "minecraft:block/cube_bottom_top",
+                "textures": {
+                    "top": f"minecraft:block/{block_name}_top",
+                    "bottom": f"minecraft:block/{block_name}_bottom",
+                    "side": f"minecraft:block/{block_name}_side"
+                }
+            }
+        else:
+            # Все 6 разные
+            for face in self.FACE_NAMES:
+                self._face_to_pil(face).save(os.path.join(tex_dir, f"{block_name}_{face}.png"), "PNG")
+
+            mc_face_map = {
+                "top": "up", "bottom": "down",
+                "front": "south", "back": "north",
+                "left": "west", "right": "east"
+            }
+            textures = {}
+            for face in self.FACE_NAMES:
+                mc_name = mc_face_map[face]
+                textures[mc_name] = f"minecraft:block/{block_name}_{face}"
+
+            model = {
+                "parent": "minecraft:block/cube",
+                "textures": textures
+            }
+
+        with open(os.path.join(model_dir, f"{block_name}.json"), "w") as f:
+            json.dump(model, f, indent=2)
+
+        # blockstates
+        blockstate = {
+            "variants": {
+                "": {"model": f"minecraft:block/{block_name}"}
+            }
+        }
+        with open(os.path.join(bs_dir, f"{block_name}.json"), "w") as f:
+            json.dump(blockstate, f, indent=2)
+        return base
+
     # =============================================
     #  ОПЕРАЦИИ С ГРАНЯМИ
     # =============================================
 
+    @recorded
     def copy_face(self):
-        self.clipboard = dict(self.faces[self.current_face])
+        self.clipboard = self.faces[self.current_face].snapshot()
         self.clipboard_face = self.current_face
         self.update_status(msg="Грань скопирована")
 
+    @recorded
     def paste_face(self):
-        if self.clipboard:
-            self.faces[self.current_face] = dict(self.clipboard)
+        if self.clipboard and self.clipboard.size == self.texture_size:
+            self.faces[self.current_face] = self.clipboard.snapshot()
             self.save_state()
             self.draw_face_canvas()
 
+    @recorded
     def copy_to_all_faces(self):
-        src = dict(self.faces[self.current_face])
+        # Грани ссылаются на один буфер, пока одна из них не изменится
+        src = self.faces[self.current_face]
         for f in self.FACE_NAMES:
-            self.faces[f] = dict(src)
+            self.faces[f] = src
         self.save_state()
         self.draw_face_canvas()
 
+    @recorded
     def copy_to_side_faces(self):
-        src = dict(self.faces[self.current_face])
+        src = self.faces[self.current_face]
         for f in ["front", "back", "left", "right"]:
-            self.faces[f] = dict(src)
+            self.faces[f] = src
         self.save_state()
         self.draw_face_canvas()
 
     def clear_current_face(self):
-        for x in range(self.texture_size):
-            for y in range(self.texture_size):
-                self.faces[self.current_face][(x, y)] = None
-        self.save_state()
-        self.draw_face_canvas()
+        self.clear_faces([self.current_face])
 
     def clear_all_faces(self):
         if messagebox.askyesno("Очистить", "Очистить все 6 граней?"):
-            for f in self.FACE_NAMES:
-                for x in range(self.texture_size):
-                    for y in range(self.texture_size):
-                        self.faces[f][(x, y)] = None
-            self.save_state()
-            self.draw_face_canvas()
+            self.clear_faces(list(self.FACE_NAMES))
 
+    @recorded
+    def clear_faces(self, names):
+        for f in self.write_targets(names):
+            self.faces[f].clear()
+        self.save_state()
+        self.draw_face_canvas()
+
+    @recorded
     def fill_current_face(self):
-        for f in self.get_target_faces():
-            for x in range(self.texture_size):
-                for y in range(self.texture_size):
-                    self.faces[f][(x, y)] = self.current_color
+        for f in self.write_targets():
+            self.faces[f].fill(self.paint_rgba(self.current_color))
         self.save_state()
         self.draw_face_canvas()
 
@@ -1478,87 +5262,94 @@ class MinecraftBlockTexturePainter:
     #  ПРЕОБРАЗОВАНИЯ ГРАНИ
     # =============================================
 
+    @traced("tool")
+    @recorded
+    def transform_faces(self, ops, faces=None):
+        """
+        Применить цепочку преобразований (см. apply_transform_sequence) к граням
+        faces (по умолчанию — целевым) сразу: одна запись истории, одна перерисовка
+        """
+        if apply_transform_sequence(self.faces, ops, faces or self.get_target_faces()):
+            self.save_state()
+            self.draw_face_canvas()
+
+    def queue_transform(self, *op):
+        """Поставить преобразование в очередь; всё накопленное до простоя применяется одним проходом"""
+        self._transform_queue.append(op)
+        if self.root is None:
+            self.flush_transforms()  # без интерфейса простоя нет — сразу
+            return
+        if self._transform_job is None:
+            self._transform_job = self.root.after_idle(self.flush_transforms)
+
+    def flush_transforms(self):
+        self._transform_job = None
+        ops, self._transform_queue = self._transform_queue, []
+        if ops:
+            self.transform_faces(ops)
+
     def rotate_face(self, angle):
-        for f in self.get_target_faces():
-            new = {}
-            for (x, y), c in self.faces[f].items():
-                if angle == 90:
-                    nx, ny = self.texture_size - 1 - y, x
-                elif angle == -90:
-                    nx, ny = y, self.texture_size - 1 - x
-                else:
-                    nx, ny = self.texture_size - 1 - x, self.texture_size - 1 - y
-                new[(nx, ny)] = c
-            self.faces[f] = new
-        self.save_state()
-        self.draw_face_canvas()
+        # 90 — по часовой стрелке
+        self.queue_transform("rotate", angle)
 
     def flip_face(self, direction):
-        for f in self.get_target_faces():
-            new = {}
-            for (x, y), c in self.faces[f].items():
-                if direction == "h":
-                    new[(self.texture_size - 1 - x, y)] = c
-                else:
-                    new[(x, self.texture_size - 1 - y)] = c
-            self.faces[f] = new
-        self.save_state()
-        self.draw_face_canvas()
+        self.queue_transform("flip", direction)
 
     def shift_face(self, dx, dy):
-        for f in self.get_target_faces():
-            new = {}
-            for (x, y), c in self.faces[f].items():
-                nx = (x + dx) % self.texture_size
-                ny = (y + dy) % self.texture_size
-                new[(nx, ny)] = c
-            self.faces[f] = new
-        self.save_state()
-        self.draw_face_canvas()
+        self.queue_transform("shift", dx, dy)
 
     # =============================================
     #  ФИЛЬТРЫ
     # =============================================
 
-    def adjust_brightness(self, amount):
-        for f in self.get_target_faces():
-            for k, c in self.faces[f].items():
-                if c:
-                    r, g, b = self._hex2rgb(c)
-                    self.faces[f][k] = self._rgb2hex(r + amount, g + amount, b + amount)
+    @traced("tool")
+    def _map_rgb(self, func):
+        """Попиксельный фильтр: func(rgb int16 (h, w, 3)) → rgb; прозрачные пиксели не трогаются"""
+        def apply(tile):
+            out = tile.copy()
+            opaque = tile[..., 3] > 0
+            rgb = func(tile[..., :3].astype(np.int16))
+            out[..., :3] = np.where(opaque[..., None], np.clip(rgb, 0, 255), tile[..., :3])
+            return out
+
+        for f in self.write_targets():
+            self.faces[f].map_tiles(apply)
         self.save_state()
         self.draw_face_canvas()
 
+    @recorded
+    def adjust_brightness(self, amount):
+        self._map_rgb(lambda rgb: rgb + amount)
+
+    @recorded
     def grayscale_face(self):
-        for f in self.get_target_faces():
-            for k, c in self.faces[f].items():
-                if c:
-                    r, g, b = self._hex2rgb(c)
-                    gray = int(0.299 * r + 0.587 * g + 0.114 * b)
-                    self.faces[f][k] = self._rgb2hex(gray, gray, gray)
-        self.save_state()
-        self.draw_face_canvas()
+        weights = np.array([0.299, 0.587, 0.114])
+        self._map_rgb(lambda rgb: np.repeat((rgb @ weights).astype(np.int16)[..., None], 3, axis=2))
 
+    @recorded
     def invert_face(self):
-        for f in self.get_target_faces():
-            for k, c in self.faces[f].items():
-                if c:
-                    r, g, b = self._hex2rgb(c)
-                    self.faces[f][k] = self._rgb2hex(255 - r, 255 - g, 255 - b)
-        self.save_state()
-        self.draw_face_canvas()
+        self._map_rgb(lambda rgb: 255 - rgb)
 
+    @recorded(seeded=True)
     def noise_face(self):
-        for f in self.get_target_faces():
-            for k, c in self.faces[f].items():
-                if c:
-                    r, g, b = self._hex2rgb(c)
-                    self.faces[f][k] = self._rgb2hex(
-                        r + random.randint(-15, 15),
-                        g + random.randint(-15, 15),
-                        b + random.randint(-15, 15))
-        self.save_state()
-        self.draw_face_canvas()
+        self._map_rgb(lambda rgb: rgb + np.random.randint(-15, 16, rgb.shape))
+
+    @traced("tool")
+    @recorded
+    def apply_filter(self, kind, radius=1, mask=None):
+        """Свёрточный фильтр (см. CONV_FILTERS) на всех целевых гранях; mask — только эта область"""
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)  # из журнала операций маска приходит списком
+        if filter_faces(self.faces, self.write_targets(), kind, radius, mask,
+                        hex_to_rgba(self.current_color)):
+            self.save_state()
+            self.draw_face_canvas()
+
+    def ask_filter(self, kind):
+        radius = simpledialog.askinteger(CONV_FILTERS[kind], "Радиус (пикселей):", minvalue=1,
+                                         maxvalue=16, initialvalue=1)
+        if radius:
+            self.apply_filter(kind, radius)
 
     # =============================================
     #  ВИД
@@ -1566,44 +5357,122 @@ class MinecraftBlockTexturePainter:
 
     def toggle_grid(self):
         self.grid_visible = not self.grid_visible
-        self.draw_face_canvas()
+        self.render_viewport()
+
+    def zoom_at(self, factor, cx=None, cy=None):
+        """Изменить масштаб, оставив точку холста (cx, cy) под курсором на месте"""
+        if cx is None:
+            w, h = self._viewport_size()
+            cx, cy = w / 2, h / 2
+        new = max(self.ZOOM_MIN, min(self.ZOOM_MAX, self.pixel_size * factor))
+        if new == self.pixel_size:
+            return
+        k = new / self.pixel_size
+        self.pan_x = cx - (cx - self.pan_x) * k
+        self.pan_y = cy - (cy - self.pan_y) * k
+        self.pixel_size = new
+        self.render_viewport()
 
     def zoom_in(self):
-        if self.pixel_size < 48:
-            self.pixel_size += 4
-            cs = self.texture_size * self.pixel_size + 1
-            self.canvas.configure(width=cs, height=cs)
-            self.draw_face_canvas()
+        self.zoom_at(1.25)
 
     def zoom_out(self):
-        if self.pixel_size > 6:
-            self.pixel_size -= 4
-            cs = self.texture_size * self.pixel_size + 1
-            self.canvas.configure(width=cs, height=cs)
-            self.draw_face_canvas()
+        self.zoom_at(0.8)
 
-    def resize_texture(self, new_size):
-        old = self.texture_size
+    def zoom_fit(self, redraw=True):
+        """Вписать грань в окно и отцентрировать"""
+        if self.root is None:
+            return
+        w, h = self._viewport_size()
+        ts = self.texture_size
+        self.pixel_size = max(self.ZOOM_MIN, min(self.ZOOM_MAX, 0.9 * min(w, h) / ts))
+        if self.pixel_size >= 1:
+            self.pixel_size = float(int(self.pixel_size))  # целый масштаб — ровные тексели
+        self.pan_x = (w - ts * self.pixel_size) / 2
+        self.pan_y = (h - ts * self.pixel_size) / 2
+        if redraw:
+            self.render_viewport()
+
+    @traced("input")
+    def on_mouse_wheel(self, event):
+        if getattr(event, "num", None) == 5 or getattr(event, "delta", 0) < 0:
+            self.zoom_at(1 / 1.15, event.x, event.y)
+        else:
+            self.zoom_at(1.15, event.x, event.y)
+
+    def on_pan_start(self, event):
+        self._pan_start = (event.x, event.y, self.pan_x, self.pan_y)
+        self.canvas.configure(cursor="fleur")
+
+    @traced("input")
+    def on_pan_drag(self, event):
+        if self._pan_start is None:
+            return
+        x0, y0, px, py = self._pan_start
+        self.pan_x = px + event.x - x0
+        self.pan_y = py + event.y - y0
+        self.render_viewport()
+
+    def on_pan_end(self, event):
+        self._pan_start = None
+        self.canvas.configure(cursor="crosshair")
+
+    @traced("input")
+    def on_canvas_resize(self, event):
+        if not self._view_centered:
+            self._view_centered = True
+            self.zoom_fit(redraw=False)
+        self.render_viewport()
+
+    def _scroll(self, axis, *args):
+        """Обработчик полос прокрутки: moveto / scroll N units|pages"""
+        w, h = self._viewport_size()
+        view = w if axis == "x" else h
+        ext = self.texture_size * self.pixel_size
+        pan = self.pan_x if axis == "x" else self.pan_y
+        if args[0] == "moveto":
+            pan = -float(args[1]) * ext
+        elif args[0] == "scroll":
+            step = view * 0.9 if args[2] == "pages" else max(self.pixel_size, 16)
+            pan -= int(args[1]) * step
+        if axis == "x":
+            self.pan_x = pan
+        else:
+            self.pan_y = pan
+        self.render_viewport()
+
+    def on_scroll_x(self, *args):
+        self._scroll("x", *args)
+
+    def on_scroll_y(self, *args):
+        self._scroll("y", *args)
+
+    @traced("tool")
+    @recorded
+    def resize_texture(self, new_size, mode=None):
+        """Новый размер всех граней; mode — ключ RESAMPLE_MODES (по умолчанию выбранный в меню)"""
+        mode = mode or self.resample_mode
         self.texture_size = new_size
 
+        # Все слои всех граней ресемплируются одной стопкой
+        # Общие буферы ресемплируются один раз и остаются общими
+        layers = [layer for f in self.FACE_NAMES for layer in self.layers[f].layers]
+        buffers = list({id(layer.pixels): layer.pixels for layer in layers}.values())
+        resized = resample_faces(np.stack([pix.read() for pix in buffers]), new_size, mode)
+        new = {id(pix): TiledFace.from_array(arr) for pix, arr in zip(buffers, resized)}
+        for layer in layers:
+            layer.pixels = new[id(layer.pixels)]
         for face in self.FACE_NAMES:
-            old_pix = dict(self.faces[face])
-            self.faces[face] = {}
-            for x in range(new_size):
-                for y in range(new_size):
-                    self.faces[face][(x, y)] = old_pix.get((x, y))
+            self.layers[face].size = new_size
+            self.layers[face].invalidate()
 
-        if self.pixel_size * new_size > 700:
-            self.pixel_size = max(4, 500 // new_size)
-
-        cs = self.texture_size * self.pixel_size + 1
-        self.canvas.configure(width=cs, height=cs)
+        self.zoom_fit(redraw=False)
         self.save_state()
         self.draw_face_canvas()
         self.update_status()
 
     def custom_resize(self):
-        sz = simpledialog.askinteger("Размер", "Введите размер:", minvalue=4, maxvalue=256,
+        sz = simpledialog.askinteger("Размер", "Введите размер:", minvalue=4, maxvalue=MAX_TEXTURE_SIZE,
                                      initialvalue=self.texture_size)
         if sz:
             self.resize_texture(sz)
@@ -1612,10 +5481,14 @@ class MinecraftBlockTexturePainter:
     #  ШАБЛОНЫ
     # =============================================
 
+    @traced("tool")
     def _fill_face(self, face, gen_func):
-        for x in range(self.texture_size):
-            for y in range(self.texture_size):
-                self.faces[face][(x, y)] = gen_func(x, y)
+        ts = self.texture_size
+        arr = np.zeros((ts, ts, 4), dtype=np.uint8)
+        for x in range(ts):
+            for y in range(ts):
+                arr[y, x] = hex_to_rgba(gen_func(x, y))
+        self.faces[face] = TiledFace.from_array(arr)
 
     def _rnd_shade(self, base_r, base_g, base_b, var=15):
         return self._rgb2hex(
@@ -1623,21 +5496,25 @@ class MinecraftBlockTexturePainter:
             base_g + random.randint(-var, var),
             base_b + random.randint(-var, var))
 
+    @recorded(seeded=True)
     def tpl_stone(self):
         for f in self.FACE_NAMES:
             self._fill_face(f, lambda x, y: self._rnd_shade(128, 128, 128, 15))
         self.save_state(); self.draw_face_canvas()
 
+    @recorded(seeded=True)
     def tpl_dirt(self):
         for f in self.FACE_NAMES:
             self._fill_face(f, lambda x, y: self._rnd_shade(134, 96, 67, 18))
         self.save_state(); self.draw_face_canvas()
 
+    @recorded(seeded=True)
     def tpl_sand(self):
         for f in self.FACE_NAMES:
             self._fill_face(f, lambda x, y: self._rnd_shade(219, 207, 163, 15))
         self.save_state(); self.draw_face_canvas()
 
+    @recorded(seeded=True)
     def tpl_cobblestone(self):
         for f in self.FACE_NAMES:
             def gen(x, y):
@@ -1647,6 +5524,7 @@ class MinecraftBlockTexturePainter:
             self._fill_face(f, gen)
         self.save_state(); self.draw_face_canvas()
 
+    @recorded(seeded=True)
     def tpl_grass(self):
         # Верх — зелёный
         self._fill_face("top", lambda x, y: self._rnd_shade(90, 160, 50, 20))
@@ -1664,6 +5542,7 @@ class MinecraftBlockTexturePainter:
             self._fill_face(f, gen_side)
         self.save_state(); self.draw_face_canvas()
 
+    @recorded(seeded=True)
     def tpl_wood_log(self):
         # Верх/низ — кольца
         for f in ["top", "bottom"]:
@@ -1687,6 +5566,7 @@ class MinecraftBlockTexturePainter:
             self._fill_face(f, gen_bark)
         self.save_state(); self.draw_face_canvas()
 
+    @recorded(seeded=True)
     def tpl_planks(self):
         for f in self.FACE_NAMES:
             def gen(x, y):
@@ -1697,6 +5577,7 @@ class MinecraftBlockTexturePainter:
             self._fill_face(f, gen)
         self.save_state(); self.draw_face_canvas()
 
+    @recorded(seeded=True)
     def tpl_brick(self):
         for f in self.FACE_NAMES:
             def gen(x, y):
@@ -1710,6 +5591,7 @@ class MinecraftBlockTexturePainter:
             self._fill_face(f, gen)
         self.save_state(); self.draw_face_canvas()
 
+    @recorded(seeded=True)
     def tpl_iron_ore(self):
         for f in self.FACE_NAMES:
             def gen(x, y):
@@ -1720,6 +5602,7 @@ class MinecraftBlockTexturePainter:
             self._fill_face(f, gen)
         self.save_state(); self.draw_face_canvas()
 
+    @recorded(seeded=True)
     def tpl_tnt(self):
         # Верх — белый с кругом
         def gen_top(x, y):
@@ -1746,6 +5629,8 @@ class MinecraftBlockTexturePainter:
     # =============================================
 
     def update_status(self, tool=None, msg=None):
+        if self.root is None:
+            return
         t = tool or self.current_tool
         face_name = self.FACE_LABELS[self.current_face].split("(")[0].strip()
         s = f"{self.texture_size}×{self.texture_size} | Грань: {face_name} | Инстр.: {t}"
@@ -1759,6 +5644,42 @@ class MinecraftBlockTexturePainter:
 # =============================================
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = MinecraftBlockTexturePainter(root)
-    root.mainloop()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Minecraft Block Texture Painter")
+    parser.add_argument("--replay", metavar="OPLOG",
+                        help="воспроизвести журнал операций без интерфейса и вывести отчёт")
+    parser.add_argument("--no-render", action="store_true",
+                        help="при воспроизведении не сводить грань в картинку после каждой правки")
+    parser.add_argument("--trace", metavar="JSON",
+                        help="трассировать с запуска и при выходе записать Chrome trace в файл")
+    parser.add_argument("--startup-report", metavar="JSON", nargs="?", const="",
+                        help="вывести этапы запуска и время до готовности к вводу (и записать в JSON)")
+    parser.add_argument("--exit-after-startup", action="store_true",
+                        help="выйти сразу после запуска — для замера времени запуска в скриптах")
+    args = parser.parse_args()
+    if args.trace:
+        TRACER.start()
+    try:
+        if args.replay:
+            report = replay_op_log(OpLog.read(args.replay), render=not args.no_render)
+            print(format_replay_report(report))
+            if args.trace:
+                print(TRACER.format_summary())
+            raise SystemExit(1 if report["mismatches"] else 0)
+        root = tk.Tk()
+        app = MinecraftBlockTexturePainter(root)
+        if args.startup_report is not None or args.exit_after_startup:
+            def startup_done():
+                if args.startup_report is not None:
+                    print(app.startup.format())
+                if args.startup_report:
+                    with open(args.startup_report, "w") as f:
+                        json.dump(app.startup.report(), f, indent=1)
+                if args.exit_after_startup:
+                    app.on_exit()
+            app.startup.on_done = startup_done
+        root.mainloop()
+    finally:
+        if args.trace:
+            TRACER.write_chrome_trace(args.trace)
\ No newline at end of file